@@ -0,0 +1,69 @@
+import io
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from .utils import file_basename_without_ext
+
+
+@dataclass
+class Artifact:
+    """One image handed from stage to stage.
+
+    It carries whichever forms are already at hand: encoded PNG `data` (e.g. the
+    PhotoRoom response), a decoded `image`, and/or a `path` on disk (cache entry
+    or debug copy). Other forms are produced lazily and kept, so an image is
+    decoded or encoded at most once.
+    """
+
+    name: str
+    data: Optional[bytes] = None
+    image: Optional[Image.Image] = None
+    path: Optional[str] = None
+
+    @classmethod
+    def from_path(cls, path: str) -> "Artifact":
+        return cls(name=file_basename_without_ext(path), path=path)
+
+    def open(self) -> Image.Image:
+        if self.image is None:
+            if self.data is not None:
+                img = Image.open(io.BytesIO(self.data))
+            else:
+                img = Image.open(self.path)
+            img.load()
+            self.image = img
+        return self.image
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self.image is not None:
+            return self.image.size
+        # Header only: no pixel decode needed for layout
+        with Image.open(io.BytesIO(self.data) if self.data is not None else self.path) as im:
+            return im.size
+
+    def encoded(self, compress_level: int = 1) -> bytes:
+        if self.data is None:
+            if self.image is not None:
+                buf = io.BytesIO()
+                self.image.save(buf, format="PNG", compress_level=compress_level)
+                self.data = buf.getvalue()
+            else:
+                with open(self.path, "rb") as f:
+                    self.data = f.read()
+        return self.data
+
+    def write(self, path: str, compress_level: int = 1, remember: bool = True) -> str:
+        """Write the encoded image to `path` (atomically) and, with `remember`,
+        point the artifact at it."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{id(self)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.encoded(compress_level))
+        os.replace(tmp, path)
+        if remember:
+            self.path = path
+        return path
@@ -0,0 +1,439 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from PIL import Image, ImageDraw
+
+from .config import load_settings
+from .utils import list_image_files
+
+
+def _sample_cutouts(paths: List[str], tmp: str) -> List[str]:
+    """Use the given images, else work/no_bg, else one synthetic cut-out in `tmp`."""
+    if paths:
+        return paths
+    found = sorted(list_image_files(load_settings().work_no_bg_dir))[:9]
+    if found:
+        return found
+    synth = os.path.join(tmp, "cutout.png")
+    img = Image.new("RGBA", (1200, 1600), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.rounded_rectangle((250, 200, 950, 1400), radius=120, fill=(190, 60, 40, 255))
+    draw.ellipse((450, 500, 750, 800), fill=(0, 0, 0, 0))
+    img.save(synth, format="PNG")
+    return [synth]
+
+
+def bench_shadow(paths: List[str]) -> int:
+    """Time the fast shadow engine against the reference one.
+
+    The pixel difference is printed for information; tests/test_shadow.py
+    holds the tolerance.
+    """
+    import tempfile
+
+    import numpy as np
+
+    from .shadow import MAX_SIDE, SHADOW_BLUR_RADIUS, SHADOW_OFFSET, _fit
+    from .shadow import render_shadow_fast, render_shadow_reference
+
+    total_ref = total_fast = 0.0
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in _sample_cutouts(paths, tmp):
+            with Image.open(path) as im:
+                img = _fit(im.convert("RGBA"), MAX_SIDE)
+            t0 = time.perf_counter()
+            ref = render_shadow_reference(img, SHADOW_OFFSET, SHADOW_BLUR_RADIUS)
+            t1 = time.perf_counter()
+            fast = render_shadow_fast(img, SHADOW_OFFSET, SHADOW_BLUR_RADIUS)
+            t2 = time.perf_counter()
+            total_ref += t1 - t0
+            total_fast += t2 - t1
+            diff = np.abs(np.asarray(ref, dtype=np.int16) - np.asarray(fast, dtype=np.int16))
+            print(
+                f"{os.path.basename(path)} {img.width}x{img.height}: "
+                f"reference {1000 * (t1 - t0):.0f} ms, fast {1000 * (t2 - t1):.0f} ms, "
+                f"max diff {diff.max()}, mean diff {diff.mean():.3f}"
+            )
+    print(f"Total: reference {total_ref:.2f}s, fast {total_fast:.2f}s "
+          f"(x{total_ref / max(total_fast, 1e-9):.1f})")
+    return 0
+
+
+def bench_pdf(paths: List[str], pages: int) -> int:
+    """Time each PDF renderer on one 9-image page and on a `pages`-page document.
+
+    Embedding follows PDF_DPI (set it to 0 to time lossless embedding).
+    """
+    import tempfile
+
+    from .artifact import Artifact
+    from .pdfgen import PDF_RENDERERS, _RENDERERS, _human_size, optimize_for_embed
+    from .pdfgen import wkhtmltopdf_available
+
+    settings = load_settings()
+    with tempfile.TemporaryDirectory() as tmp:
+        sample = _sample_cutouts(paths, tmp)
+        for name in PDF_RENDERERS:
+            if name == "wkhtmltopdf" and not wkhtmltopdf_available(settings):
+                print(f"{name}: skipped (binary not found at {settings.wkhtmltopdf_path})")
+                continue
+            for n_pages in (1, pages):
+                # Fresh artifacts per slot, so every image is decoded as in a real run
+                images = [Artifact.from_path(sample[i % len(sample)]) for i in range(9 * n_pages)]
+                out_path = os.path.join(tmp, f"{name}_{n_pages}.pdf")
+                t0 = time.perf_counter()
+                if settings.pdf_dpi > 0:
+                    images = [
+                        optimize_for_embed(a, settings.pdf_dpi, settings.pdf_jpeg_quality)
+                        for a in images
+                    ]
+                _RENDERERS[name](images, out_path, settings)
+                elapsed = time.perf_counter() - t0
+                print(
+                    f"{name}: {n_pages} page(s) in {elapsed:.2f}s "
+                    f"({1000 * elapsed / n_pages:.0f} ms/page, "
+                    f"{_human_size(os.path.getsize(out_path))})"
+                )
+    return 0
+
+
+def bench_state(entries: int, runs: int) -> int:
+    """Per-poll state cost with `entries` processed files: legacy JSON vs SQLite.
+
+    A poll prunes absent files, looks up every file of the input folder and
+    records one finished batch of 9. File system scans are left out: they are
+    the same for both stores.
+    """
+    import tempfile
+
+    from .state import StateStore
+    from .utils import load_state, save_state
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, "in", f"img_{i:06d}.jpg") for i in range(entries)]
+        batch = [os.path.join(tmp, "in", f"new_{i}.jpg") for i in range(9)]
+        json_path = os.path.join(tmp, "state.json")
+        save_state(json_path, {
+            "processed": paths,
+            "processing": [],
+            "processed_signatures": {p: "1024:1700000000:1700000000" for p in paths},
+            "processed_drive_ids": [f"drive{i}" for i in range(entries)],
+        })
+
+        def legacy_poll() -> None:
+            existing = set(paths)
+            state = load_state(json_path)  # prune_state_absent_files
+            _ = [p for p in state["processed"] if p in existing]
+            state = load_state(json_path)  # collect_new_images
+            processed = set(state["processed"])
+            _ = [p for p in paths if p not in processed]
+            state = load_state(json_path)  # process_batch: processing, then processed
+            state["processing"] = sorted(set(state["processing"]) | set(batch))
+            save_state(json_path, state)
+            state["processed"] = sorted(set(state["processed"]) | set(batch))
+            state["processing"] = []
+            save_state(json_path, state)
+
+        t0 = time.perf_counter()
+        store = StateStore(os.path.join(tmp, "state.db"))
+        store.migrate_json(json_path)
+        migrate_s = time.perf_counter() - t0
+        os.replace(json_path + ".migrated", json_path)
+
+        def sqlite_poll() -> None:
+            store.prune_absent(paths + batch)
+            store.lookup(paths)
+            store.mark_processed(batch, store.mark_processing(batch))
+
+        results = {}
+        for name, poll in (("json", legacy_poll), ("sqlite", sqlite_poll)):
+            timings = []
+            for _ in range(max(1, runs)):
+                t0 = time.perf_counter()
+                poll()
+                timings.append(time.perf_counter() - t0)
+            results[name] = min(timings)
+            print(f"{name}: {1000 * results[name]:.0f} ms per poll ({entries} entries)")
+        print(f"sqlite: migration of {entries} entries took {migrate_s:.2f}s")
+        print(f"x{results['json'] / max(results['sqlite'], 1e-9):.1f} faster per poll")
+    return 0
+
+
+def bench_dedup(entries: int, queries: int) -> int:
+    """Near-duplicate lookups: multi-index vs a linear scan of every hash.
+
+    Hash robustness and the index's exactness are checked in tests/test_dedup.py.
+    """
+    import random
+
+    from .dedup import MultiIndex, hamming
+
+    radius = load_settings().dedup_max_distance
+    rnd = random.Random(0)
+    stored = [rnd.getrandbits(64) for _ in range(entries)]
+    t0 = time.perf_counter()
+    index = MultiIndex(radius)
+    for i, h in enumerate(stored):
+        index.add(h, str(i))
+    build_s = time.perf_counter() - t0
+    # Half the probes are near copies of stored hashes, half are unseen
+    probes = [
+        stored[rnd.randrange(entries)] ^ (1 << rnd.randrange(64)) if i % 2 else rnd.getrandbits(64)
+        for i in range(queries)
+    ]
+    t0 = time.perf_counter()
+    for h in probes:
+        index.search(h, radius)
+    index_s = (time.perf_counter() - t0) / queries
+    t0 = time.perf_counter()
+    for h in probes:
+        sum(1 for s in stored if hamming(h, s) <= radius)
+    scan_s = (time.perf_counter() - t0) / queries
+    print(
+        f"{entries} hashes: multi-index built in {build_s:.2f}s, lookup {1000 * index_s:.2f} ms, "
+        f"linear scan {1000 * scan_s:.2f} ms (x{scan_s / max(index_s, 1e-9):.0f})"
+    )
+    return 0
+
+
+def bench_watch(files: int, events: int) -> int:
+    """Scan cost per poll on a large folder, polling vs the event-driven index."""
+    import tempfile
+
+    from .fsindex import DirectoryIndex
+    from .utils import file_signature, sort_by_ctime
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(files):
+            with open(os.path.join(tmp, f"img{i:06d}.jpg"), "wb") as f:
+                f.write(b"x")
+
+        def poll_scan() -> None:
+            # What each polling cycle did: prune listing, then list + sign again
+            sort_by_ctime(list_image_files(tmp))
+            for p in sort_by_ctime(list_image_files(tmp)):
+                file_signature(p)
+
+        index = DirectoryIndex(tmp)
+        if not index.start():
+            return 1
+        try:
+
+            def index_scan() -> None:
+                index.paths()
+                for p in index.paths():
+                    index.signature(p)
+
+            for name, scan in (("polling", poll_scan), ("events", index_scan)):
+                t0 = time.perf_counter()
+                scan()
+                print(f"{name}: {1000 * (time.perf_counter() - t0):.0f} ms per poll ({files} files)")
+
+            latencies = []
+            for i in range(events):
+                index.wait(0)
+                path = os.path.join(tmp, f"new{i}.jpg")
+                t0 = time.perf_counter()
+                with open(path, "wb") as f:
+                    f.write(b"x")
+                if not index.wait(5.0):
+                    print(f"no event for {path} FAIL")
+                    return 1
+                latencies.append(time.perf_counter() - t0)
+            latencies.sort()
+            print(
+                f"events: detection in {1000 * latencies[len(latencies) // 2]:.1f} ms (median), "
+                f"{1000 * latencies[-1]:.1f} ms (max); polling: up to POLL_INTERVAL_SECONDS"
+            )
+        finally:
+            index.stop()
+    return 0
+
+
+def bench_drive(files: int, polls: int, batch: int = 9, latency: float = 0.15) -> int:
+    """Drive costs against the local stand-in of drive_stand_in.py.
+
+    Polls: full listing vs change feed. Downloads of one batch: one after
+    the other vs concurrent, and prefetched during processing. Uploads:
+    inline vs handed to the background queue. tests/test_gdrive.py checks
+    the results.
+    """
+    import tempfile
+
+    from .drive_stand_in import DriveStandIn
+    from .gdrive import Downloader, DriveFolderFeed, download_file, list_images_in_folder
+    from .gdrive import upload_file
+    from .state import StateStore
+    from .uploads import UploadQueue
+
+    drive = DriveStandIn()
+    service = drive.thread_service()
+    svc = service()
+    folder = "inbox"
+    for i in range(files):
+        drive.put(f"img{i:06d}", folder)
+
+    def timed_polls(label: str, poll) -> None:
+        drive.calls = 0
+        t0 = time.perf_counter()
+        for _ in range(max(1, polls)):
+            poll()
+        print(
+            f"{label}: {drive.calls // max(1, polls)} call(s), "
+            f"{1000 * (time.perf_counter() - t0) / max(1, polls):.0f} ms per poll"
+        )
+
+    try:
+        timed_polls("full listing", lambda: list_images_in_folder(folder, svc))
+        with tempfile.TemporaryDirectory() as tmp:
+            store = StateStore(os.path.join(tmp, "state.db"))
+            feed = DriveFolderFeed(folder, store, resync_seconds=0, service=lambda: svc)
+            drive.calls = 0
+            t0 = time.perf_counter()
+            feed.images()
+            print(
+                f"change feed, first poll (listing): {drive.calls} call(s), "
+                f"{1000 * (time.perf_counter() - t0):.0f} ms"
+            )
+            timed_polls("change feed, idle", feed.images)
+
+            ids = [f"img{i:06d}" for i in range(2 * batch)]
+            for i, fid in enumerate(ids):
+                drive.content[fid] = os.urandom(1 << 20) + bytes([i])
+            drive.media_delay = latency
+            t0 = time.perf_counter()
+            for fid in ids[:batch]:
+                download_file(fid, os.path.join(tmp, "seq", fid), service=svc)
+            seq_s = time.perf_counter() - t0
+            downloader = Downloader(os.path.join(tmp, "dl"), service=service)
+            try:
+                t0 = time.perf_counter()
+                downloader.fetch(ids[:batch])
+                par_s = time.perf_counter() - t0
+                # Next batch downloads while this one "processes"
+                downloader.prefetch(ids[batch:])
+                time.sleep(seq_s)
+                t0 = time.perf_counter()
+                downloader.fetch(ids[batch:])
+                wait_s = time.perf_counter() - t0
+            finally:
+                downloader.close()
+            print(
+                f"downloads of {batch} files ({1000 * latency:.0f} ms each): one by one "
+                f"{seq_s:.2f}s, concurrent {par_s:.2f}s, prefetched {wait_s:.2f}s waited"
+            )
+
+            pdfs = []
+            for i in range(3):
+                pdfs.append(os.path.join(tmp, f"canvas_{i}.pdf"))
+                with open(pdfs[-1], "wb") as f:
+                    f.write(os.urandom(3 << 19))  # 1.5 MB: two 1 MB chunks
+            t0 = time.perf_counter()
+            upload_file(pdfs[0], "scratch", chunk_mb=1, service=svc)
+            inline_s = time.perf_counter() - t0
+            queue = UploadQueue(store, chunk_mb=1, service=service)
+            t0 = time.perf_counter()
+            for path in pdfs:
+                queue.enqueue(path, "out")
+            enqueue_ms = 1000 * (time.perf_counter() - t0) / len(pdfs)
+            queue.wait_idle(120)
+            print(
+                f"uploads of 1.5 MB PDFs: inline {inline_s:.2f}s each; queued {enqueue_ms:.1f} ms "
+                f"each, {len(pdfs)} drained in {time.perf_counter() - t0:.1f}s"
+            )
+    finally:
+        drive.close()
+    return 0
+
+
+# Entry points that must start fast (tests/test_imports.py checks they load
+# no heavy library eagerly)
+STARTUP_MODULES = (
+    "auto_canvas.watch", "auto_canvas.watch_gdrive", "auto_canvas.multiwatch", "auto_canvas.pipeline"
+)
+
+
+def _import_profile(module: str) -> Dict[str, int]:
+    """Cumulative import time (us) per module, from `python -X importtime`."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    profile: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        profile[name.strip()] = int(cumulative)
+    return profile
+
+
+def bench_importtime(modules: List[str], budget_ms: float, runs: int) -> int:
+    """Cold-import each entry point; fail over budget."""
+    failed = 0
+    for module in modules or STARTUP_MODULES:
+        best_ms = min(_import_profile(module).get(module, 0) for _ in range(max(1, runs))) / 1000
+        ok = best_ms <= budget_ms
+        failed += not ok
+        print(f"{module}: {best_ms:.0f} ms (budget {budget_ms:.0f} ms) {'ok' if ok else 'FAIL'}")
+    return 1 if failed else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Auto Canvas micro-benchmarks")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p_shadow = sub.add_parser("shadow", help="Fast vs reference shadow engine")
+    p_shadow.add_argument("paths", nargs="*", help="RGBA cut-outs (default: work/no_bg)")
+
+    p_pdf = sub.add_parser("pdf", help="PDF renderers: one 9-image page and a long document")
+    p_pdf.add_argument("paths", nargs="*", help="Images to lay out (default: work/no_bg)")
+    p_pdf.add_argument("--pages", type=int, default=100, help="Pages in the long document")
+
+    p_imp = sub.add_parser("importtime", help="Cold-start import budget of the entry points")
+    p_imp.add_argument("modules", nargs="*", help=f"Modules (default: {', '.join(STARTUP_MODULES)})")
+    p_imp.add_argument("--budget-ms", type=float, default=150.0, help="Max cumulative import time")
+    p_imp.add_argument("--runs", type=int, default=3, help="Imports per module (best is kept)")
+
+    p_state = sub.add_parser("state", help="Poll cost of the state store, JSON vs SQLite")
+    p_state.add_argument("--entries", type=int, default=100_000, help="Processed files in state")
+    p_state.add_argument("--runs", type=int, default=3, help="Polls per store (best is kept)")
+
+    p_dedup = sub.add_parser("dedup", help="Near-duplicate index lookups vs a linear scan")
+    p_dedup.add_argument("--entries", type=int, default=100_000, help="Hashes in the index")
+    p_dedup.add_argument("--queries", type=int, default=200, help="Lookups to time")
+
+    p_watch = sub.add_parser("watch", help="Folder scan cost, polling vs file events")
+    p_watch.add_argument("--files", type=int, default=20_000, help="Files in the folder")
+    p_watch.add_argument("--events", type=int, default=20, help="New files to time")
+
+    p_drive = sub.add_parser("drive", help="Drive polls, downloads and uploads against a stand-in")
+    p_drive.add_argument("--files", type=int, default=5000, help="Images in the Drive folder")
+    p_drive.add_argument("--polls", type=int, default=5, help="Polls to time")
+
+    args = parser.parse_args()
+    if args.name == "shadow":
+        sys.exit(bench_shadow(args.paths))
+    if args.name == "pdf":
+        sys.exit(bench_pdf(args.paths, args.pages))
+    if args.name == "state":
+        sys.exit(bench_state(args.entries, args.runs))
+    if args.name == "dedup":
+        sys.exit(bench_dedup(args.entries, args.queries))
+    if args.name == "watch":
+        sys.exit(bench_watch(args.files, args.events))
+    if args.name == "drive":
+        sys.exit(bench_drive(args.files, args.polls))
+    if args.name == "importtime":
+        sys.exit(bench_importtime(args.modules, args.budget_ms, args.runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,286 @@
 import os
-import requests
-from typing import List
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
 
-from .config import load_settings
-from .utils import file_basename_without_ext
+from . import profiling, tracing
+from .artifact import Artifact
+from .config import Settings, load_settings
+from .metrics import PHOTOROOM_REQUESTS, STAGE_SECONDS
+from .preprocess import prepare_upload
+from .ratelimit import (
+    QuotaExhaustedError,
+    RateController,
+    RateLimitedError,
+    SharedTokenBucket,
+    TokenBucket,
+)
+from .utils import file_basename_without_ext, unique_output_paths
 
 
 PHOTOROOM_URL = "https://sdk.photoroom.com/v1/segment"
 
+ResultCallback = Callable[[int, Artifact], None]
 
-def remove_background_batch(input_paths: List[str]) -> List[str]:
-    """Remove background for each input image using PhotoRoom API.
+BACKENDS = ("photoroom", "local")
 
-    Returns list of output file paths (PNG to preserve transparency).
+
+class BackgroundBackend:
+    """Background-removal engine selected by BG_BACKEND (or per run).
+
+    Subclasses implement `remove_background`, returning the cut-out in memory;
+    the batch runner below fans it out over `concurrency` threads.
     """
-    settings = load_settings()
-    if not settings.photoroom_api_key:
-        raise RuntimeError("PHOTOROOM_API_KEY not configured")
 
-    outputs: List[str] = []
-    os.makedirs(settings.work_no_bg_dir, exist_ok=True)
+    name = ""
+    concurrency = 1
+
+    def remove_background(self, path: str) -> Artifact:
+        raise NotImplementedError
+
+    def _remove_indexed(
+        self,
+        idx: int,
+        path: str,
+        on_result: Optional[ResultCallback],
+        parent: Optional[tracing.Span] = None,
+    ) -> Artifact:
+        with profiling.section(), STAGE_SECONDS.time(stage="bg"), tracing.span(
+            "bg.image", parent, image=os.path.basename(path), backend=self.name
+        ):
+            result = self.remove_background(path)
+        if on_result is not None:
+            on_result(idx, result)
+        return result
+
+    def remove_background_many(
+        self, input_paths: List[str], on_result: Optional[ResultCallback] = None
+    ) -> List[Artifact]:
+        """Run images on a bounded worker pool; results keep input order.
+
+        `on_result(index, artifact)` fires as each image finishes, so callers can
+        keep paid results even if a later image fails the batch.
+        """
+        jobs = list(enumerate(input_paths))
+        workers = min(self.concurrency, len(jobs))
+        if workers <= 1:
+            return [self._remove_indexed(i, p, on_result) for i, p in jobs]
+        # Image spans run in the pool threads, under the caller's span
+        parent = tracing.current()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"bg-{self.name}") as pool:
+            futures = [pool.submit(self._remove_indexed, i, p, on_result, parent) for i, p in jobs]
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [f for f in futures if f in done and f.exception() is not None]
+            if failed:
+                # Do not start work that would be thrown away with the batch
+                for f in pending:
+                    f.cancel()
+                raise failed[0].exception()
+            return [f.result() for f in futures]
+
+
+class PhotoRoomClient(BackgroundBackend):
+    """PhotoRoom segmentation client with a pooled session and shared pacing.
 
-    headers = {"x-api-key": settings.photoroom_api_key}
+    One instance is kept per process (see `get_client`) so keep-alive connections
+    and the token bucket survive across batches.
+    """
+
+    name = "photoroom"
+
+    def __init__(self, settings: Settings) -> None:
+        self.api_key = settings.photoroom_api_key
+        self.concurrency = max(1, settings.photoroom_concurrency)
+        self.retry_max = settings.photoroom_retry_max
+        self.retry_backoff_seconds = settings.photoroom_retry_backoff_seconds
+        self.preupload_max_side = settings.preupload_max_side
+        self.preupload_quality = settings.preupload_quality
+        self.throttle_retry_max = settings.photoroom_throttle_retry_max
+        # Shared with the other processes (watcher, API) through PHOTOROOM_BUCKET_DB
+        if settings.photoroom_bucket_db:
+            self.bucket = SharedTokenBucket.per_minute(
+                settings.photoroom_requests_per_min,
+                settings.photoroom_burst,
+                path=settings.photoroom_bucket_db,
+            )
+        else:
+            self.bucket = TokenBucket.per_minute(
+                settings.photoroom_requests_per_min, settings.photoroom_burst
+            )
+        self.controller = RateController(
+            self.bucket,
+            max_concurrency=self.concurrency,
+            default_wait=settings.rate_limit_sleep_seconds,
+            cooldown=settings.batch_cooldown_seconds,
+            quota_cooldown=settings.photoroom_quota_cooldown_seconds,
+        )
+        # Imported here so that the local backend and tools start without it
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"x-api-key": self.api_key})
+
+    def remove_background(self, path: str) -> Artifact:
+        import requests
 
-    for idx, path in enumerate(input_paths):
-        name = file_basename_without_ext(path)
-        out_path = os.path.join(settings.work_no_bg_dir, f"{name}.png")
+        # Encoded once; every retry resends the same bytes
+        with tracing.span("bg.prepare"):
+            name, stream, mimetype = prepare_upload(
+                path, self.preupload_max_side, self.preupload_quality
+            )
+            with stream:
+                payload = stream.read()
+        # Separate budgets: a throttled image still gets its retries for
+        # transport errors and 5xx responses
         attempt = 0
+        throttled = 0
         while True:
-            attempt += 1
             try:
-                with open(path, "rb") as f:
-                    files = {"image_file": f}
-                    data = {"format": "png"}
-                    resp = requests.post(
-                        PHOTOROOM_URL,
-                        headers=headers,
-                        files=files,
-                        data=data,
-                        timeout=60,
-                    )
-                if resp.status_code == requests.codes.ok:
-                    with open(out_path, "wb") as out:
-                        out.write(resp.content)
-                    outputs.append(out_path)
-                    break
-                elif resp.status_code in (402, 429):
-                    # Quota/rate limit reached - surface immediately without delaying
-                    raise RuntimeError(
-                        f"PhotoRoom error {resp.status_code}: {resp.text[:200]}"
-                    )
-                else:
-                    raise RuntimeError(
-                        f"PhotoRoom error {resp.status_code}: {resp.text[:200]}"
-                    )
-            except requests.RequestException as e:
-                if attempt >= settings.photoroom_retry_max:
+                # Time in the request but not in the post: waiting for a slot or token
+                with tracing.span(
+                    "photoroom.request", attempt=attempt + 1, throttled=throttled
+                ) as request_span:
+                    with self.controller.slot():
+                        self.bucket.acquire()
+                        with tracing.span("photoroom.post"):
+                            resp = self.session.post(
+                                PHOTOROOM_URL,
+                                files={"image_file": (name, payload, mimetype)},
+                                data={"format": "png"},
+                                timeout=60,
+                            )
+                    request_span.set(status=resp.status_code)
+            except requests.RequestException:
+                PHOTOROOM_REQUESTS.inc(outcome="network")
+                attempt += 1
+                if attempt >= self.retry_max:
                     raise
                 # Small backoff only for transient network errors
-                import time as _t
-                _t.sleep(settings.photoroom_retry_backoff_seconds)
+                time.sleep(self.retry_backoff_seconds)
+                continue
+
+            if resp.status_code == requests.codes.ok:
+                PHOTOROOM_REQUESTS.inc(outcome="ok")
+                self.controller.on_success(resp.headers)
+                return Artifact(name=file_basename_without_ext(path), data=resp.content)
+            if resp.status_code == 429:
+                # Park this image (and every other worker) until the window reopens
+                PHOTOROOM_REQUESTS.inc(outcome="throttled")
+                throttled += 1
+                wait_s = self.controller.on_throttle(resp.headers)
+                if throttled > self.throttle_retry_max:
+                    raise RateLimitedError(
+                        f"PhotoRoom error 429 after {throttled} attempts: {resp.text[:200]}"
+                    )
+                print(f"PhotoRoom rate limited; parking {name} for {wait_s:.0f}s", flush=True)
+                continue
+            if resp.status_code == 402:
+                PHOTOROOM_REQUESTS.inc(outcome="quota")
+                wait_s = self.controller.on_quota_exhausted(resp.headers)
+                raise QuotaExhaustedError(
+                    f"PhotoRoom error 402 (breaker open {wait_s:.0f}s): {resp.text[:200]}"
+                )
+            PHOTOROOM_REQUESTS.inc(outcome="error")
+            if resp.status_code >= 500:
+                attempt += 1
+                if attempt < self.retry_max:
+                    print(f"PhotoRoom error {resp.status_code}; retrying {name}", flush=True)
+                    time.sleep(self.retry_backoff_seconds)
+                    continue
+            raise RuntimeError(f"PhotoRoom error {resp.status_code}: {resp.text[:200]}")
+
+
+_CLIENT: Optional[PhotoRoomClient] = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client(settings: Optional[Settings] = None) -> PhotoRoomClient:
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = PhotoRoomClient(settings or load_settings())
+        return _CLIENT
+
+
+def current_rate() -> Dict[str, object]:
+    """Allowed PhotoRoom rate, concurrency and quota breaker state for this process."""
+    return get_client().controller.snapshot()
+
+
+_LOCAL = None
+
+
+def get_backend(name: str, settings: Optional[Settings] = None) -> BackgroundBackend:
+    s = settings or load_settings()
+    if name == "photoroom":
+        if not s.photoroom_api_key:
+            raise RuntimeError("PHOTOROOM_API_KEY not configured")
+        return get_client(s)
+    if name == "local":
+        global _LOCAL
+        with _CLIENT_LOCK:
+            if _LOCAL is None:
+                # Imported lazily: NumPy is only needed for the offline engine
+                from .local_bg import LocalBackend
+
+                _LOCAL = LocalBackend(s)
+            return _LOCAL
+    raise ValueError(f"Unknown background backend {name!r}; expected one of {BACKENDS}")
+
+
+def remove_background_batch(
+    input_paths: List[str],
+    on_result: Optional[ResultCallback] = None,
+    backend: Optional[str] = None,
+) -> List[Artifact]:
+    """Remove background for each input image with the selected backend.
+
+    Returns one in-memory PNG artifact per input (transparency preserved); they
+    are also written to WORK_NO_BG_DIR when KEEP_WORK_FILES is set. When the
+    primary backend fails and BG_FALLBACK names another one, the images it did
+    not finish are handed to the fallback. `on_result` only reports primary
+    results, so fallback outputs are never cached in place of the real thing.
+    """
+    settings = load_settings()
+    name = backend or settings.bg_backend
+    fallback = settings.bg_fallback if settings.bg_fallback != name else ""
+
+    work_paths: Optional[List[str]] = None
+    if settings.keep_work_files:
+        os.makedirs(settings.work_no_bg_dir, exist_ok=True)
+        work_paths = unique_output_paths(input_paths, settings.work_no_bg_dir)
+    outputs: List[Optional[Artifact]] = [None] * len(input_paths)
 
-    return outputs
+    def _record(idx: int, art: Artifact) -> None:
+        if work_paths is not None:
+            art.write(work_paths[idx], settings.png_compress_level)
+        outputs[idx] = art
 
+    def _record_primary(idx: int, art: Artifact) -> None:
+        _record(idx, art)
+        if on_result is not None:
+            on_result(idx, art)
 
+    try:
+        get_backend(name, settings).remove_background_many(
+            input_paths, on_result=_record_primary
+        )
+        return outputs  # type: ignore[return-value]
+    except Exception as e:
+        if not fallback:
+            raise
+        remaining = [i for i, out in enumerate(outputs) if out is None]
+        print(
+            f"Background backend {name} failed ({e}); "
+            f"using {fallback} for {len(remaining)} image(s)",
+            flush=True,
+        )
+    get_backend(fallback, settings).remove_background_many(
+        [input_paths[i] for i in remaining],
+        on_result=lambda pos, art: _record(remaining[pos], art),
+    )
+    return outputs  # type: ignore[return-value]
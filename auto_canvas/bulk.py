@@ -0,0 +1,213 @@
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Deque, Dict, List, Optional, Tuple
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+from .artifact import Artifact
+from .config import Settings, load_settings
+from .pdfgen import draw_page_3x3, optimize_for_embed
+from .pipeline import run_stages
+from .ratelimit import QuotaExhaustedError, RateLimitedError
+from .utils import chunk, list_image_files
+
+
+# Pages whose embed encoding may still be running while the next page goes
+# through the stages
+PAGES_IN_FLIGHT = 2
+
+
+def _manifest_path(out_dir: str, name: str) -> str:
+    return os.path.join(out_dir, f"{name}.bulk.json")
+
+
+def _save_manifest(path: str, manifest: Dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _load_or_start(path: str, src_dir: str, pages_per_pdf: int) -> Dict:
+    """Resume the manifest for `src_dir` if there is one, else list the folder.
+
+    The file list and page count are frozen in the manifest, so PDF parts keep
+    the same boundaries across restarts even if files are added meanwhile.
+    """
+    source = os.path.abspath(src_dir)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("source") == source:
+            print(
+                f"Resuming bulk run: {manifest['done_parts']} part(s) already written",
+                flush=True,
+            )
+            return manifest
+    manifest = {
+        "source": source,
+        "pages_per_pdf": pages_per_pdf,
+        "files": sorted(list_image_files(src_dir)),
+        "done_parts": 0,
+        "skipped": [],
+    }
+    _save_manifest(path, manifest)
+    return manifest
+
+
+class _Progress:
+    def __init__(self, total: int, done: int) -> None:
+        self.total = total
+        self.done = done
+        self.start_done = done
+        self.started = time.monotonic()
+        self.tty = sys.stdout.isatty()
+
+    def update(self, n: int, part: str) -> None:
+        self.done += n
+        elapsed = time.monotonic() - self.started
+        rate = (self.done - self.start_done) / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        msg = (
+            f"[bulk] {self.done}/{self.total} images, {part}, "
+            f"{rate:.1f} img/s, ETA {int(eta // 60)}m{int(eta % 60):02d}s"
+        )
+        if self.tty:
+            print("\r" + msg, end="", flush=True)
+        else:
+            print(msg, flush=True)
+
+    def close(self) -> None:
+        if self.tty:
+            print(flush=True)
+
+
+def _as_is(art: Artifact) -> Artifact:
+    return art
+
+
+def _stage_page(
+    settings: Settings, page_files: List[str], backend: str, skipped: List[str]
+) -> List[Artifact]:
+    """Run one page through the stages; on failure retry image by image and
+    skip the ones that still fail (quota and rate-limit errors stop the run)."""
+    try:
+        return run_stages(settings, page_files, backend, verbose=False)
+    except (QuotaExhaustedError, RateLimitedError):
+        raise
+    except Exception:
+        pass
+    arts: List[Artifact] = []
+    for path in page_files:
+        try:
+            arts.extend(run_stages(settings, [path], backend, verbose=False))
+        except (QuotaExhaustedError, RateLimitedError):
+            raise
+        except Exception as e:
+            print(f"\nSkipping {path}: {e}", flush=True)
+            if path not in skipped:
+                skipped.append(path)
+    return arts
+
+
+def _write_part(
+    settings: Settings,
+    files: List[str],
+    out_path: str,
+    backend: str,
+    skipped: List[str],
+    progress: _Progress,
+    label: str,
+) -> None:
+    """Stream `files` into one PDF, page by page, then publish it atomically.
+
+    Only the current page's decoded images are held at a time; earlier pages
+    are kept as their (small) embedded JPEGs until the part is saved.
+    """
+    tmp = out_path + ".tmp"
+    c = canvas.Canvas(tmp, pagesize=A4)
+    if settings.pdf_dpi > 0:
+        prepare = partial(
+            optimize_for_embed, dpi=settings.pdf_dpi, quality=settings.pdf_jpeg_quality
+        )
+    else:
+        prepare = _as_is
+    pending: Deque[Tuple[int, List[Future]]] = deque()
+    pages = 0
+
+    def _draw_oldest() -> None:
+        nonlocal pages
+        n_files, futures = pending.popleft()
+        arts = [f.result() for f in futures]
+        if arts:
+            draw_page_3x3(c, arts)
+            pages += 1
+        # Skipped images count too, so the progress total adds up
+        progress.update(n_files, label)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(9, os.cpu_count() or 1))) as pool:
+        for page_files in chunk(files, 9):
+            arts = _stage_page(settings, page_files, backend, skipped)
+            # Embed encoding runs in the pool while the next page is staged
+            pending.append((len(page_files), [pool.submit(prepare, a) for a in arts]))
+            while len(pending) > PAGES_IN_FLIGHT:
+                _draw_oldest()
+        while pending:
+            _draw_oldest()
+    if pages:
+        c.save()
+        os.replace(tmp, out_path)
+
+
+def run_bulk(
+    src_dir: str,
+    pages_per_pdf: Optional[int] = None,
+    backend: Optional[str] = None,
+    out_dir: Optional[str] = None,
+) -> List[str]:
+    """Backfill every image of `src_dir` into PDFs of `pages_per_pdf` pages.
+
+    Progress is recorded per finished PDF in `<out_dir>/<folder>.bulk.json`;
+    running the same command again continues with the first unfinished PDF.
+    """
+    settings = load_settings()
+    backend = backend or settings.bg_backend
+    out_dir = out_dir or settings.output_pdf_dir
+    os.makedirs(out_dir, exist_ok=True)
+    name = os.path.basename(os.path.normpath(os.path.abspath(src_dir))) or "bulk"
+    manifest_path = _manifest_path(out_dir, name)
+    manifest = _load_or_start(
+        manifest_path, src_dir, pages_per_pdf or settings.bulk_pages_per_pdf
+    )
+
+    files: List[str] = manifest["files"]
+    parts = chunk(files, 9 * max(1, int(manifest["pages_per_pdf"])))
+    done_parts = int(manifest["done_parts"])
+    progress = _Progress(len(files), sum(len(p) for p in parts[:done_parts]))
+    written: List[str] = []
+    try:
+        for part_no in range(done_parts + 1, len(parts) + 1):
+            out_path = os.path.join(out_dir, f"{name}_part{part_no:04d}.pdf")
+            label = f"part {part_no}/{len(parts)}"
+            _write_part(
+                settings, parts[part_no - 1], out_path, backend,
+                manifest["skipped"], progress, label,
+            )
+            if os.path.exists(out_path):
+                written.append(out_path)
+            manifest["done_parts"] = part_no
+            _save_manifest(manifest_path, manifest)
+    finally:
+        progress.close()
+    print(
+        f"Bulk done: {len(files)} image(s) in {len(parts)} PDF(s) in {out_dir}"
+        + (f", {len(manifest['skipped'])} skipped" if manifest["skipped"] else ""),
+        flush=True,
+    )
+    return written
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from .artifact import Artifact
+from .config import Settings, load_settings
+from .metrics import CACHE_REQUESTS
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    """On-disk, content-addressed store for stage outputs (no_bg, shadow).
+
+    Entries live at `<root>/<stage>/<key[:2]>/<key>.png`. Access refreshes the
+    file mtime so the least recently used entries are evicted first once the
+    total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes: int, compress_level: int = 1) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._entries: Optional["OrderedDict[str, int]"] = None
+        self._total = 0
+
+    @staticmethod
+    def key(stage: str, source: str, **params) -> str:
+        """Key from the source digest (input bytes or upstream key) and stage parameters."""
+        payload = json.dumps({"stage": stage, "source": source, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, stage: str, key: str) -> str:
+        return os.path.join(self.root, stage, key[:2], f"{key}.png")
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        if self._entries is None:
+            found = []
+            for dirpath, _, names in os.walk(self.root):
+                for name in names:
+                    if not name.endswith(".png"):
+                        continue
+                    p = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(p)
+                    except FileNotFoundError:
+                        continue
+                    found.append((st.st_mtime, p, st.st_size))
+            found.sort()
+            self._entries = OrderedDict((p, size) for _, p, size in found)
+            self._total = sum(self._entries.values())
+        return self._entries
+
+    def get(self, stage: str, key: str) -> Optional[Artifact]:
+        path = self._path(stage, key)
+        with self._lock:
+            entries = self._load_index()
+            if path in entries:
+                # Read now: eviction may delete the file before the artifact is used
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    os.utime(path)
+                except OSError:
+                    data = None
+                if data is not None:
+                    entries.move_to_end(path)
+                    self.hits[stage] = self.hits.get(stage, 0) + 1
+                    CACHE_REQUESTS.inc(stage=stage, result="hit")
+                    return Artifact(name=key, data=data)
+            if path in entries:
+                self._total -= entries.pop(path)
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+            CACHE_REQUESTS.inc(stage=stage, result="miss")
+            return None
+
+    def contains(self, stage: str, key: str) -> bool:
+        """Whether an entry exists, without counting a hit or refreshing it."""
+        path = self._path(stage, key)
+        with self._lock:
+            return path in self._load_index() and os.path.exists(path)
+
+    def put(self, stage: str, key: str, artifact: Artifact) -> Artifact:
+        """Store the encoded `artifact` (reusing its bytes when it has them).
+
+        The artifact keeps its bytes and does not point at the entry, which
+        eviction may delete while the artifact is still waiting to be used.
+        """
+        path = self._path(stage, key)
+        artifact.write(path, self.compress_level, remember=False)
+        size = os.path.getsize(path)
+        with self._lock:
+            entries = self._load_index()
+            self._total -= entries.pop(path, 0)
+            entries[path] = size
+            self._total += size
+            self._evict(keep=path)
+        return artifact
+
+    def _evict(self, keep: str) -> None:
+        entries = self._entries
+        while self._total > self.max_bytes and len(entries) > 1:
+            oldest = next(iter(entries))
+            if oldest == keep:
+                entries.move_to_end(oldest)
+                oldest = next(iter(entries))
+            self._total -= entries.pop(oldest)
+            try:
+                os.remove(oldest)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        stages = set(self.hits) | set(self.misses)
+        return {
+            s: {"hits": self.hits.get(s, 0), "misses": self.misses.get(s, 0)}
+            for s in sorted(stages)
+        }
+
+    def describe(self) -> str:
+        parts = [f"{s} {v['hits']} hit/{v['misses']} miss" for s, v in self.stats().items()]
+        return ", ".join(parts) + f" ({self._total // (1024 * 1024)} MB)"
+
+
+_CACHE: Optional[ArtifactCache] = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache(settings: Optional[Settings] = None) -> Optional[ArtifactCache]:
+    """Process-wide cache, or None when CACHE_MAX_MB is 0."""
+    global _CACHE
+    s = settings or load_settings()
+    if s.cache_max_mb <= 0:
+        return None
+    with _CACHE_LOCK:
+        max_bytes = s.cache_max_mb * 1024 * 1024
+        if (
+            _CACHE is None
+            or _CACHE.root != s.cache_dir
+            or _CACHE.max_bytes != max_bytes
+            or _CACHE.compress_level != s.png_compress_level
+        ):
+            _CACHE = ArtifactCache(s.cache_dir, max_bytes, s.png_compress_level)
+        return _CACHE
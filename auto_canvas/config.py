@@ -1,9 +1,12 @@
 import os
+import threading
 from dataclasses import dataclass
-from dotenv import load_dotenv
+from typing import Optional
 
+from dotenv import dotenv_values, find_dotenv
 
-@dataclass
+
+@dataclass(frozen=True)
 class Settings:
     photoroom_api_key: str
     wkhtmltopdf_path: str
@@ -13,6 +16,7 @@ class Settings:
     work_shadow_dir: str
     state_file: str
     batch_size: int = 9
+    batch_max_wait_seconds: int = 900
     poll_interval_seconds: int = 5
     stability_seconds: int = 3
     photoroom_requests_per_min: int = 6
@@ -20,10 +24,121 @@ class Settings:
     photoroom_retry_backoff_seconds: int = 5
     batch_cooldown_seconds: int = 10
     rate_limit_sleep_seconds: int = 65
+    photoroom_concurrency: int = 4
+    photoroom_burst: int = 4
+    photoroom_bucket_db: str = ""
+    cache_dir: str = ""
+    cache_max_mb: int = 1024
+    preupload_max_side: int = 1600
+    preupload_quality: int = 90
+    photoroom_quota_cooldown_seconds: int = 900
+    photoroom_throttle_retry_max: int = 10
+    bg_backend: str = "photoroom"
+    bg_fallback: str = ""
+    shadow_engine: str = "fast"
+    shadow_workers: int = 1
+    shadow_max_inflight: int = 0
+    keep_work_files: bool = False
+    png_compress_level: int = 1
+    pdf_renderer: str = "reportlab"
+    pdf_dpi: int = 200
+    pdf_jpeg_quality: int = 85
+    bulk_pages_per_pdf: int = 50
+    pipeline_streaming: bool = True
+    pipeline_bg_workers: int = 0
+    pipeline_queue_size: int = 9
+    pipeline_max_batches: int = 2
+    state_db: str = ""
+    dedup_mode: str = "off"
+    dedup_max_distance: int = 5
+    watch_events: bool = True
+    watch_reconcile_seconds: int = 300
+    gdrive_resync_seconds: int = 3600
+    gdrive_download_workers: int = 4
+    gdrive_chunk_mb: int = 32
+    gdrive_upload_chunk_mb: int = 8
+    watch_folders: str = ""
+    watch_workers: int = 2
+    metrics_dir: str = ""
+    trace_file: str = ""
+    trace_max_mb: int = 50
+    profile_dir: str = ""
+    jobs_dir: str = ""
+    jobs_workers: int = 1
+    jobs_queue_size: int = 20
+    jobs_max_images: int = 45
+    jobs_ttl_seconds: int = 3600
+
+
+_SETTINGS: Optional[Settings] = None
+_SETTINGS_LOCK = threading.Lock()
+_ENV_PATH = ""
+_ENV_MTIME = 0.0
+# Variables set by the real environment win over .env, also on reload
+_PROCESS_ENV_KEYS = frozenset(os.environ)
+
+
+def _apply_dotenv() -> None:
+    global _ENV_PATH, _ENV_MTIME
+    _ENV_PATH = find_dotenv()
+    if not _ENV_PATH:
+        return
+    _ENV_MTIME = os.path.getmtime(_ENV_PATH)
+    for key, value in dotenv_values(_ENV_PATH).items():
+        if value is not None and key not in _PROCESS_ENV_KEYS:
+            os.environ[key] = value
 
 
 def load_settings() -> Settings:
-    load_dotenv()
+    """Settings snapshot, read from the environment and `.env` once per process.
+
+    Use `reload_settings()` (or `reload_if_env_changed()`) to pick up changes.
+    """
+    settings = _SETTINGS
+    if settings is None:
+        with _SETTINGS_LOCK:
+            if _SETTINGS is None:
+                return _reload_locked()
+            return _SETTINGS
+    return settings
+
+
+def reload_settings() -> Settings:
+    """Re-read `.env` and the environment into a fresh snapshot."""
+    with _SETTINGS_LOCK:
+        return _reload_locked()
+
+
+def reload_if_env_changed() -> bool:
+    """Reload when `.env` was modified since the last load; cheap enough to poll."""
+    if not _ENV_PATH:
+        return False
+    try:
+        changed = os.path.getmtime(_ENV_PATH) != _ENV_MTIME
+    except OSError:
+        return False
+    if changed:
+        reload_settings()
+        print(f"Settings reloaded from {_ENV_PATH}", flush=True)
+    return changed
+
+
+def install_reload_signal() -> None:
+    """Reload settings on SIGHUP (POSIX only; a no-op on Windows)."""
+    import signal
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: reload_settings())
+
+
+def _reload_locked() -> Settings:
+    global _SETTINGS
+    _SETTINGS = _read_settings()
+    return _SETTINGS
+
+
+def _read_settings() -> Settings:
+    _apply_dotenv()
 
     root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 
@@ -43,11 +158,64 @@ def load_settings() -> Settings:
             "WORK_SHADOW_DIR", _default_path("work", "shadow")
         ),
         state_file=os.getenv("STATE_FILE", _default_path(".state.json")),
+        stability_seconds=int(os.getenv("STABILITY_SECONDS", "3")),
+        batch_max_wait_seconds=int(os.getenv("BATCH_MAX_WAIT_SECONDS", "900")),
         photoroom_requests_per_min=int(os.getenv("PHOTOROOM_RPM", "6")),
         photoroom_retry_max=int(os.getenv("PHOTOROOM_RETRY_MAX", "3")),
         photoroom_retry_backoff_seconds=int(os.getenv("PHOTOROOM_RETRY_BACKOFF", "5")),
         batch_cooldown_seconds=int(os.getenv("BATCH_COOLDOWN_SECONDS", "10")),
         rate_limit_sleep_seconds=int(os.getenv("RATE_LIMIT_SLEEP_SECONDS", "65")),
+        photoroom_concurrency=int(os.getenv("PHOTOROOM_CONCURRENCY", "4")),
+        photoroom_burst=int(
+            os.getenv("PHOTOROOM_BURST", os.getenv("PHOTOROOM_CONCURRENCY", "4"))
+        ),
+        photoroom_bucket_db=os.getenv(
+            "PHOTOROOM_BUCKET_DB", _default_path("work", "photoroom_bucket.db")
+        ).strip(),
+        cache_dir=os.getenv("CACHE_DIR", _default_path("work", "cache")),
+        cache_max_mb=int(os.getenv("CACHE_MAX_MB", "1024")),
+        preupload_max_side=int(os.getenv("PREUPLOAD_MAX_SIDE", "1600")),
+        preupload_quality=int(os.getenv("PREUPLOAD_QUALITY", "90")),
+        photoroom_quota_cooldown_seconds=int(os.getenv("PHOTOROOM_QUOTA_COOLDOWN", "900")),
+        photoroom_throttle_retry_max=int(os.getenv("PHOTOROOM_THROTTLE_RETRY_MAX", "10")),
+        bg_backend=os.getenv("BG_BACKEND", "photoroom").strip().lower(),
+        bg_fallback=os.getenv("BG_FALLBACK", "").strip().lower(),
+        shadow_engine=os.getenv("SHADOW_ENGINE", "fast").strip().lower(),
+        shadow_workers=int(os.getenv("SHADOW_WORKERS", str(os.cpu_count() or 1))),
+        shadow_max_inflight=int(os.getenv("SHADOW_MAX_INFLIGHT", "0")),
+        keep_work_files=os.getenv("KEEP_WORK_FILES", "0").strip().lower() in ("1", "true", "yes"),
+        png_compress_level=int(os.getenv("PNG_COMPRESS_LEVEL", "1")),
+        pdf_renderer=os.getenv("PDF_RENDERER", "reportlab").strip().lower(),
+        pdf_dpi=int(os.getenv("PDF_DPI", "200")),
+        pdf_jpeg_quality=int(os.getenv("PDF_JPEG_QUALITY", "85")),
+        bulk_pages_per_pdf=int(os.getenv("BULK_PAGES_PER_PDF", "50")),
+        pipeline_streaming=os.getenv("PIPELINE_STREAMING", "1").strip().lower() in ("1", "true", "yes"),
+        pipeline_bg_workers=int(os.getenv("PIPELINE_BG_WORKERS", "0")),
+        pipeline_queue_size=int(os.getenv("PIPELINE_QUEUE_SIZE", "9")),
+        pipeline_max_batches=int(os.getenv("PIPELINE_MAX_BATCHES", "2")),
+        state_db=os.getenv(
+            "STATE_DB",
+            os.path.splitext(os.getenv("STATE_FILE", _default_path(".state.json")))[0] + ".db",
+        ),
+        dedup_mode=os.getenv("DEDUP_MODE", "off").strip().lower(),
+        dedup_max_distance=int(os.getenv("DEDUP_MAX_DISTANCE", "5")),
+        watch_events=os.getenv("WATCH_EVENTS", "1").strip().lower() in ("1", "true", "yes"),
+        watch_reconcile_seconds=int(os.getenv("WATCH_RECONCILE_SECONDS", "300")),
+        gdrive_resync_seconds=int(os.getenv("GDRIVE_RESYNC_SECONDS", "3600")),
+        gdrive_download_workers=int(os.getenv("GDRIVE_DOWNLOAD_WORKERS", "4")),
+        gdrive_chunk_mb=int(os.getenv("GDRIVE_CHUNK_MB", "32")),
+        gdrive_upload_chunk_mb=int(os.getenv("GDRIVE_UPLOAD_CHUNK_MB", "8")),
+        watch_folders=os.getenv("WATCH_FOLDERS", "").strip(),
+        watch_workers=int(os.getenv("WATCH_WORKERS", "2")),
+        metrics_dir=os.getenv("METRICS_DIR", _default_path("work", "metrics")).strip(),
+        trace_file=os.getenv("TRACE_FILE", _default_path("work", "traces.jsonl")).strip(),
+        trace_max_mb=int(os.getenv("TRACE_MAX_MB", "50")),
+        profile_dir=os.getenv("PROFILE_DIR", _default_path("work", "profile")).strip(),
+        jobs_dir=os.getenv("JOBS_DIR", _default_path("work", "jobs")),
+        jobs_workers=int(os.getenv("JOBS_WORKERS", "1")),
+        jobs_queue_size=int(os.getenv("JOBS_QUEUE_SIZE", "20")),
+        jobs_max_images=int(os.getenv("JOBS_MAX_IMAGES", "45")),
+        jobs_ttl_seconds=int(os.getenv("JOBS_TTL_SECONDS", "3600")),
     )
 
     # Ensure folders exist
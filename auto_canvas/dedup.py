@@ -0,0 +1,208 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from .cache import ArtifactCache
+from .config import Settings, load_settings
+from .state import StateStore, get_state_store
+
+
+DEDUP_MODES = ("off", "reuse", "skip")
+# dHash on a 9x8 grey thumbnail: 64 bits, robust to resizing and recompression
+HASH_SIZE = 8
+# Thumbnails whose grey levels span less than this are featureless (blank
+# frames, plain backdrops): their hashes would all collide, so they are not
+# indexed
+MIN_CONTRAST = 8
+
+
+def dhash(path: str, hash_size: int = HASH_SIZE) -> Optional[int]:
+    """Difference hash: one bit per horizontally adjacent pixel pair.
+
+    None for featureless images (see MIN_CONTRAST).
+    """
+    with Image.open(path) as im:
+        if im.format == "JPEG":
+            # Decode at reduced scale; the hash only needs a thumbnail
+            im.draft("L", (hash_size * 16, hash_size * 16))
+        grey = ImageOps.exif_transpose(im).convert("L")
+    px = grey.resize((hash_size + 1, hash_size), Image.BOX).tobytes()
+    if max(px) - min(px) < MIN_CONTRAST:
+        return None
+    h = 0
+    for row in range(hash_size):
+        base = row * (hash_size + 1)
+        for col in range(hash_size):
+            h = (h << 1) | (px[base + col] < px[base + col + 1])
+    return h
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndex:
+    """Multi-index hashing over 64-bit hashes for Hamming radius searches.
+
+    Hashes are split into `max_distance + 1` blocks, each with its own hash
+    table. Two hashes within `max_distance` bits agree exactly on at least one
+    block (pigeonhole), so a search only compares the entries sharing a block
+    with the query instead of every stored hash.
+    """
+
+    def __init__(self, max_distance: int, bits: int = HASH_SIZE * HASH_SIZE) -> None:
+        self.max_distance = max_distance
+        n = min(bits, max_distance + 1)
+        bounds = [bits * i // n for i in range(n + 1)]
+        self._blocks = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._tables: List[Dict[int, List[Tuple[int, str]]]] = [{} for _ in self._blocks]
+        self.size = 0
+
+    def add(self, h: int, value: str) -> None:
+        self.size += 1
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            table.setdefault((h >> shift) & mask, []).append((h, value))
+
+    def search(self, h: int, radius: Optional[int] = None) -> List[Tuple[int, int, str]]:
+        """(distance, hash, value) of every entry within `radius`, closest first."""
+        radius = self.max_distance if radius is None else min(radius, self.max_distance)
+        found: Dict[Tuple[int, str], Tuple[int, int, str]] = {}
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            for other, value in table.get((h >> shift) & mask, ()):
+                if (other, value) in found:
+                    continue
+                d = hamming(h, other)
+                if d <= radius:
+                    found[(other, value)] = (d, other, value)
+        return sorted(found.values(), key=lambda item: item[0])
+
+
+@dataclass
+class Match:
+    path: str
+    distance: int
+    bg_key: Optional[str]
+
+
+class DuplicateIndex:
+    """Perceptual hashes of every ingested image, persisted in the state store.
+
+    The in-memory multi-index is rebuilt from the `phashes` table when the
+    index is opened; every new hash is written through to the table.
+    """
+
+    def __init__(self, store: StateStore, max_distance: int) -> None:
+        self.store = store
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._hashes = MultiIndex(max_distance)
+        self._by_path: Dict[str, Tuple[int, Optional[str]]] = {}
+        for path, h, key in store.phashes():
+            self._hashes.add(h, path)
+            self._by_path[path] = (h, key)
+
+    def check(self, path: str, bg_key: Optional[str] = None) -> Optional[Match]:
+        """Hash `path`, record it, and return the closest earlier near-duplicate."""
+        h = dhash(path)
+        if h is None:
+            return None
+        with self._lock:
+            match = None
+            for d, node_hash, other in self._hashes.search(h):
+                current = self._by_path.get(other)
+                # Skip itself and stale nodes of paths whose content changed
+                if other == path or current is None or current[0] != node_hash:
+                    continue
+                match = Match(other, d, current[1])
+                break
+            previous = self._by_path.get(path)
+            if previous is None or previous[0] != h:
+                self._hashes.add(h, path)
+            self._by_path[path] = (h, bg_key or (previous[1] if previous else None))
+        self.store.add_phash(path, h, bg_key)
+        return match
+
+    def count(self, name: str) -> int:
+        return self.store.bump_counter(f"dedup_{name}")
+
+
+_INDEXES: Dict[str, DuplicateIndex] = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def get_duplicate_index(settings: Optional[Settings] = None) -> Optional[DuplicateIndex]:
+    """Index of the state store's images, or None when DEDUP_MODE is off."""
+    s = settings or load_settings()
+    if s.dedup_mode not in DEDUP_MODES:
+        raise ValueError(f"Unknown DEDUP_MODE {s.dedup_mode!r}; expected one of {DEDUP_MODES}")
+    if s.dedup_mode == "off":
+        return None
+    store = get_state_store(s)
+    with _INDEX_LOCK:
+        index = _INDEXES.get(store.path)
+        # The block layout depends on the radius: rebuild when it changes
+        if index is None or index.max_distance != s.dedup_max_distance:
+            index = _INDEXES[store.path] = DuplicateIndex(store, s.dedup_max_distance)
+        return index
+
+
+def reuse_key(settings: Settings, cache: ArtifactCache, path: str, bg_key: str) -> str:
+    """Cut-out cache key to use for `path`, indexing its hash on the way.
+
+    Returns the key of an earlier near-duplicate whose cut-out is still
+    cached, so its result (and cached shadow) is reused instead of a new
+    PhotoRoom call; otherwise `bg_key` unchanged. Also applies in skip mode,
+    to duplicates that did not come through the watchers (e.g. `--paths`).
+    """
+    if settings.dedup_mode == "off":
+        return bg_key
+    index = get_duplicate_index(settings)
+    try:
+        match = index.check(path, bg_key)
+    except OSError as e:
+        print(f"Duplicate check failed for {path}: {e}", flush=True)
+        return bg_key
+    if match is None or not match.bg_key or match.bg_key == bg_key:
+        return bg_key
+    if not cache.contains("no_bg", match.bg_key):
+        print(
+            f"Near-duplicate: {path} matches {match.path} (distance {match.distance}); "
+            "its cut-out is no longer cached, removing the background again",
+            flush=True,
+        )
+        return bg_key
+    total = index.count("reused")
+    print(
+        f"Near-duplicate: {path} matches {match.path} (distance {match.distance}); "
+        f"reusing its cut-out ({total} reused so far)",
+        flush=True,
+    )
+    return match.bg_key
+
+
+def drop_duplicates(settings: Settings, paths: List[str]) -> Tuple[List[str], List[str]]:
+    """Split `paths` into (kept, skipped) for DEDUP_MODE=skip."""
+    if settings.dedup_mode != "skip":
+        return paths, []
+    index = get_duplicate_index(settings)
+    kept: List[str] = []
+    skipped: List[str] = []
+    for p in paths:
+        try:
+            match = index.check(p)
+        except OSError as e:
+            print(f"Duplicate check failed for {p}: {e}", flush=True)
+            match = None
+        if match is None:
+            kept.append(p)
+            continue
+        skipped.append(p)
+        total = index.count("skipped")
+        print(
+            f"Skipping near-duplicate {p}: matches {match.path} "
+            f"(distance {match.distance}, {total} skipped so far)",
+            flush=True,
+        )
+    return kept, skipped
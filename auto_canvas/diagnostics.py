@@ -1,10 +1,17 @@
 import os
 import json
-from fastapi import FastAPI
+from typing import List
+
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 
 from .config import load_settings
 from .gdrive import _service as gsvc
+from .jobs import JobQueueFullError, get_job_queue, wait_done
+from .metrics import render as render_metrics
+from .profiling import list_reports, profile_status, request_profile
+from .tracing import read_spans
 
 
 app = FastAPI(title="Auto Canvas Diagnostics")
@@ -28,7 +35,7 @@ def health():
         output_dir=s.output_pdf_dir,
         work_no_bg=s.work_no_bg_dir,
         work_shadow=s.work_shadow_dir,
-        state_file_exists=os.path.exists(s.state_file),
+        state_file_exists=os.path.exists(s.state_db) or os.path.exists(s.state_file),
     )
 
 
@@ -59,3 +66,72 @@ def diagnose_gdrive():
         return {"ok": False, "error": str(e)}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus metrics of every process writing to METRICS_DIR."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/traces")
+def traces(trace: str = "", limit: int = 500):
+    """Latest spans of TRACE_FILE, or all spans of one trace (batch)."""
+    return read_spans(trace, limit)
+
+
+@app.post("/profile")
+def start_profile(mode: str = "cpu", batches: int = 1):
+    """Profile the watcher's next `batches` batches (mode cpu or memory)."""
+    try:
+        return request_profile(mode, batches)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/profile")
+def profiles():
+    return {"reports": list_reports()}
+
+
+@app.get("/profile/{profile_id}")
+def profile(profile_id: str):
+    status = profile_status(profile_id)
+    if status["status"] == "unknown":
+        raise HTTPException(status_code=404, detail=f"No profile {profile_id}")
+    return status
+
+
+@app.post("/jobs", status_code=202)
+def submit_job(files: List[UploadFile] = File(...)):
+    """Queue the posted images as one job; they come back as one PDF."""
+    try:
+        job = get_job_queue().submit([(f.filename or "", f.file) for f in files])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    return job.info()
+
+
+def _job(job_id: str):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, wait: float = 0):
+    """Job status; with `wait`, long-poll up to that many seconds (max 60)
+    for the job to finish."""
+    job = _job(job_id)
+    if wait > 0:
+        await wait_done(job, wait)
+    return job.info()
+
+
+@app.get("/jobs/{job_id}/pdf")
+def job_pdf(job_id: str):
+    job = _job(job_id)
+    if job.status != "done":
+        return JSONResponse(job.info(), status_code=409)
+    return FileResponse(job.pdf, media_type="application/pdf", filename=f"{job.id}.pdf")
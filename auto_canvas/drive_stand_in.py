@@ -0,0 +1,172 @@
+import http.server
+import json
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
+
+
+def drive_client(endpoint: str):
+    """Drive v3 client for a stand-in at `endpoint`, e.g. from another process."""
+    doc = json.loads(get_static_doc("drive", "v3"))
+    doc["rootUrl"] = endpoint
+    doc["baseUrl"] = endpoint + doc["servicePath"]
+    return build_from_document(doc, http=build_http())
+
+
+class DriveStandIn:
+    """Local HTTP stand-in for the Drive v3 endpoints the watchers use, for
+    the tests and `bench drive` (the app itself never imports it).
+
+    Serves files.list, changes.getStartPageToken, changes.list, media
+    downloads and resumable uploads from an in-memory folder and change log,
+    paginated like Drive, and counts calls. Downloads and upload chunks take
+    `media_delay` seconds, like a round trip; the next `upload_faults` upload
+    chunks fail with a 503.
+    """
+
+    def __init__(self, page_size: int = 1000) -> None:
+        self.files: Dict[str, Dict] = {}
+        self.content: Dict[str, bytes] = {}
+        self.sessions: Dict[str, Dict] = {}
+        self.media_delay = 0.0
+        self.upload_faults = 0
+        self.log: List[str] = []
+        self.first_token = 0  # tokens below this are expired (410)
+        self.calls = 0
+        self.page_size = page_size
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like Drive
+
+            def _reply(self) -> None:
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                stand_in.calls += 1
+                status, answer, headers = stand_in.answer(
+                    self.command, url.path.rstrip("/"), query, self.headers, body
+                )
+                media = isinstance(answer, bytes)
+                data = answer if media else json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "image/jpeg" if media else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = _reply
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.endpoint = f"http://127.0.0.1:{self._server.server_port}/"
+
+    def service(self):
+        """Drive client talking to the stand-in (uploads included)."""
+        return drive_client(self.endpoint)
+
+    def answer(self, method: str, path: str, query: Dict[str, str], headers, body: bytes):
+        if method == "POST" and query.get("uploadType") == "resumable":
+            sid = str(len(self.sessions))
+            self.sessions[sid] = {"meta": json.loads(body or b"{}"), "data": b""}
+            location = f"{self.endpoint}upload/drive/v3/files?uploadType=resumable&upload_id={sid}"
+            return 200, {}, {"Location": location}
+        if method == "PUT":
+            return self._upload_chunk(self.sessions[query["upload_id"]], headers, body)
+        size = min(int(query.get("pageSize", 100)), self.page_size)
+        start = int(query.get("pageToken", 0))
+        if path.endswith("/changes/startPageToken"):
+            return 200, {"startPageToken": str(len(self.log))}, {}
+        if path.endswith("/changes"):
+            if start < self.first_token:
+                return 410, {"error": {"code": 410, "message": "Invalid page token"}}, {}
+            ids = self.log[start : start + size]
+            page: Dict = {"changes": [
+                {"changeType": "file", "fileId": fid, "removed": fid not in self.files,
+                 **({"file": self.files[fid]} if fid in self.files else {})}
+                for fid in ids
+            ]}
+            if start + size < len(self.log):
+                page["nextPageToken"] = str(start + size)
+            else:
+                page["newStartPageToken"] = str(len(self.log))
+            return 200, page, {}
+        if query.get("alt") == "media":
+            time.sleep(self.media_delay)
+            return 200, self.content[path.rsplit("/", 1)[1]], {}
+        if path.endswith("/files"):
+            q = query["q"]
+            folder = q.split("in parents")[0].rsplit("'", 2)[1]
+            listed = [f for f in self.files.values() if folder in f["parents"] and not f["trashed"]]
+            if "appProperties has" in q:
+                key, value = q.split("'")[1], q.split("'")[3]
+                listed = [f for f in listed if f.get("appProperties", {}).get(key) == value]
+            page = {"files": listed[start : start + size]}
+            if start + size < len(listed):
+                page["nextPageToken"] = str(start + size)
+            return 200, page, {}
+        return 404, {"error": {"code": 404, "message": path}}, {}
+
+    def _upload_chunk(self, session: Dict, headers, body: bytes):
+        time.sleep(self.media_delay)
+        if self.upload_faults > 0:
+            self.upload_faults -= 1
+            return 503, {"error": {"code": 503, "message": "Backend Error"}}, {}
+        span, total = headers["Content-Range"].split()[1].split("/")
+        if span != "*" and int(span.split("-")[0]) == len(session["data"]):
+            session["data"] += body
+        if total != "*" and len(session["data"]) == int(total):
+            meta = session["meta"]
+            fid = f"upload{len(self.files)}"
+            self.files[fid] = {
+                "id": fid, "name": meta.get("name", ""), "mimeType": "application/pdf",
+                "parents": meta.get("parents", []), "trashed": False,
+                "appProperties": meta.get("appProperties", {}),
+            }
+            self.content[fid] = session["data"]
+            self.log.append(fid)
+            return 200, {"id": fid}, {}
+        done = len(session["data"])
+        return 308, {}, ({"Range": f"bytes=0-{done - 1}"} if done else {})
+
+    def put(self, fid: str, folder: str, mime: str = "image/jpeg", trashed: bool = False) -> None:
+        stamp = f"2024-01-01T00:00:{len(self.log) % 60:02d}.000Z"
+        self.files[fid] = {
+            "id": fid, "name": f"{fid}.jpg", "mimeType": mime, "createdTime": stamp,
+            "modifiedTime": stamp, "parents": [folder], "trashed": trashed,
+        }
+        self.log.append(fid)
+
+    def delete(self, fid: str) -> None:
+        del self.files[fid]
+        self.log.append(fid)
+
+    def expected(self, folder: str) -> List[str]:
+        return sorted(
+            fid for fid, f in self.files.items()
+            if folder in f["parents"] and not f["trashed"] and f["mimeType"].startswith("image/")
+        )
+
+    def thread_service(self):
+        """Factory of one client per thread, like gdrive._service."""
+        local = threading.local()
+
+        def service():
+            if not hasattr(local, "svc"):
+                local.svc = self.service()
+            return local.svc
+
+        return service
+
+    def close(self) -> None:
+        self._server.shutdown()
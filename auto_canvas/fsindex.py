@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .utils import is_image_file, stat_signature
+
+
+_READ_EVENTS = ("opened", "closed_no_write")
+
+
+class DirectoryIndex:
+    """In-memory index of the images of one folder, kept current by watchdog.
+
+    Create, modify, move and delete events re-stat only the file concerned, so
+    a poll reads the listing, ctimes and signatures from memory instead of
+    stat-ing the whole folder. A full scan runs at start and every
+    `reconcile_seconds` to catch events the OS dropped (network drives,
+    overflowing inotify queues).
+    """
+
+    def __init__(self, directory: str, reconcile_seconds: int = 300) -> None:
+        self.directory = directory
+        self.reconcile_seconds = reconcile_seconds
+        self._files: Dict[str, os.stat_result] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._observer = None
+        self._last_reconcile = 0.0
+
+    def start(self) -> bool:
+        """Index the folder and subscribe to its events; False without watchdog."""
+        try:
+            from watchdog.observers import Observer
+        except ImportError as e:
+            print(f"watchdog unavailable ({e}); polling {self.directory}", flush=True)
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        observer = Observer()
+        observer.schedule(self._handler(), self.directory, recursive=False)
+        observer.daemon = True
+        observer.start()
+        self._observer = observer
+        # After subscribing, so files created in between are not missed
+        self.reconcile()
+        return True
+
+    def stop(self) -> None:
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def _handler(self):
+        from watchdog.events import FileSystemEventHandler
+
+        index = self
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event) -> None:
+                # Reads (the pipeline opening inputs) are not changes
+                if event.is_directory or event.event_type in _READ_EVENTS:
+                    return
+                index._refresh(event.src_path)
+                dest = getattr(event, "dest_path", "")
+                if dest:
+                    index._refresh(dest)
+
+        return _Handler()
+
+    def _refresh(self, path: str) -> None:
+        """Re-stat one file after an event (a vanished file leaves the index)."""
+        name = os.path.basename(path)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.directory):
+            return
+        if not is_image_file(name):
+            return
+        path = os.path.join(self.directory, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        with self._lock:
+            old = self._files.get(path)
+            if st is None:
+                self._files.pop(path, None)
+            else:
+                self._files[path] = st
+        if (old is None) != (st is None) or (
+            old is not None and st is not None and stat_signature(old) != stat_signature(st)
+        ):
+            self._changed.set()
+
+    def reconcile(self) -> int:
+        """Rescan the folder; returns the number of changes the events missed."""
+        found: Dict[str, os.stat_result] = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not is_image_file(entry.name):
+                    continue
+                try:
+                    if entry.is_file():
+                        found[os.path.join(self.directory, entry.name)] = entry.stat()
+                except FileNotFoundError:
+                    continue
+        with self._lock:
+            old = self._files
+            missed = len(old.keys() ^ found.keys()) + sum(
+                1 for p, st in found.items()
+                if p in old and stat_signature(old[p]) != stat_signature(st)
+            )
+            self._files = found
+        first = self._last_reconcile == 0.0
+        self._last_reconcile = time.monotonic()
+        if missed and not first:
+            print(f"Reconcile: {missed} change(s) missed by the file events", flush=True)
+            self._changed.set()
+        return missed
+
+    def maybe_reconcile(self) -> None:
+        if time.monotonic() - self._last_reconcile >= self.reconcile_seconds:
+            self.reconcile()
+
+    def paths(self) -> List[str]:
+        """Indexed images, oldest first (same order as `sort_by_ctime`)."""
+        with self._lock:
+            items = list(self._files.items())
+        items.sort(key=lambda item: item[1].st_ctime)
+        return [p for p, _ in items]
+
+    def signature(self, path: str) -> str:
+        with self._lock:
+            st = self._files.get(path)
+        return stat_signature(st) if st is not None else ""
+
+    def ctime(self, path: str) -> Optional[float]:
+        with self._lock:
+            st = self._files.get(path)
+        return st.st_ctime if st is not None else None
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep until a file event or `timeout`; True if something changed."""
+        changed = self._changed.wait(timeout)
+        self._changed.clear()
+        return changed
+
+
+def start_directory_index(directory: str, reconcile_seconds: int) -> Optional[DirectoryIndex]:
+    index = DirectoryIndex(directory, reconcile_seconds)
+    return index if index.start() else None
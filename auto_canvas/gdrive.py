@@ -1,26 +1,48 @@
 import io
+import json
 import os
+import random
+import threading
 import time
-from typing import List, Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from google.oauth2 import service_account
 import base64
 
+from . import tracing
 from .config import load_settings
+from .metrics import STAGE_SECONDS
+from .state import StateStore
 
 
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+# Per-request timeout of the Drive HTTP connections
+HTTP_TIMEOUT_SECONDS = 120
 
 
-def _service():
-    s = load_settings()
-    keyfile = os.getenv("GDRIVE_SERVICE_ACCOUNT_JSON", "").strip()
-    keyjson = os.getenv("GDRIVE_SERVICE_ACCOUNT_JSON_CONTENT", "").strip()
-    keyb64 = os.getenv("GDRIVE_SERVICE_ACCOUNT_JSON_BASE64", "").strip()
+_KEY_VARIABLES = (
+    "GDRIVE_SERVICE_ACCOUNT_JSON",
+    "GDRIVE_SERVICE_ACCOUNT_JSON_CONTENT",
+    "GDRIVE_SERVICE_ACCOUNT_JSON_BASE64",
+)
+_SOURCES: Dict[Tuple[str, ...], Tuple[str, str]] = {}
+
+
+def _credential_source() -> Tuple[str, str]:
+    """("file", path) or ("info", JSON text) of the service account key.
+
+    Resolved once per set of GDRIVE_SERVICE_ACCOUNT_* values, so Drive calls
+    do not list /etc/secrets or decode the key each time.
+    """
+    load_settings()  # applies .env (GDRIVE_* variables) on first use
+    env = tuple(os.getenv(name, "").strip() for name in _KEY_VARIABLES)
+    source = _SOURCES.get(env)
+    if source is None:
+        source = _SOURCES[env] = _resolve_source(*env)
+    return source
 
-    temp_path = None
+
+def _resolve_source(keyfile: str, keyjson: str, keyb64: str) -> Tuple[str, str]:
     # Auto-detect secret file under common paths (Render Secret Files)
     if (not keyfile) and os.path.isdir("/etc/secrets"):
         for name in os.listdir("/etc/secrets"):
@@ -28,58 +50,374 @@ def _service():
                 keyfile = os.path.join("/etc/secrets", name)
                 break
     if keyfile and os.path.exists(keyfile):
-        path_to_use = keyfile
-    elif keyjson:
-        temp_path = "/tmp/gdrive_sa.json"
-        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-        with open(temp_path, "w", encoding="utf-8") as f:
-            f.write(keyjson)
-        path_to_use = temp_path
-    elif keyb64:
-        temp_path = "/tmp/gdrive_sa.json"
-        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-        with open(temp_path, "wb") as f:
-            f.write(base64.b64decode(keyb64))
-        path_to_use = temp_path
-    else:
-        raise RuntimeError(
-            "GDRIVE_SERVICE_ACCOUNT_JSON not set or file missing; set path to secret file, or provide JSON content via GDRIVE_SERVICE_ACCOUNT_JSON_CONTENT or base64 via GDRIVE_SERVICE_ACCOUNT_JSON_BASE64."
-        )
-
-    creds = service_account.Credentials.from_service_account_file(path_to_use, scopes=SCOPES)
-    # Optionally impersonate user: subject=os.getenv("GDRIVE_IMPERSONATE_EMAIL")
-    return build("drive", "v3", credentials=creds, cache_discovery=False)
-
-
-def list_images_in_folder(folder_id: str) -> List[Dict]:
-    svc = _service()
-    query = f"'{folder_id}' in parents and trashed = false"
-    fields = "files(id, name, mimeType, modifiedTime, size)"
-    results = svc.files().list(q=query, fields=fields, pageSize=1000).execute()
-    files = results.get("files", [])
-    # Keep only images by mimeType
-    images = [f for f in files if (f.get("mimeType", "").startswith("image/"))]
-    # Sort by modifiedTime asc
+        return "file", keyfile
+    if keyjson:
+        return "info", keyjson
+    if keyb64:
+        return "info", base64.b64decode(keyb64).decode("utf-8")
+    raise RuntimeError(
+        "GDRIVE_SERVICE_ACCOUNT_JSON not set or file missing; set path to secret file, or provide JSON content via GDRIVE_SERVICE_ACCOUNT_JSON_CONTENT or base64 via GDRIVE_SERVICE_ACCOUNT_JSON_BASE64."
+    )
+
+
+_CREDENTIALS: Dict[Tuple[str, str], object] = {}
+_CREDENTIALS_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def _credentials(source: Tuple[str, str]):
+    # Imported here: the Google client libraries take a noticeable time to load
+    from google.oauth2 import service_account
+
+    with _CREDENTIALS_LOCK:
+        creds = _CREDENTIALS.get(source)
+        if creds is None:
+            kind, value = source
+            if kind == "file":
+                creds = service_account.Credentials.from_service_account_file(value, scopes=SCOPES)
+            else:
+                creds = service_account.Credentials.from_service_account_info(
+                    json.loads(value), scopes=SCOPES
+                )
+            # Optionally impersonate user: subject=os.getenv("GDRIVE_IMPERSONATE_EMAIL")
+            _CREDENTIALS[source] = creds
+        return creds
+
+
+def _service():
+    """Drive client of the calling thread, built once and then reused.
+
+    The key is read once per process; the access token it yields is shared
+    by every thread and refreshed by google-auth when it expires. Each thread
+    has its own HTTP connection pool (httplib2 is not thread-safe), kept open
+    between calls.
+    """
+    import google_auth_httplib2
+    from googleapiclient.discovery import build
+    from googleapiclient.http import build_http
+
+    source = _credential_source()
+    cached = getattr(_LOCAL, "service", None)
+    if cached is not None and cached[0] == source:
+        return cached[1]
+    # build_http keeps 308 (resumable upload progress) from being followed as a redirect
+    base = build_http()
+    base.timeout = HTTP_TIMEOUT_SECONDS
+    http = google_auth_httplib2.AuthorizedHttp(_credentials(source), http=base)
+    svc = build("drive", "v3", http=http, cache_discovery=False, static_discovery=True)
+    _LOCAL.service = (source, svc)
+    return svc
+
+
+FILE_FIELDS = "id, name, mimeType, createdTime, modifiedTime, size"
+CHANGE_FIELDS = (
+    f"nextPageToken, newStartPageToken, "
+    f"changes(changeType, fileId, removed, file({FILE_FIELDS}, parents, trashed))"
+)
+_FILE_KEYS = tuple(k.strip() for k in FILE_FIELDS.split(","))
+PAGE_SIZE = 1000
+# changes.list answers these when a stored page token is no longer valid
+_STALE_TOKEN_STATUSES = (400, 404, 410)
+
+
+def _is_image(f: Dict) -> bool:
+    return f.get("mimeType", "").startswith("image/")
+
+
+def _listing_entry(f: Dict) -> Dict:
+    return {k: f[k] for k in _FILE_KEYS if k in f}
+
+
+def _sorted_images(files: Iterable[Dict]) -> List[Dict]:
+    # Keep only images by mimeType, sorted by modifiedTime asc
+    images = [f for f in files if _is_image(f)]
     images.sort(key=lambda f: f.get("modifiedTime", ""))
     return images
 
 
-def download_file(file_id: str, dest_path: str) -> None:
-    svc = _service()
+def list_images_in_folder(folder_id: str, service=None) -> List[Dict]:
+    """Every image of the folder, following `nextPageToken` past the first page."""
+    svc = service or _service()
+    query = f"'{folder_id}' in parents and trashed = false"
+    files: List[Dict] = []
+    page_token: Optional[str] = None
+    while True:
+        results = svc.files().list(
+            q=query,
+            fields=f"nextPageToken, files({FILE_FIELDS})",
+            pageSize=PAGE_SIZE,
+            pageToken=page_token,
+        ).execute()
+        files.extend(results.get("files", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return _sorted_images(files)
+
+
+def get_start_page_token(service=None) -> str:
+    svc = service or _service()
+    return svc.changes().getStartPageToken().execute()["startPageToken"]
+
+
+def list_changes(page_token: str, service=None) -> Tuple[List[Dict], str]:
+    """Changes since `page_token`, all pages; returns them and the next start token."""
+    svc = service or _service()
+    changes: List[Dict] = []
+    while True:
+        results = svc.changes().list(
+            pageToken=page_token,
+            fields=CHANGE_FIELDS,
+            pageSize=PAGE_SIZE,
+            includeRemoved=True,
+            spaces="drive",
+        ).execute()
+        changes.extend(results.get("changes", []))
+        if "newStartPageToken" in results:
+            return changes, results["newStartPageToken"]
+        page_token = results["nextPageToken"]
+
+
+class DriveFolderFeed:
+    """Images of one Drive folder, kept current from the Changes API.
+
+    The first poll lists the folder (all pages) and saves the listing with a
+    change token in the state store; later polls, including after a restart,
+    only fetch the changes since that token, one call when nothing happened.
+    A full listing runs again when the token is rejected and every
+    `resync_seconds`, to repair anything the change feed missed.
+    """
+
+    def __init__(
+        self,
+        folder_id: str,
+        store: StateStore,
+        resync_seconds: int = 3600,
+        service: Optional[Callable[[], object]] = None,
+    ) -> None:
+        self.folder_id = folder_id
+        self.store = store
+        self.resync_seconds = resync_seconds
+        self._service = service or _service
+        self._token, self._files = store.drive_listing(folder_id)
+        # A listing saved by an earlier run is as fresh as its token
+        self._last_resync = time.monotonic() if self._token else 0.0
+
+    def images(self) -> List[Dict]:
+        """Current images of the folder, oldest modification first."""
+        from googleapiclient.errors import HttpError
+
+        svc = self._service()
+        due = self.resync_seconds > 0 and time.monotonic() - self._last_resync >= self.resync_seconds
+        if not self._token or due:
+            self.resync(svc)
+        else:
+            try:
+                self._apply_changes(svc)
+            except HttpError as e:
+                if e.resp.status not in _STALE_TOKEN_STATUSES:
+                    raise
+                print(f"Drive change token rejected ({e.resp.status}); listing the folder", flush=True)
+                self.resync(svc)
+        return _sorted_images(self._files.values())
+
+    def resync(self, svc=None) -> int:
+        """List the whole folder; returns the number of changes the feed missed."""
+        svc = svc or self._service()
+        # Token first: changes made during the listing are replayed next poll
+        token = get_start_page_token(svc)
+        files = {f["id"]: _listing_entry(f) for f in list_images_in_folder(self.folder_id, svc)}
+        missed = 0
+        if self._token:
+            missed = len(files.keys() ^ self._files.keys()) + sum(
+                1 for fid, f in files.items()
+                if fid in self._files and self._files[fid].get("modifiedTime") != f.get("modifiedTime")
+            )
+            if missed:
+                print(f"Drive resync: {missed} change(s) missed by the change feed", flush=True)
+        self.store.save_drive_listing(self.folder_id, token, files, replace=True)
+        self._token, self._files = token, files
+        self._last_resync = time.monotonic()
+        return missed
+
+    def _apply_changes(self, svc) -> None:
+        changes, token = list_changes(self._token, svc)
+        # Last change of each file wins; None means it left the folder
+        latest: Dict[str, Optional[Dict]] = {}
+        for change in changes:
+            if change.get("changeType", "file") != "file":
+                continue
+            f = change.get("file")
+            gone = (
+                change.get("removed")
+                or f is None
+                or f.get("trashed")
+                or self.folder_id not in f.get("parents", [])
+                or not _is_image(f)
+            )
+            latest[change["fileId"]] = None if gone else _listing_entry(f)
+        upserts = {fid: f for fid, f in latest.items() if f is not None}
+        removed = [fid for fid, f in latest.items() if f is None and fid in self._files]
+        if token == self._token and not upserts and not removed:
+            return
+        self.store.save_drive_listing(self.folder_id, token, upserts, removed)
+        self._files.update(upserts)
+        for fid in removed:
+            del self._files[fid]
+        self._token = token
+
+
+def download_bytes(file_id: str, chunk_mb: int = 32, service=None) -> bytes:
+    """File content, downloaded into memory in `chunk_mb` MB requests."""
+    from googleapiclient.http import MediaIoBaseDownload
+
+    svc = service or _service()
     request = svc.files().get_media(fileId=file_id)
-    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-    with open(dest_path, "wb") as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
+    buf = io.BytesIO()
+    downloader = MediaIoBaseDownload(buf, request, chunksize=max(1, chunk_mb) << 20)
+    done = False
+    while not done:
+        status, done = downloader.next_chunk()
+    return buf.getvalue()
+
+
+def download_file(file_id: str, dest_path: str, chunk_mb: int = 32, service=None) -> str:
+    """Download into memory, then write `dest_path` at once (atomically)."""
+    with STAGE_SECONDS.time(stage="download"), tracing.span("drive.download", file_id=file_id):
+        data = download_bytes(file_id, chunk_mb, service)
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    tmp = f"{dest_path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, dest_path)
+    return dest_path
+
+
+class Downloader:
+    """Concurrent Drive downloads into a staging folder.
+
+    `prefetch` starts downloads in the background (the next batch while the
+    current one is processing); `fetch` waits for a batch, starting whatever
+    was not prefetched. Each thread uses its own cached Drive client.
+    """
+
+    def __init__(
+        self,
+        staging_dir: str,
+        workers: int = 4,
+        chunk_mb: int = 32,
+        service: Optional[Callable[[], object]] = None,
+    ) -> None:
+        self.staging_dir = staging_dir
+        self.chunk_mb = chunk_mb
+        self._service = service or _service
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gdrive-dl")
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def path(self, file_id: str) -> str:
+        return os.path.join(self.staging_dir, f"gdrive_{file_id}.bin")
+
+    def prefetch(self, file_ids: Iterable[str]) -> None:
+        with self._lock:
+            for fid in file_ids:
+                current = self._futures.get(fid)
+                # Start it, or start it again after a failed attempt
+                if current is None or (current.done() and (current.cancelled() or current.exception())):
+                    self._futures[fid] = self._pool.submit(self._download, fid)
+
+    def _download(self, file_id: str) -> str:
+        return download_file(file_id, self.path(file_id), self.chunk_mb, self._service())
+
+    def fetch(self, file_ids: List[str]) -> List[str]:
+        """Local paths of the files, in order; raises if a download failed."""
+        self.prefetch(file_ids)
+        with self._lock:
+            futures = [self._futures[fid] for fid in file_ids]
+        try:
+            return [f.result() for f in futures]
+        finally:
+            # Done with these: a failed download is retried on the next fetch
+            self.discard(file_ids, remove_files=False)
+
+    def discard(self, file_ids: Iterable[str], remove_files: bool = True) -> None:
+        """Forget prefetched files (e.g. removed from Drive before processing)."""
+        with self._lock:
+            dropped = [(fid, self._futures.pop(fid)) for fid in file_ids if fid in self._futures]
+        for fid, future in dropped:
+            future.cancel()
+            if remove_files and not future.cancelled():
+                future.add_done_callback(lambda _, p=self.path(fid): _remove_quietly(p))
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Answers worth another try of the same upload chunk
+_TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def _is_transient(e: Exception) -> bool:
+    from googleapiclient.errors import HttpError
+
+    if isinstance(e, HttpError):
+        return e.resp.status in _TRANSIENT_STATUSES
+    return isinstance(e, OSError)
+
+
+def upload_file(
+    filepath: str,
+    folder_id: str,
+    mime_type: str = "application/pdf",
+    chunk_mb: int = 8,
+    retries: int = 3,
+    app_properties: Optional[Dict[str, str]] = None,
+    service=None,
+) -> str:
+    """Upload in resumable `chunk_mb` MB chunks; returns the new file id.
 
+    A chunk that fails with a 5xx/429 or a network error is retried up to
+    `retries` times with backoff, resuming the same upload session from the
+    bytes Drive acknowledged.
+    """
+    from googleapiclient.http import MediaFileUpload
 
-def upload_file(filepath: str, folder_id: str, mime_type: str = "application/pdf") -> str:
-    svc = _service()
-    file_metadata = {"name": os.path.basename(filepath), "parents": [folder_id]}
-    media = MediaFileUpload(filepath, mimetype=mime_type)
-    file = svc.files().create(body=file_metadata, media_body=media, fields="id").execute()
-    return file.get("id")
+    svc = service or _service()
+    file_metadata: Dict[str, object] = {"name": os.path.basename(filepath), "parents": [folder_id]}
+    if app_properties:
+        file_metadata["appProperties"] = app_properties
+    media = MediaFileUpload(
+        filepath, mimetype=mime_type, chunksize=max(1, chunk_mb) << 20, resumable=True
+    )
+    request = svc.files().create(body=file_metadata, media_body=media, fields="id")
+    response = None
+    failures = 0
+    while response is None:
+        try:
+            # Not next_chunk's own num_retries: it resends an already consumed
+            # stream; after a failure next_chunk first asks Drive what it kept
+            status, response = request.next_chunk()
+            failures = 0
+        except Exception as e:
+            if failures >= retries or not _is_transient(e):
+                raise
+            failures += 1
+            time.sleep(min(30.0, 2.0 ** failures) * random.uniform(0.5, 1.0))
+    return response.get("id")
 
 
+def find_by_app_property(key: str, value: str, folder_id: str, service=None) -> Optional[str]:
+    """Id of a file of the folder tagged `key`=`value` in its appProperties."""
+    svc = service or _service()
+    query = (
+        f"appProperties has {{ key='{key}' and value='{value}' }} "
+        f"and '{folder_id}' in parents and trashed = false"
+    )
+    files = svc.files().list(q=query, fields="files(id)", pageSize=1).execute().get("files", [])
+    return files[0]["id"] if files else None
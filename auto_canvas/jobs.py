@@ -0,0 +1,265 @@
+import asyncio
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from typing import BinaryIO, Deque, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from . import profiling, tracing
+from .config import Settings, load_settings
+from .metrics import BATCHES_PROCESSED, IMAGES_PROCESSED, QUEUE_DEPTH, QUEUE_SECONDS
+from .pdfgen import images_to_pdf_3x3
+from .pipeline import run_stages
+
+
+# Formats the pipeline reads, by the extension given to the saved upload
+UPLOAD_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+# Longest a status request may wait for a job to finish, and how often it checks
+MAX_WAIT_SECONDS = 60.0
+WAIT_STEP_SECONDS = 0.05
+
+
+class JobQueueFullError(RuntimeError):
+    """JOBS_QUEUE_SIZE jobs are already waiting for a worker."""
+
+
+class Job:
+    """Images posted to the API, turned into one PDF in `directory`."""
+
+    def __init__(self, job_id: str, directory: str, paths: List[str]) -> None:
+        self.id = job_id
+        self.directory = directory
+        self.paths = paths
+        self.status = "queued"
+        self.pdf = ""
+        self.error = ""
+        self.created = time.time()
+        self.started = 0.0
+        self.finished = 0.0
+        self.done = threading.Event()
+
+    def info(self) -> Dict[str, object]:
+        out: Dict[str, object] = {"id": self.id, "status": self.status, "images": len(self.paths)}
+        if self.started:
+            out["queued_seconds"] = round(self.started - self.created, 3)
+        if self.finished:
+            out["processing_seconds"] = round(self.finished - self.started, 3)
+        if self.error:
+            out["error"] = self.error
+        return out
+
+
+def _save_upload(directory: str, index: int, name: str, stream: BinaryIO) -> str:
+    """Copy one uploaded image to disk in chunks, named after the client's file
+    name and the format Pillow finds in the file."""
+    tmp = os.path.join(directory, f"{index + 1:02d}.upload")
+    with open(tmp, "wb") as f:
+        shutil.copyfileobj(stream, f)
+    try:
+        with Image.open(tmp) as img:
+            fmt = img.format
+            img.verify()
+    except Exception as e:
+        raise ValueError(f"{name or f'file {index + 1}'} is not a readable image: {e}") from e
+    ext = UPLOAD_FORMATS.get(fmt or "")
+    if ext is None:
+        raise ValueError(f"{name}: {fmt} images are not supported ({', '.join(UPLOAD_FORMATS)})")
+    stem = re.sub(r"[^\w.-]+", "_", os.path.splitext(os.path.basename(name))[0])[:60] or "image"
+    path = os.path.join(directory, f"{index + 1:02d}_{stem}{ext}")
+    os.replace(tmp, path)
+    return path
+
+
+async def wait_done(job: Job, timeout: float) -> None:
+    """Wait until the job is done or failed, at most `timeout` seconds, without
+    holding a thread (long-polls would otherwise fill the server's pool)."""
+    deadline = time.monotonic() + max(0.0, min(timeout, MAX_WAIT_SECONDS))
+    while not job.done.is_set() and time.monotonic() < deadline:
+        await asyncio.sleep(WAIT_STEP_SECONDS)
+
+
+class JobQueue:
+    """Bounded queue of API jobs, run by JOBS_WORKERS threads.
+
+    A job goes to a worker as soon as one is free, with no polling or
+    stability wait. A worker takes the oldest job and the jobs queued behind
+    it, up to BATCH_SIZE images. It runs their background and shadow stages
+    in one call, so the PhotoRoom fan-out and the cache are shared, then
+    renders one PDF per job. If such a group fails, its jobs are retried one
+    by one, so a bad image only fails its own job.
+    """
+
+    def __init__(self, settings: Settings) -> None:
+        self.settings = settings
+        self._queue: Deque[Job] = deque()
+        self._jobs: Dict[str, Job] = {}
+        self._cv = threading.Condition()
+        # Slots taken by submits still saving their files
+        self._reserved = 0
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        with self._cv:
+            if not self._threads:
+                self._threads = [
+                    threading.Thread(target=self._worker, name=f"jobs-{i}", daemon=True)
+                    for i in range(max(1, self.settings.jobs_workers))
+                ]
+                for t in self._threads:
+                    t.start()
+
+    def submit(self, files: Sequence[Tuple[str, BinaryIO]]) -> Job:
+        """Queue `(file name, binary file)` images as one job. The slot is
+        reserved before the files are read. Raises ValueError for bad input
+        and JobQueueFullError when the queue is full."""
+        s = self.settings
+        if not files:
+            raise ValueError("No image given")
+        if len(files) > s.jobs_max_images:
+            raise ValueError(f"At most {s.jobs_max_images} images per job (got {len(files)})")
+        with self._cv:
+            if len(self._queue) + self._reserved >= s.jobs_queue_size:
+                raise JobQueueFullError(f"{len(self._queue) + self._reserved} jobs already queued")
+            self._reserved += 1
+        try:
+            self.prune()
+            job_id = uuid.uuid4().hex[:16]
+            directory = os.path.join(s.jobs_dir, job_id)
+            os.makedirs(directory)
+            try:
+                paths = [_save_upload(directory, i, name, f) for i, (name, f) in enumerate(files)]
+            except BaseException:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+        except BaseException:
+            with self._cv:
+                self._reserved -= 1
+            raise
+        job = Job(job_id, directory, paths)
+        with self._cv:
+            self._reserved -= 1
+            self._jobs[job_id] = job
+            self._queue.append(job)
+            QUEUE_DEPTH.set(len(self._queue), queue="jobs", folder="api")
+            self._cv.notify()
+        self.start()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cv:
+            return self._jobs.get(job_id)
+
+    def prune(self) -> None:
+        """Forget finished jobs older than JOBS_TTL_SECONDS and delete their
+        files, also those left by an earlier process."""
+        cutoff = time.time() - self.settings.jobs_ttl_seconds
+        with self._cv:
+            expired = [
+                j for j in self._jobs.values() if j.done.is_set() and j.finished < cutoff
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+            live = set(self._jobs)
+        for job in expired:
+            shutil.rmtree(job.directory, ignore_errors=True)
+        try:
+            names = os.listdir(self.settings.jobs_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.settings.jobs_dir, name)
+            try:
+                stale = name not in live and os.path.getmtime(path) < cutoff
+            except OSError:
+                continue
+            if stale:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _next_group(self) -> List[Job]:
+        """Oldest job plus the following ones that fit in one batch."""
+        with self._cv:
+            while not self._queue:
+                self._cv.wait()
+            group = [self._queue.popleft()]
+            images = len(group[0].paths)
+            while self._queue and images + len(self._queue[0].paths) <= self.settings.batch_size:
+                images += len(self._queue[0].paths)
+                group.append(self._queue.popleft())
+            QUEUE_DEPTH.set(len(self._queue), queue="jobs", folder="api")
+        now = time.time()
+        for job in group:
+            job.status = "running"
+            job.started = now
+            for _ in job.paths:
+                QUEUE_SECONDS.observe(now - job.created)
+        return group
+
+    def _worker(self) -> None:
+        while True:
+            group = self._next_group()
+            try:
+                self._run(group)
+            except Exception as e:
+                if len(group) == 1:
+                    self._finish(group[0], error=e)
+                    continue
+                print(f"Job group of {len(group)} failed ({e}); retrying each job alone", flush=True)
+                for job in group:
+                    if job.done.is_set():
+                        continue
+                    try:
+                        self._run([job])
+                    except Exception as job_error:
+                        self._finish(job, error=job_error)
+
+    def _run(self, group: List[Job]) -> None:
+        s = self.settings
+        paths = [p for job in group for p in job.paths]
+        try:
+            with profiling.section(), tracing.span(
+                "jobs.batch", jobs=len(group), images=len(paths)
+            ):
+                arts = run_stages(s, paths, s.bg_backend, verbose=False)
+                start = 0
+                for job in group:
+                    job_arts = arts[start : start + len(job.paths)]
+                    start += len(job.paths)
+                    self._finish(job, pdf=images_to_pdf_3x3(job_arts, job.directory, settings=s))
+        finally:
+            profiling.batch_done()
+
+    def _finish(self, job: Job, pdf: str = "", error: Optional[BaseException] = None) -> None:
+        job.finished = time.time()
+        if error is None:
+            job.pdf = pdf
+            job.status = "done"
+            BATCHES_PROCESSED.inc()
+            IMAGES_PROCESSED.inc(len(job.paths))
+            print(
+                f"Job {job.id} ({len(job.paths)} images): {pdf} in "
+                f"{job.finished - job.created:.1f}s ({job.started - job.created:.1f}s queued)",
+                flush=True,
+            )
+        else:
+            job.error = str(error)
+            job.status = "failed"
+            print(f"Job {job.id} failed: {error}", flush=True)
+        job.done.set()
+
+
+_QUEUE: Optional[JobQueue] = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_job_queue(settings: Optional[Settings] = None) -> JobQueue:
+    """Process-wide job queue; its workers start with the first job."""
+    global _QUEUE
+    with _QUEUE_LOCK:
+        if _QUEUE is None:
+            _QUEUE = JobQueue(settings or load_settings())
+        return _QUEUE
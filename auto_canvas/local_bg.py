@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+from .artifact import Artifact
+from .bg import BackgroundBackend
+from .config import Settings
+from .utils import file_basename_without_ext
+
+
+# Flood fill runs on a small copy; the mask is then upsampled and feathered
+WORK_SIDE = 512
+# RGB distance range treated as "still background" around the border colour
+MIN_TOLERANCE = 28.0
+MAX_TOLERANCE = 60.0
+# Share of border pixels that must match the backdrop colour, and minimum
+# foreground share; otherwise the scene is not a plain backdrop and stays whole
+MIN_PLAIN_BORDER = 0.6
+MIN_FOREGROUND = 0.02
+
+
+def _border_pixels(rgb: "np.ndarray") -> "np.ndarray":
+    return np.concatenate([rgb[0], rgb[-1], rgb[1:-1, 0], rgb[1:-1, -1]]).astype(np.float32)
+
+
+def _flood_from_border(candidate: "np.ndarray") -> "np.ndarray":
+    """Pixels of `candidate` connected (4-neighbourhood) to the image border."""
+    reached = np.zeros_like(candidate)
+    reached[0] = candidate[0]
+    reached[-1] = candidate[-1]
+    reached[:, 0] |= candidate[:, 0]
+    reached[:, -1] |= candidate[:, -1]
+    count = int(reached.sum())
+    while True:
+        # Several dilation steps per convergence check keeps the loop cheap
+        for _ in range(8):
+            grown = reached.copy()
+            grown[1:] |= reached[:-1]
+            grown[:-1] |= reached[1:]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            reached = grown & candidate
+        new_count = int(reached.sum())
+        if new_count == count:
+            return reached
+        count = new_count
+
+
+def foreground_mask(img: Image.Image, feather: float = 1.5) -> Image.Image:
+    """Estimate an `L` alpha mask for a product shot on a plain background.
+
+    The background colour is the median of the border pixels; every pixel close
+    to it and connected to the border is background. Enclosed regions of the same
+    colour stay opaque, which suits products photographed on a table or sheet.
+    """
+    small = img.copy()
+    small.thumbnail((WORK_SIDE, WORK_SIDE), Image.BILINEAR)
+    rgb = np.asarray(small, dtype=np.float32)
+
+    border = _border_pixels(rgb)
+    bg_color = np.median(border, axis=0)
+    border_dist = np.sqrt(((border - bg_color) ** 2).sum(axis=1))
+    # Adapt to noisy or gradient backgrounds seen along the border
+    tolerance = min(MAX_TOLERANCE, max(MIN_TOLERANCE, float(np.percentile(border_dist, 95)) * 1.5))
+    if float((border_dist <= tolerance).mean()) < MIN_PLAIN_BORDER:
+        return Image.new("L", img.size, 255)
+    dist = np.sqrt(((rgb - bg_color) ** 2).sum(axis=2))
+
+    background = _flood_from_border(dist <= tolerance)
+    if 1.0 - background.mean() < MIN_FOREGROUND:
+        return Image.new("L", img.size, 255)
+    mask = Image.fromarray(np.where(background, 0, 255).astype(np.uint8), mode="L")
+    # Refine: drop isolated specks, close pinholes, then soften the edge
+    mask = mask.filter(ImageFilter.MinFilter(3)).filter(ImageFilter.MaxFilter(3))
+    mask = mask.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.MinFilter(3))
+    mask = mask.resize(img.size, Image.BILINEAR)
+    if feather > 0:
+        mask = mask.filter(ImageFilter.GaussianBlur(feather * img.width / small.width))
+    return mask
+
+
+class LocalBackend(BackgroundBackend):
+    """Offline background removal on the CPU (NumPy + Pillow), no API calls."""
+
+    name = "local"
+
+    def __init__(self, settings: Settings) -> None:
+        self.max_side = settings.preupload_max_side
+        self.concurrency = max(1, min(4, os.cpu_count() or 1))
+
+    def remove_background(self, path: str) -> Artifact:
+        with Image.open(path) as im:
+            if im.format == "JPEG" and self.max_side > 0:
+                im.draft("RGB", (self.max_side, self.max_side))
+            img = ImageOps.exif_transpose(im).convert("RGB")
+        if self.max_side > 0:
+            img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        out = img.convert("RGBA")
+        out.putalpha(foreground_mask(img))
+        return Artifact(name=file_basename_without_ext(path), image=out)
@@ -0,0 +1,441 @@
+import bisect
+import glob
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from .config import load_settings
+
+
+class Percentiles:
+    """Recent samples of one measure (seconds) and their percentiles.
+
+    Keeps the last `window` samples, so the figures follow the current load
+    rather than the whole lifetime of the process.
+    """
+
+    def __init__(self, name: str, window: int = 1000) -> None:
+        self.name = name
+        self.count = 0
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+
+    def percentiles(self, qs: Sequence[int] = (50, 90, 99)) -> Dict[int, float]:
+        """Nearest-rank percentiles of the recent samples (empty if none)."""
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return {}
+        n = len(ordered)
+        return {q: ordered[min(n - 1, max(0, -(-q * n // 100) - 1))] for q in qs}
+
+    def describe(self) -> str:
+        p = self.percentiles()
+        if not p:
+            return f"{self.name}: no samples"
+        parts = ", ".join(f"p{q} {v:.0f}s" for q, v in p.items())
+        return f"{self.name}: {parts} (last {len(self._samples)} of {self.count})"
+
+
+# Time from an image's arrival in the input folder to its batch starting
+QUEUE_TIME = Percentiles("Queue time")
+
+
+# Prometheus metrics, shared between processes.
+#
+# Each process keeps its sample values in its own memory-mapped file under
+# METRICS_DIR (`<pid>.metrics`): an update is an in-place write to the map,
+# and the diagnostics app renders /metrics by summing every file. The file of
+# an exited process (or one left under a pid now reused) is renamed `.dead`,
+# then its counters and histograms are added to `archive.metrics` and it is
+# deleted, so they keep counting while the directory stays small; its gauges
+# are dropped. Without METRICS_DIR, values stay in this process.
+
+_HEADER = 8  # int32 bytes used, padded to keep values 8-byte aligned
+_INITIAL_BYTES = 1 << 16
+_ARCHIVE = "archive.metrics"
+
+
+def _entry(key: str, value: float) -> bytes:
+    """int32 key length, key padded to a multiple of 8 with the length, float64."""
+    encoded = key.encode("utf-8")
+    padded = encoded + b" " * (-(4 + len(encoded)) % 8)
+    return struct.pack(f"<i{len(padded)}sd", len(encoded), padded, value)
+
+
+class _MmapValues:
+    def __init__(self, directory: str) -> None:
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.pid}.metrics")
+        # A file left by an earlier process with the same pid is archived
+        _retire(path)
+        self._file = open(path, "w+b")
+        self._capacity = _INITIAL_BYTES
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = _HEADER
+        struct.pack_into("<i", self._map, 0, self._used)
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _position(self, key: str) -> int:
+        pos = self._positions.get(key)
+        if pos is None:
+            entry = _entry(key, 0.0)
+            while self._used + len(entry) > self._capacity:
+                self._capacity *= 2
+                self._map.close()
+                self._file.truncate(self._capacity)
+                self._map = mmap.mmap(self._file.fileno(), self._capacity)
+            self._map[self._used : self._used + len(entry)] = entry
+            pos = self._used + len(entry) - 8
+            self._used += len(entry)
+            # Published after the entry is complete, for concurrent readers
+            struct.pack_into("<i", self._map, 0, self._used)
+            self._positions[key] = pos
+        return pos
+
+    def add(self, key: str, amount: float) -> None:
+        self.add_many(((key, amount),))
+
+    def add_many(self, amounts: Iterable[Tuple[str, float]]) -> None:
+        with self._lock:
+            for key, amount in amounts:
+                pos = self._position(key)
+                value = struct.unpack_from("<d", self._map, pos)[0] + amount
+                struct.pack_into("<d", self._map, pos, value)
+
+    def set(self, key: str, value: float) -> None:
+        with self._lock:
+            struct.pack_into("<d", self._map, self._position(key), value)
+
+    def items(self) -> List[Tuple[str, float]]:
+        with self._lock:
+            return _parse(bytes(self._map[: self._used]))
+
+
+class _LocalValues:
+    def __init__(self) -> None:
+        self.pid = os.getpid()
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, amount: float) -> None:
+        self.add_many(((key, amount),))
+
+    def add_many(self, amounts: Iterable[Tuple[str, float]]) -> None:
+        with self._lock:
+            for key, amount in amounts:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, key: str, value: float) -> None:
+        with self._lock:
+            self._values[key] = value
+
+    def items(self) -> List[Tuple[str, float]]:
+        with self._lock:
+            return list(self._values.items())
+
+
+def _parse(data: bytes) -> List[Tuple[str, float]]:
+    if len(data) < _HEADER:
+        return []
+    used = min(len(data), struct.unpack_from("<i", data, 0)[0])
+    out: List[Tuple[str, float]] = []
+    pos = _HEADER
+    while pos + 4 <= used:
+        n = struct.unpack_from("<i", data, pos)[0]
+        end = pos + 4 + n + (-(4 + n) % 8)
+        if end + 8 > used:
+            break
+        out.append((data[pos + 4 : pos + 4 + n].decode("utf-8"), struct.unpack_from("<d", data, end)[0]))
+        pos = end + 8
+    return out
+
+
+def _read(path: str) -> List[Tuple[str, float]]:
+    try:
+        with open(path, "rb") as f:
+            return _parse(f.read())
+    except OSError:
+        return []
+
+
+def _retire(path: str) -> None:
+    """Set a dead process's file aside for `_archive`; the rename lets only one
+    caller claim it."""
+    try:
+        os.replace(path, f"{path}.{time.time_ns()}.dead")
+    except FileNotFoundError:
+        pass
+
+
+_ARCHIVE_LOCK = threading.Lock()
+
+
+def _archive(directory: str) -> None:
+    """Add the counters and histograms of the `.dead` files to the archive,
+    then delete them."""
+    with _ARCHIVE_LOCK:
+        dead = glob.glob(os.path.join(directory, "*.dead"))
+        if not dead:
+            return
+        path = os.path.join(directory, _ARCHIVE)
+        totals = dict(_read(path))
+        for dead_path in dead:
+            for key, value in _read(dead_path):
+                metric = _BY_SAMPLE.get(key.split("{", 1)[0])
+                if metric is not None and metric.kind == "gauge":
+                    continue
+                totals[key] = totals.get(key, 0.0) + value
+        data = b"".join(_entry(key, value) for key, value in totals.items())
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(struct.pack("<i", _HEADER + len(data)).ljust(_HEADER, b"\0") + data)
+        os.replace(tmp, path)
+        for dead_path in dead:
+            try:
+                os.remove(dead_path)
+            except OSError:
+                pass
+
+
+_VALUES: Optional[Union[_MmapValues, _LocalValues]] = None
+_VALUES_LOCK = threading.Lock()
+
+
+def _values() -> Union[_MmapValues, _LocalValues]:
+    global _VALUES
+    values = _VALUES
+    # A forked child must not write into its parent's file
+    if values is None or values.pid != os.getpid():
+        with _VALUES_LOCK:
+            if _VALUES is None or _VALUES.pid != os.getpid():
+                directory = load_settings().metrics_dir
+                _VALUES = _MmapValues(directory) if directory else _LocalValues()
+            values = _VALUES
+    return values
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample_key(name: str, labels: Dict[str, object]) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class _Metric:
+    kind = ""
+    suffixes: Tuple[str, ...] = ("",)
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+        for suffix in self.suffixes:
+            _BY_SAMPLE[name + suffix] = self
+
+    def _labels(self, labels: Dict[str, object]) -> Dict[str, object]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return {k: labels[k] for k in self.labelnames}
+
+
+class Counter(_Metric):
+    kind = "counter"
+    suffixes = ("_total",)
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        _values().add(_sample_key(self.name + "_total", self._labels(labels)), amount)
+
+
+class Gauge(_Metric):
+    """Summed over the live processes that set it."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        _values().set(_sample_key(self.name, self._labels(labels)), value)
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+
+class Histogram(_Metric):
+    """Stored as one count per bucket; `render` makes the buckets cumulative."""
+
+    kind = "histogram"
+    suffixes = ("_bucket", "_sum", "_count")
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._keys: Dict[Tuple[object, ...], Tuple[List[str], str, str]] = {}
+
+    def _sample_keys(self, labels: Dict[str, object]) -> Tuple[List[str], str, str]:
+        ident = tuple(labels.get(k) for k in self.labelnames)
+        keys = self._keys.get(ident)
+        if keys is None:
+            labels = self._labels(labels)
+            keys = self._keys[ident] = (
+                [
+                    _sample_key(self.name + "_bucket", {**labels, "le": _le(bound)})
+                    for bound in self.buckets
+                ],
+                _sample_key(self.name + "_sum", labels),
+                _sample_key(self.name + "_count", labels),
+            )
+        return keys
+
+    def observe(self, value: float, **labels: object) -> None:
+        buckets, sum_key, count_key = self._sample_keys(labels)
+        bucket = buckets[bisect.bisect_left(self.buckets, value)]
+        _values().add_many(((bucket, 1.0), (sum_key, value), (count_key, 1.0)))
+
+    @contextmanager
+    def time(self, **labels: object) -> Iterator[None]:
+        """Observe the duration of the block, in seconds (also when it raises)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+
+def _le(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else f"{bound:g}"
+
+
+_REGISTRY: List[_Metric] = []
+_BY_SAMPLE: Dict[str, _Metric] = {}
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect(directory: Optional[str] = None) -> Dict[str, float]:
+    """Stored sample values summed over the processes writing to `directory`
+    (default METRICS_DIR; this process only when it is unset)."""
+    directory = load_settings().metrics_dir if directory is None else directory
+    if not directory:
+        return dict(_values().items())
+    totals: Dict[str, float] = {}
+    files = [os.path.join(directory, _ARCHIVE)]
+    for path in glob.glob(os.path.join(directory, "*.metrics")):
+        try:
+            pid = int(os.path.basename(path).split(".")[0])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _alive(pid):
+            files.append(path)
+        else:
+            _retire(path)
+    _archive(directory)
+    for path in files:
+        for key, value in _read(path):
+            if key.split("{", 1)[0] in _BY_SAMPLE:
+                totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _histogram_lines(metric: Histogram, samples: Dict[str, float], keys: List[str]) -> List[str]:
+    series: Dict[Tuple[Tuple[str, str], ...], Dict[str, float]] = {}
+    for key in keys:
+        name, _, rest = key.partition("{")
+        labels = _LABEL_RE.findall(rest)
+        le = ""
+        if name.endswith("_bucket"):
+            le = dict(labels).pop("le")
+            labels = [kv for kv in labels if kv[0] != "le"]
+        field = le or name[len(metric.name) + 1 :]
+        series.setdefault(tuple(labels), {})[field] = samples[key]
+    lines: List[str] = []
+    for labels, fields in sorted(series.items()):
+        base = dict(labels)
+        running = 0.0
+        for bound in metric.buckets:
+            running += fields.get(_le(bound), 0.0)
+            lines.append(f"{_sample_key(metric.name + '_bucket', {**base, 'le': _le(bound)})} {running:.17g}")
+        for field in ("sum", "count"):
+            value = fields.get(field, 0.0)
+            lines.append(f"{_sample_key(f'{metric.name}_{field}', base)} {value:.17g}")
+    return lines
+
+
+def render(directory: Optional[str] = None) -> str:
+    """Every registered metric in the Prometheus text format (version 0.0.4)."""
+    samples = collect(directory)
+    by_metric: Dict[str, List[str]] = {}
+    for key in samples:
+        by_metric.setdefault(_BY_SAMPLE[key.split("{", 1)[0]].name, []).append(key)
+    lines: List[str] = []
+    for metric in _REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        keys = by_metric.get(metric.name, [])
+        if isinstance(metric, Histogram):
+            lines.extend(_histogram_lines(metric, samples, keys))
+        else:
+            lines.extend(f"{key} {samples[key]:.17g}" for key in sorted(keys))
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "auto_canvas_stage_seconds",
+    "Duration of one unit of work per stage: bg and shadow per image, pdf per "
+    "batch, download and upload per file.",
+    ["stage"],
+)
+QUEUE_SECONDS = Histogram(
+    "auto_canvas_queue_seconds",
+    "Time from an image's arrival in its input folder to its batch starting.",
+)
+IMAGES_PROCESSED = Counter("auto_canvas_images_processed", "Images laid out in a finished PDF.")
+BATCHES_PROCESSED = Counter("auto_canvas_batches_processed", "Batches turned into a PDF.")
+QUEUE_DEPTH = Gauge(
+    "auto_canvas_queue_depth",
+    "Work waiting, by queue: images (not yet in a batch) and uploads (Drive "
+    "uploads pending) per watched folder, jobs (API jobs queued, folder api).",
+    ["queue", "folder"],
+)
+PHOTOROOM_REQUESTS = Counter(
+    "auto_canvas_photoroom_requests",
+    "PhotoRoom calls by outcome: ok, throttled (429), quota (402), error (other "
+    "status) or network.",
+    ["outcome"],
+)
+CACHE_REQUESTS = Counter(
+    "auto_canvas_cache_requests",
+    "Artifact cache lookups by stage and result (hit or miss).",
+    ["stage", "result"],
+)
@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from .config import Settings, install_reload_signal, load_settings, reload_if_env_changed
+from .state import get_state_store
+from .watch import IDLE_WAKE_SECONDS, FolderWatcher
+from .watch_gdrive import DriveFolderWatcher
+
+
+FOLDER_TYPES = ("local", "drive")
+# Batches a folder may have waiting for a worker; the rest stay pending in
+# the folder, so stability and deadlines are judged when a worker frees up
+MAX_QUEUED_PER_FOLDER = 2
+
+
+@dataclass(frozen=True)
+class FolderSpec:
+    """One watched input folder and where its PDFs go.
+
+    `input`/`output` are local paths, or Drive folder ids when `type` is
+    "drive". `weight` is the folder's share of the workers when several
+    folders have work.
+    """
+
+    name: str
+    input: str
+    output: str
+    type: str = "local"
+    weight: float = 1.0
+
+
+def load_folder_specs(raw: str) -> List[FolderSpec]:
+    """Parse WATCH_FOLDERS: a JSON list, or the path of a JSON file holding one."""
+    if not raw:
+        raise RuntimeError("WATCH_FOLDERS is not set")
+    if not raw.lstrip().startswith("["):
+        with open(raw, "r", encoding="utf-8") as f:
+            raw = f.read()
+    specs: List[FolderSpec] = []
+    for entry in json.loads(raw):
+        try:
+            spec = FolderSpec(
+                name=str(entry["name"]),
+                input=str(entry["input"]),
+                output=str(entry["output"]),
+                type=str(entry.get("type", "local")).lower(),
+                weight=float(entry.get("weight", 1.0)),
+            )
+        except KeyError as e:
+            raise RuntimeError(f"WATCH_FOLDERS entry {entry!r} is missing {e}") from e
+        if spec.type not in FOLDER_TYPES:
+            raise RuntimeError(f"Folder {spec.name!r}: type must be one of {FOLDER_TYPES}")
+        if spec.weight <= 0:
+            raise RuntimeError(f"Folder {spec.name!r}: weight must be positive")
+        specs.append(spec)
+    names = [s.name for s in specs]
+    if len(set(names)) != len(names):
+        raise RuntimeError("WATCH_FOLDERS names must be unique")
+    if not specs:
+        raise RuntimeError("WATCH_FOLDERS is empty")
+    return specs
+
+
+def folder_settings(base: Settings, spec: FolderSpec) -> Settings:
+    """`base` with the folder's own directories and state database."""
+    root = os.path.splitext(base.state_db)[0]
+    changes = {
+        "state_db": f"{root}.{spec.name}.db",
+        # The shared legacy .state.json is not migrated into every folder
+        "state_file": f"{root}.{spec.name}.json",
+    }
+    if spec.type == "local":
+        changes.update(input_dir=spec.input, output_pdf_dir=spec.output)
+    else:
+        # Drive batches are staged and rendered locally, then uploaded
+        changes.update(
+            input_dir=os.path.join(base.input_dir, spec.name),
+            output_pdf_dir=os.path.join(base.output_pdf_dir, spec.name),
+        )
+    s = replace(base, **changes)
+    for path in (s.input_dir, s.output_pdf_dir):
+        os.makedirs(path, exist_ok=True)
+    return s
+
+
+Watcher = Union[FolderWatcher, DriveFolderWatcher]
+
+
+def make_watcher(base: Settings, spec: FolderSpec) -> Watcher:
+    s = folder_settings(base, spec)
+    if spec.type == "local":
+        return FolderWatcher(s, name=spec.name)
+    return DriveFolderWatcher(s, spec.input, spec.output, name=spec.name)
+
+
+class FairScheduler:
+    """Worker threads shared by several folders, with start-time fair queuing.
+
+    Each batch gets a start tag max(virtual time, folder's previous finish
+    tag) and a finish tag start + images / weight; workers always take the
+    smallest start tag. Busy folders therefore get worker time in proportion
+    to their weight, a folder with a large backlog cannot starve the others,
+    and a folder that was idle does not bank credit for later.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self._heap: List[Tuple[float, int, str, float, Callable[[], object], Future]] = []
+        self._cv = threading.Condition()
+        self._vtime = 0.0
+        self._finish: Dict[str, float] = {}
+        self._queued: Dict[str, int] = {}
+        self.served: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"watch-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(
+        self, folder: str, weight: float, cost: int, fn: Callable[..., object], *args
+    ) -> Future:
+        fut: Future = Future()
+        with self._cv:
+            if self._closed:
+                raise RuntimeError("Scheduler is closed")
+            start = max(self._vtime, self._finish.get(folder, 0.0))
+            self._finish[folder] = start + max(1, cost) / weight
+            self._queued[folder] = self._queued.get(folder, 0) + 1
+            heapq.heappush(
+                self._heap, (start, next(self._seq), folder, float(cost), partial(fn, *args), fut)
+            )
+            self._cv.notify()
+        return fut
+
+    def queued(self, folder: str) -> int:
+        """Batches of `folder` waiting for a worker."""
+        with self._cv:
+            return self._queued.get(folder, 0)
+
+    def close(self) -> None:
+        """Run what is queued, then stop the workers."""
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def _worker(self) -> None:
+        while True:
+            with self._cv:
+                while not self._heap and not self._closed:
+                    self._cv.wait()
+                if not self._heap:
+                    return
+                start, _, folder, cost, fn, fut = heapq.heappop(self._heap)
+                self._vtime = max(self._vtime, start)
+                self._queued[folder] -= 1
+                self.served[folder] = self.served.get(folder, 0) + int(cost)
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn())
+            except BaseException as e:
+                fut.set_exception(e)
+
+
+def _batch_done(watcher: Watcher, batch: List[str], fut: Future) -> None:
+    watcher.release(batch)
+    err = fut.exception()
+    if err is not None:
+        watcher.log(f"Pipeline error: {err}")
+    elif fut.result():
+        watcher.log(f"Done: {fut.result()}")
+
+
+def _folder_loop(
+    spec: FolderSpec, watcher: Watcher, scheduler: FairScheduler, stop: threading.Event
+) -> None:
+    while not stop.is_set():
+        try:
+            room = MAX_QUEUED_PER_FOLDER - scheduler.queued(spec.name)
+            batches, wait_s = watcher.poll(max_batches=max(0, room))
+            for batch in batches:
+                watcher.log(f"Batch ready ({len(batch)} images). Queued for a worker...")
+                fut = scheduler.submit(spec.name, spec.weight, len(batch), watcher.run_batch, batch)
+                fut.add_done_callback(partial(_batch_done, watcher, batch))
+            watcher.wait(wait_s)
+        except Exception as e:
+            watcher.log(f"Error in watcher: {e}")
+            stop.wait(watcher.settings.poll_interval_seconds)
+
+
+def run_multi_watcher(raw_specs: Optional[str] = None) -> None:
+    """Watch every WATCH_FOLDERS entry from one process.
+
+    Batches of all folders run on WATCH_WORKERS shared threads and draw on
+    this process's single PhotoRoom client (one rate budget and concurrency
+    limit); each folder keeps its own state database and output.
+    """
+    settings = load_settings()
+    specs = load_folder_specs(raw_specs or settings.watch_folders)
+    scheduler = FairScheduler(settings.watch_workers)
+    watchers = [(spec, make_watcher(settings, spec)) for spec in specs]
+    print(
+        f"Watching {len(specs)} folder(s) with {max(1, settings.watch_workers)} worker(s): "
+        + ", ".join(f"{s.name} ({s.type}, weight {s.weight:g})" for s in specs),
+        flush=True,
+    )
+    install_reload_signal()
+    for spec, watcher in watchers:
+        interrupted = get_state_store(watcher.settings).clear_inflight()
+        if interrupted:
+            watcher.log(f"{interrupted} batch(es) interrupted by the last stop will be redone")
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_folder_loop, args=(spec, watcher, scheduler, stop),
+            name=f"watch-{spec.name}", daemon=True,
+        )
+        for spec, watcher in watchers
+    ]
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            time.sleep(IDLE_WAKE_SECONDS)
+            # .env edits and SIGHUP both replace the settings snapshot
+            if reload_if_env_changed() or load_settings() is not settings:
+                settings = load_settings()
+                for spec, watcher in watchers:
+                    watcher.update_settings(folder_settings(settings, spec))
+    except KeyboardInterrupt:
+        print("Stopped by user.", flush=True)
+        stop.set()
+        scheduler.close()
+        for _, watcher in watchers:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    run_multi_watcher()
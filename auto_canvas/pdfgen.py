@@ -1,14 +1,27 @@
+import io
 import os
+import threading
 import time
-from typing import List
-import pdfkit
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.pdfgen import canvas
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from PIL import Image
 
-from .config import load_settings
-from .utils import chunk
+from . import tracing
+from .artifact import Artifact
+from .config import Settings, load_settings
+from .metrics import STAGE_SECONDS
+from .utils import chunk, unique_output_paths
 
+if TYPE_CHECKING:
+    from reportlab.pdfgen.canvas import Canvas
+
+
+PDF_RENDERERS = ("reportlab", "wkhtmltopdf")
+# Points per millimetre (reportlab.lib.units.mm, without importing ReportLab)
+MM = 72 / 25.4
+# Largest printed size of one image (matches the CSS below) and page colour
+MAX_IMG_W = 55 * MM
+MAX_IMG_H = 80 * MM
+PAGE_BACKGROUND = (255, 255, 255)
 
 CSS = """
 @page { size: A4; }
@@ -20,10 +33,31 @@ img { max-width: 55mm; max-height: 80mm; width: auto; height: auto; display: inl
 .page:last-child { page-break-after: auto; }
 """
 
+_WK_CONFIGS: Dict[str, object] = {}
+_WK_LOCK = threading.Lock()
+
+
+def _wk_config(binary: str):
+    """pdfkit configuration for `binary`, or None if it is missing.
 
-def _wk_config():
-    settings = load_settings()
-    return pdfkit.configuration(wkhtmltopdf=settings.wkhtmltopdf_path)
+    Resolved once per process (per path), not on every batch.
+    """
+    with _WK_LOCK:
+        if binary not in _WK_CONFIGS:
+            try:
+                import pdfkit
+
+                _WK_CONFIGS[binary] = pdfkit.configuration(wkhtmltopdf=binary)
+            except (ImportError, OSError) as e:
+                reason = str(e).splitlines()[0] if str(e) else type(e).__name__
+                print(f"wkhtmltopdf unavailable ({reason}); PDFs use reportlab", flush=True)
+                _WK_CONFIGS[binary] = None
+        return _WK_CONFIGS[binary]
+
+
+def wkhtmltopdf_available(settings: Optional[Settings] = None) -> bool:
+    s = settings or load_settings()
+    return _wk_config(s.wkhtmltopdf_path) is not None
 
 
 def _to_file_uri(path: str) -> str:
@@ -31,24 +65,137 @@ def _to_file_uri(path: str) -> str:
     return "file:///" + abs_path.replace("\\", "/")
 
 
-def images_to_pdf_3x3(images: List[str], output_pdf_dir: str | None = None) -> str:
-    settings = load_settings()
-    if output_pdf_dir is None:
-        output_pdf_dir = settings.output_pdf_dir
-    os.makedirs(output_pdf_dir, exist_ok=True)
+def _is_jpeg(data: Optional[bytes]) -> bool:
+    return data is not None and data[:2] == b"\xff\xd8"
 
-    # Try html->wkhtmltopdf first; fallback to reportlab if wkhtmltopdf not present
-    ts = time.strftime("%Y%m%d_%H%M%S")
-    out_path = os.path.join(output_pdf_dir, f"canvas_{ts}.pdf")
-    try:
-        _ = _wk_config()  # may raise if binary missing
+
+def _ensure_files(images: List[Artifact], out_dir: str, compress_level: int) -> List[str]:
+    """wkhtmltopdf reads images from disk: write the in-memory ones to `out_dir`.
+
+    The artifacts keep no reference to these files, which only live as long
+    as the render.
+    """
+    paths: List[str] = []
+    for art in images:
+        if art.path is not None:
+            paths.append(art.path)
+            continue
+        data = art.encoded(compress_level)
+        ext = ".jpg" if _is_jpeg(data) else ".png"
+        path = unique_output_paths([art.name], out_dir, ext=ext)[0]
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def _draw_size(iw: int, ih: int) -> Tuple[float, float]:
+    """Printed size in points: fit in MAX_IMG_W x MAX_IMG_H, keeping the ratio."""
+    scale = min(MAX_IMG_W / iw, MAX_IMG_H / ih)
+    return iw * scale, ih * scale
+
+
+def optimize_for_embed(art: Artifact, dpi: int, quality: int) -> Artifact:
+    """Resample to `dpi` at the printed size and flatten onto the page as JPEG.
+
+    Cells never overlap and the page is plain PAGE_BACKGROUND, so compositing
+    the alpha here looks the same as a PDF soft mask; only fully opaque
+    pixels are left, and no SMask is embedded.
+    """
+    img = art.open()
+    draw_w, draw_h = _draw_size(*img.size)
+    target = (round(draw_w / 72 * dpi), round(draw_h / 72 * dpi))
+    if target[0] < img.width:
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        flat = Image.new("RGB", img.size, PAGE_BACKGROUND)
+        flat.paste(img, mask=img.getchannel("A"))
+        img = flat
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return Artifact(name=art.name, data=buf.getvalue())
+
+
+def _lossless_size(art: Artifact) -> Optional[int]:
+    """What embedding the image unchanged costs: its encoded bytes or file, or
+    None for a decoded image (never encoded just to log)."""
+    if art.data is not None:
+        return len(art.data)
+    if art.path is not None:
+        return os.path.getsize(art.path)
+    return None
+
+
+def _human_size(n: int) -> str:
+    if abs(n) >= 1024 * 1024:
+        return f"{n / (1024 * 1024):.1f} MB"
+    return f"{n / 1024:.0f} KB"
+
+
+def draw_page_3x3(c: "Canvas", page_images: Sequence[Artifact]) -> None:
+    """Draw up to 9 images as one A4 page of `c` and finish the page."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+
+    page_w, page_h = A4
+    margin = 10 * MM
+    cols, rows = 3, 3
+    cell_w = (page_w - 2 * margin) / cols
+    cell_h = (page_h - 2 * margin) / rows
+
+    for idx, art in enumerate(page_images):
+        col = idx % cols
+        row = idx // cols
+        x = margin + col * cell_w
+        # ReportLab origin bottom-left
+        y = page_h - margin - (row + 1) * cell_h
+
+        # Compute image size preserving ratio. JPEGs (see optimize_for_embed)
+        # are embedded as-is; anything else is decoded once and drawn.
+        if _is_jpeg(art.data):
+            src = ImageReader(io.BytesIO(art.data))  # type: ignore[arg-type]
+        else:
+            src = ImageReader(art.open())
+        draw_w, draw_h = _draw_size(*src.getSize())
+        # Center in cell
+        dx = x + (cell_w - draw_w) / 2
+        dy = y + (cell_h - draw_h) / 2
+        c.drawImage(src, dx, dy, width=draw_w, height=draw_h, preserveAspectRatio=True, mask='auto')
+    c.showPage()
+
+
+def render_pdf_reportlab(images: List[Artifact], out_path: str, settings: Settings) -> None:
+    """In-process 3x3 grid on A4; each image is decoded once and drawn directly."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen.canvas import Canvas
+
+    c = Canvas(out_path, pagesize=A4)
+    for page_images in chunk(images, 9):
+        draw_page_3x3(c, page_images)
+    c.save()
+
+
+def render_pdf_wkhtmltopdf(images: List[Artifact], out_path: str, settings: Settings) -> None:
+    """HTML table rendered by the wkhtmltopdf binary (opt-in, needs files on disk)."""
+    import tempfile
+
+    import pdfkit
+
+    config = _wk_config(settings.wkhtmltopdf_path)
+    if config is None:
+        raise RuntimeError(f"wkhtmltopdf not found at {settings.wkhtmltopdf_path}")
+    with tempfile.TemporaryDirectory(prefix="auto_canvas_pdf_") as tmp:
+        paths = _ensure_files(images, tmp, settings.png_compress_level)
         # Build HTML with 9 images per page
         html_parts: List[str] = [
             "<html><head><meta charset='utf-8'><style>",
             CSS,
             "</style></head><body>",
         ]
-        for page_images in chunk(images, 9):
+        for page_images in chunk(paths, 9):
             html_parts.append("<div class='page'><table>")
             for row_start in range(0, len(page_images), 3):
                 row = page_images[row_start : row_start + 3]
@@ -70,43 +217,96 @@ def images_to_pdf_3x3(images: List[str], output_pdf_dir: str | None = None) -> s
             "margin-bottom": "10mm",
             "margin-left": "10mm",
         }
-        pdfkit.from_string(html, out_path, configuration=_wk_config(), options=options)
-        return out_path
-    except Exception:
-        pass
+        pdfkit.from_string(html, out_path, configuration=config, options=options)
 
-    # Fallback ReportLab 3x3 grid
-    page_w, page_h = A4
-    margin = 10 * mm
-    cols, rows = 3, 3
-    cell_w = (page_w - 2 * margin) / cols
-    cell_h = (page_h - 2 * margin) / rows
-    max_img_w = 55 * mm
-    max_img_h = 80 * mm
 
-    c = canvas.Canvas(out_path, pagesize=A4)
-    from PIL import Image
+PdfRenderer = Callable[[List[Artifact], str, Settings], None]
 
-    for page_images in chunk(images, 9):
-        for idx, img_path in enumerate(page_images):
-            col = idx % cols
-            row = idx // cols
-            x = margin + col * cell_w
-            # ReportLab origin bottom-left
-            y = page_h - margin - (row + 1) * cell_h
-
-            # Compute image size preserving ratio
-            with Image.open(img_path) as im:
-                iw, ih = im.size
-            scale = min(max_img_w / iw, max_img_h / ih)
-            draw_w = iw * scale
-            draw_h = ih * scale
-            # Center in cell
-            dx = x + (cell_w - draw_w) / 2
-            dy = y + (cell_h - draw_h) / 2
-            c.drawImage(img_path, dx, dy, width=draw_w, height=draw_h, preserveAspectRatio=True, mask='auto')
-        c.showPage()
-    c.save()
+_RENDERERS: Dict[str, PdfRenderer] = {
+    "reportlab": render_pdf_reportlab,
+    "wkhtmltopdf": render_pdf_wkhtmltopdf,
+}
+
+
+def images_to_pdf_3x3(
+    images: Sequence[Union[str, Artifact]],
+    output_pdf_dir: str | None = None,
+    renderer: Optional[str] = None,
+    settings: Optional[Settings] = None,
+) -> str:
+    """Lay the images out 9 per A4 page with PDF_RENDERER (default reportlab).
+
+    wkhtmltopdf is opt-in; if its binary is missing or it fails, the batch is
+    rendered with reportlab instead and the reason is logged. With PDF_DPI > 0,
+    images are first resampled to that resolution and flattened to JPEG
+    (PDF_JPEG_QUALITY), and the bytes saved are logged. `settings` defaults
+    to the process-wide snapshot (a watched folder passes its own).
+    """
+    settings = settings or load_settings()
+    name = renderer or settings.pdf_renderer
+    if name not in _RENDERERS:
+        raise ValueError(f"Unknown PDF renderer {name!r}; expected one of {PDF_RENDERERS}")
+    images = [a if isinstance(a, Artifact) else Artifact.from_path(a) for a in images]
+    if output_pdf_dir is None:
+        output_pdf_dir = settings.output_pdf_dir
+    os.makedirs(output_pdf_dir, exist_ok=True)
+
+    ts = time.strftime("%Y%m%d_%H%M%S")
+    out_path = os.path.join(output_pdf_dir, f"canvas_{ts}.pdf")
+    n = 1
+    while True:
+        # Reserve the name: batches can finish within the same second, also
+        # on parallel workers writing to the same folder
+        try:
+            with open(out_path, "x"):
+                break
+        except FileExistsError:
+            n += 1
+            out_path = os.path.join(output_pdf_dir, f"canvas_{ts}_{n}.pdf")
+    lossless: Optional[int] = None
+    embedded = 0
+    t0 = time.perf_counter()
+    try:
+        with tracing.span("pdf", renderer=name, images=len(images)):
+            if settings.pdf_dpi > 0:
+                with tracing.span("pdf.optimize", dpi=settings.pdf_dpi):
+                    sizes = [_lossless_size(a) for a in images]
+                    if None not in sizes:
+                        lossless = sum(sizes)  # type: ignore[arg-type]
+                    images = [
+                        optimize_for_embed(a, settings.pdf_dpi, settings.pdf_jpeg_quality)
+                        for a in images
+                    ]
+                    embedded = sum(len(a.data) for a in images)  # type: ignore[arg-type]
+            _render(name, images, out_path, settings)
+    except BaseException:
+        os.remove(out_path)
+        raise
+    STAGE_SECONDS.observe(time.perf_counter() - t0, stage="pdf")
+    if settings.pdf_dpi > 0:
+        # Savings only when every original size is known
+        compared = (
+            f" instead of {_human_size(lossless)} ({_human_size(lossless - embedded)} saved)"
+            if lossless is not None
+            else ""
+        )
+        print(
+            f"PDF {os.path.basename(out_path)}: {_human_size(os.path.getsize(out_path))}, "
+            f"images {_human_size(embedded)} at {settings.pdf_dpi} dpi{compared}",
+            flush=True,
+        )
     return out_path
 
 
+def _render(name: str, images: List[Artifact], out_path: str, settings: Settings) -> None:
+    if name == "wkhtmltopdf":
+        if wkhtmltopdf_available(settings):
+            try:
+                with tracing.span("pdf.wkhtmltopdf"):
+                    render_pdf_wkhtmltopdf(images, out_path, settings)
+                return
+            except Exception as e:
+                print(f"wkhtmltopdf failed ({e}); using reportlab", flush=True)
+        name = "reportlab"
+    with tracing.span(f"pdf.{name}"):
+        _RENDERERS[name](images, out_path, settings)
@@ -2,62 +2,191 @@ from __future__ import annotations
 
 import argparse
 import os
-from typing import List
-
-from .config import load_settings
-from .utils import load_state, save_state, file_signature
-from .bg import remove_background_batch
-from .shadow import add_shadow_batch
+import time
+from functools import partial
+from typing import Callable, List, Optional, Sequence, Union
+
+from . import profiling, tracing
+from .artifact import Artifact
+from .config import Settings, load_settings
+from .bg import BACKENDS, remove_background_batch
+from .cache import ArtifactCache, file_digest, get_cache
+from .dedup import reuse_key
+from .metrics import BATCHES_PROCESSED, IMAGES_PROCESSED
+from .state import get_state_store
+from .shadow import MAX_SIDE, SHADOW_BLUR_RADIUS, SHADOW_OFFSET, add_shadow_batch
 from .pdfgen import images_to_pdf_3x3
+from .utils import StabilityTracker, list_image_files, sort_by_ctime
+
+
+def _fill_missing(
+    cache: ArtifactCache,
+    stage: str,
+    outputs: List[Optional[Artifact]],
+    keys: List[Optional[str]],
+    inputs: Sequence[Union[str, Artifact]],
+    run: Callable[..., List[Artifact]],
+) -> List[int]:
+    """Run `run` on the inputs whose output slot is still empty, caching each result.
+
+    Results the stage did not report through `on_result` (background fallback)
+    or that have no key are used as-is but left out of the cache; their indices
+    are returned.
+    """
+    missing = [i for i, out in enumerate(outputs) if out is None]
+    if not missing:
+        return []
+
+    def _store(pos: int, art: Artifact) -> None:
+        # Cache each result as soon as it exists so a failed batch keeps it
+        idx = missing[pos]
+        key = keys[idx]
+        outputs[idx] = cache.put(stage, key, art) if key else art
+
+    produced = run([inputs[i] for i in missing], on_result=_store)
+    uncached: List[int] = []
+    for i, art in zip(missing, produced):
+        if outputs[i] is None or not keys[i]:
+            outputs[i] = art
+            uncached.append(i)
+    return uncached
+
+
+def bg_cache_key(cache: ArtifactCache, settings: Settings, path: str, backend: str) -> str:
+    """Cut-out key from the file bytes, or a near-duplicate's key (DEDUP_MODE=reuse)."""
+    key = cache.key(
+        "no_bg",
+        file_digest(path),
+        backend=backend,
+        preupload_max_side=settings.preupload_max_side,
+        preupload_quality=settings.preupload_quality,
+    )
+    return reuse_key(settings, cache, path, key)
 
 
-def process_batch(input_images: List[str]) -> str:
-    """Process a batch of images end-to-end and return output PDF path."""
-    settings = load_settings()
+def shadow_cache_key(cache: ArtifactCache, settings: Settings, bg_key: str) -> str:
+    return cache.key(
+        "shadow",
+        bg_key,
+        offset=list(SHADOW_OFFSET),
+        blur_radius=SHADOW_BLUR_RADIUS,
+        max_side=MAX_SIDE,
+        engine=settings.shadow_engine,
+    )
+
 
-    # Track processing in state to avoid duplicates on restart
-    state = load_state(settings.state_file)
-    processing_set = set(state.get("processing", []))
-    processed_set = set(state.get("processed", []))
-
-    # Mark as processing
-    for p in input_images:
-        if p not in processing_set and p not in processed_set:
-            processing_set.add(p)
-    state["processing"] = sorted(processing_set)
-    save_state(settings.state_file, state)
-
-    # Steps
-    no_bg = remove_background_batch(input_images)
-    with_shadow = add_shadow_batch(no_bg)
-    pdf_path = images_to_pdf_3x3(with_shadow)
-
-    # Mark processed
-    for p in input_images:
-        processed_set.add(p)
-        processing_set.discard(p)
-        sig = file_signature(p)
-        state.setdefault("processed_signatures", {})[p] = sig
-    state["processing"] = sorted(processing_set)
-    state["processed"] = sorted(processed_set)
-    save_state(settings.state_file, state)
+def _bg_and_shadow_cached(
+    cache: ArtifactCache, settings: Settings, input_images: List[str], backend: str
+) -> List[Artifact]:
+    bg_keys = [bg_cache_key(cache, settings, p, backend) for p in input_images]
+    shadow_keys = [shadow_cache_key(cache, settings, k) for k in bg_keys]
+    outputs = [cache.get("shadow", k) for k in shadow_keys]
+    todo = [i for i, out in enumerate(outputs) if out is None]
+    if todo:
+        # A cached shadow makes the no_bg result unnecessary for that image
+        no_bg = [cache.get("no_bg", bg_keys[i]) for i in todo]
+        with tracing.span("bg", images=sum(1 for a in no_bg if a is None), backend=backend):
+            fell_back = _fill_missing(
+                cache,
+                "no_bg",
+                no_bg,
+                [bg_keys[i] for i in todo],
+                [input_images[i] for i in todo],
+                partial(remove_background_batch, backend=backend),
+            )
+        todo_shadow_keys: List[Optional[str]] = [shadow_keys[i] for i in todo]
+        for pos in fell_back:
+            # Shadows of fallback cut-outs must not stand in for the real backend
+            todo_shadow_keys[pos] = None
+        shadowed: List[Optional[Artifact]] = [None] * len(todo)
+        with tracing.span("shadow", images=len(todo)):
+            _fill_missing(
+                cache,
+                "shadow",
+                shadowed,
+                todo_shadow_keys,
+                no_bg,  # type: ignore[arg-type]
+                # Encode in the workers: the cache stores PNG bytes
+                partial(add_shadow_batch, encode=True),
+            )
+        for i, out in zip(todo, shadowed):
+            outputs[i] = out
+    return outputs  # type: ignore[return-value]
+
+
+def run_stages(
+    settings: Settings, input_images: List[str], backend: str, verbose: bool = True
+) -> List[Artifact]:
+    """Background removal then shadow, one in-memory artifact per input.
+
+    Steps hand images over in memory; stages whose output is already cached
+    are skipped.
+    """
+    cache = get_cache(settings)
+    if cache is None:
+        with tracing.span("bg", images=len(input_images), backend=backend):
+            no_bg = remove_background_batch(input_images, backend=backend)
+        with tracing.span("shadow", images=len(no_bg)):
+            return add_shadow_batch(no_bg)
+    # Cache lookups plus the bg and shadow spans of what was not cached
+    with tracing.span("stages", images=len(input_images)):
+        with_shadow = _bg_and_shadow_cached(cache, settings, input_images, backend)
+    if verbose:
+        print(f"Cache: {cache.describe()}", flush=True)
+    return with_shadow
+
+
+def mark_processing(settings: Settings, input_images: List[str]) -> int:
+    """Track processing in state to avoid duplicates on restart; returns the batch id."""
+    return get_state_store(settings).mark_processing(input_images)
+
+
+def mark_processed(
+    settings: Settings, input_images: List[str], batch_id: Optional[int] = None
+) -> None:
+    get_state_store(settings).mark_processed(input_images, batch_id)
+
+
+def process_batch(
+    input_images: List[str], backend: Optional[str] = None, settings: Optional[Settings] = None
+) -> str:
+    """Process a batch of images end-to-end and return output PDF path.
+
+    `backend` overrides BG_BACKEND for this batch ("photoroom" or "local");
+    `settings` gives a watched folder its own state and output directory.
+    """
+    settings = settings or load_settings()
+    backend = backend or settings.bg_backend
+
+    try:
+        with profiling.section(), tracing.span("batch", images=len(input_images)) as span:
+            batch_id = mark_processing(settings, input_images)
+            span.set(batch_id=batch_id, state_db=os.path.basename(settings.state_db))
+            with_shadow = run_stages(settings, input_images, backend)
+            pdf_path = images_to_pdf_3x3(with_shadow, settings.output_pdf_dir, settings=settings)
+            mark_processed(settings, input_images, batch_id)
+            span.set(pdf=os.path.basename(pdf_path))
+    finally:
+        profiling.batch_done()
+    BATCHES_PROCESSED.inc()
+    IMAGES_PROCESSED.inc(len(input_images))
 
     return pdf_path
 
 
-def main_once() -> None:
+def main_once(backend: Optional[str] = None) -> None:
     settings = load_settings()
-    # Example manual run: take first 9 images from input
-    files = [
-        os.path.join(settings.input_dir, f)
-        for f in os.listdir(settings.input_dir)
-        if os.path.isfile(os.path.join(settings.input_dir, f))
-    ]
-    files = files[: settings.batch_size]
+    # Manual run: the oldest BATCH_SIZE images of INPUT_DIR, like the watchers,
+    # skipping files still being written (unchanged for STABILITY_SECONDS)
+    files = sort_by_ctime(list_image_files(settings.input_dir))
+    tracker = StabilityTracker(settings.stability_seconds)
+    tracker.observe(files)
+    time.sleep(tracker.next_ready_in(files))
+    files = tracker.observe(files)[: settings.batch_size]
     if not files:
         print("No images to process.")
         return
-    out = process_batch(files)
+    out = process_batch(files, backend=backend)
     print(f"Generated PDF: {out}")
 
 def main() -> None:
@@ -72,15 +201,34 @@ def main() -> None:
         nargs="+",
         help="Explicit image paths to process (up to batch size)",
     )
+    parser.add_argument(
+        "--bulk",
+        metavar="DIR",
+        help="Backfill every image of DIR into multi-page PDFs (resumable)",
+    )
+    parser.add_argument(
+        "--pages-per-pdf",
+        type=int,
+        help="Pages per PDF in --bulk mode (default: BULK_PAGES_PER_PDF)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        help="Background removal engine for this run (default: BG_BACKEND)",
+    )
     args = parser.parse_args()
 
-    if args.paths:
+    if args.bulk:
+        from .bulk import run_bulk
+
+        run_bulk(args.bulk, pages_per_pdf=args.pages_per_pdf, backend=args.backend)
+    elif args.paths:
         settings = load_settings()
         files = args.paths[: settings.batch_size]
-        out = process_batch(files)
+        out = process_batch(files, backend=args.backend)
         print(f"Generated PDF: {out}")
     else:
-        main_once()
+        main_once(backend=args.backend)
 
 
 if __name__ == "__main__":
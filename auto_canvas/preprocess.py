@@ -0,0 +1,45 @@
+import io
+import math
+import os
+from typing import BinaryIO, Tuple
+
+from PIL import Image, ImageOps
+
+from .utils import file_basename_without_ext
+
+
+EXIF_ORIENTATION = 0x0112
+
+
+def prepare_upload(path: str, max_side: int, quality: int) -> Tuple[str, BinaryIO, str]:
+    """Return a `(filename, stream, mimetype)` upload payload for `path`.
+
+    JPEGs are decoded at reduced scale (draft mode), EXIF orientation is applied,
+    the longest side is capped to `max_side` and the result re-encoded as JPEG.
+    Images that are already small, upright JPEGs are streamed from disk unchanged.
+    `max_side <= 0` disables preprocessing.
+    """
+    if max_side <= 0:
+        return os.path.basename(path), open(path, "rb"), "application/octet-stream"
+
+    with Image.open(path) as im:
+        orientation = im.getexif().get(EXIF_ORIENTATION, 1)
+        if im.format == "JPEG" and orientation == 1 and max(im.size) <= max_side:
+            return os.path.basename(path), open(path, "rb"), "image/jpeg"
+        if im.format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below max_side.
+            # draft() keeps both axes at least the requested size, so ask for
+            # the aspect-preserving target, not a square
+            scale = max_side / max(im.size)
+            im.draft("RGB", (math.ceil(im.width * scale), math.ceil(im.height * scale)))
+        img = ImageOps.exif_transpose(im)
+        if img.mode != "RGB":
+            # PhotoRoom only needs the subject; flatten any transparency on white
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[3])
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=quality, optimize=True)
+    buf.seek(0)
+    return f"{file_basename_without_ext(path)}.jpg", buf, "image/jpeg"
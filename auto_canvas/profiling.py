@@ -0,0 +1,226 @@
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from .config import load_settings
+
+
+# On-demand profiling of the next N batches of a running watcher.
+#
+# The diagnostics app writes a request into PROFILE_DIR; the first watcher
+# process to start a batch section claims it (atomic rename), profiles until
+# N batches have finished, then writes the report next to it. Modes:
+#   cpu     cProfile of every section thread (batch, image and PDF work),
+#           merged; report sorted by cumulative time, plus a .prof file
+#   memory  tracemalloc over the whole process; top allocation sites and
+#           their growth since the start
+
+MODES = ("cpu", "memory")
+REQUEST_FILE = "request.json"
+# Sections check for a request at most this often
+CHECK_SECONDS = 1.0
+TOP_LINES = 40
+
+
+def _dir() -> str:
+    return load_settings().profile_dir
+
+
+def request_profile(mode: str, batches: int) -> Dict[str, object]:
+    """Ask the watcher to profile its next `batches` batches; replaces a
+    request nobody has claimed yet."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}; expected one of {MODES}")
+    if batches < 1:
+        raise ValueError("batches must be at least 1")
+    directory = _dir()
+    if not directory:
+        raise RuntimeError("PROFILE_DIR is not set")
+    os.makedirs(directory, exist_ok=True)
+    req = {"id": uuid.uuid4().hex[:12], "mode": mode, "batches": batches, "requested": time.time()}
+    tmp = os.path.join(directory, f"{REQUEST_FILE}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(req, f)
+    os.replace(tmp, os.path.join(directory, REQUEST_FILE))
+    return req
+
+
+def profile_status(profile_id: str) -> Dict[str, object]:
+    """"pending" (not claimed yet), "running", "done" (with the report) or "unknown"."""
+    directory = _dir()
+    if not profile_id.isalnum():
+        return {"id": profile_id, "status": "unknown"}
+    report = os.path.join(directory, f"{profile_id}.txt")
+    if os.path.exists(report):
+        with open(report, "r", encoding="utf-8") as f:
+            return {"id": profile_id, "status": "done", "report": f.read()}
+    if os.path.exists(os.path.join(directory, f"{profile_id}.running.json")):
+        return {"id": profile_id, "status": "running"}
+    try:
+        with open(os.path.join(directory, REQUEST_FILE), "r", encoding="utf-8") as f:
+            if json.load(f).get("id") == profile_id:
+                return {"id": profile_id, "status": "pending"}
+    except (OSError, ValueError):
+        pass
+    return {"id": profile_id, "status": "unknown"}
+
+
+def list_reports() -> List[str]:
+    directory = _dir()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(n[:-4] for n in names if n.endswith(".txt"))
+
+
+class _Session:
+    def __init__(self, req: Dict[str, object], running_path: str) -> None:
+        self.id = str(req["id"])
+        self.mode = str(req["mode"])
+        self.left = int(req["batches"])  # type: ignore[arg-type]
+        self.batches = self.left
+        self.running_path = running_path
+        self.started = time.time()
+        self.profiles: list = []
+        self.baseline = None
+        if self.mode == "memory":
+            import tracemalloc
+
+            tracemalloc.start(25)
+            self.baseline = tracemalloc.take_snapshot()
+
+    def report(self) -> str:
+        out = io.StringIO()
+        out.write(
+            f"{self.mode} profile {self.id}: {self.batches} batch(es), pid {os.getpid()}, "
+            f"{time.time() - self.started:.1f}s\n\n"
+        )
+        if self.mode == "cpu":
+            import pstats
+
+            if not self.profiles:
+                return out.getvalue() + "No profiled section ran.\n"
+            stats = pstats.Stats(self.profiles[0], stream=out)
+            for prof in self.profiles[1:]:
+                stats.add(prof)
+            stats.dump_stats(os.path.join(os.path.dirname(self.running_path), f"{self.id}.prof"))
+            stats.sort_stats("cumulative").print_stats(TOP_LINES)
+        else:
+            import tracemalloc
+
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            ignore = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+            snapshot = snapshot.filter_traces(ignore)
+            out.write("Top allocations still held:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_LINES]:
+                out.write(f"{stat}\n")
+            out.write("\nGrowth since the start:\n")
+            growth = snapshot.compare_to(self.baseline.filter_traces(ignore), "lineno")
+            for stat in growth[:TOP_LINES]:
+                out.write(f"{stat}\n")
+        return out.getvalue()
+
+
+_SESSION: Optional[_Session] = None
+_LOCK = threading.Lock()
+_CHECKED = 0.0
+_LOCAL = threading.local()
+
+
+def _claim() -> None:
+    """Take a pending request, at most every CHECK_SECONDS; call under _LOCK."""
+    global _SESSION, _CHECKED
+    now = time.monotonic()
+    if _SESSION is not None or now - _CHECKED < CHECK_SECONDS:
+        return
+    _CHECKED = now
+    directory = _dir()
+    if not directory:
+        return
+    request = os.path.join(directory, REQUEST_FILE)
+    claimed = os.path.join(directory, f"claimed.{os.getpid()}.json")
+    try:
+        # Only one process wins the rename
+        os.rename(request, claimed)
+        with open(claimed, "r", encoding="utf-8") as f:
+            req = json.load(f)
+    except (OSError, ValueError):
+        return
+    running = os.path.join(directory, f"{req['id']}.running.json")
+    os.replace(claimed, running)
+    _SESSION = _Session(req, running)
+    print(
+        f"Profiling ({_SESSION.mode}) the next {_SESSION.left} batch(es): {_SESSION.id}", flush=True
+    )
+
+
+@contextmanager
+def section() -> Iterator[None]:
+    """Profile this thread's work in the block while a cpu session runs.
+
+    Wraps each unit of batch work (a whole batch, one image, one PDF); nested
+    sections of the same thread are covered by the outer one.
+    """
+    with _LOCK:
+        _claim()
+        session = _SESSION
+    if session is None or session.mode != "cpu" or getattr(_LOCAL, "active", False):
+        yield
+        return
+    import cProfile
+
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # Python 3.12+ runs one profiler per process, which sees every thread
+        prof = None
+    if prof is None:
+        yield
+        return
+    _LOCAL.active = True
+    try:
+        yield
+    finally:
+        prof.disable()
+        _LOCAL.active = False
+        with _LOCK:
+            if _SESSION is session:
+                session.profiles.append(prof)
+
+
+def batch_done() -> None:
+    """Count a finished batch (failed ones too); ends the session after N."""
+    global _SESSION
+    with _LOCK:
+        session = _SESSION
+        if session is None:
+            return
+        session.left -= 1
+        if session.left > 0:
+            return
+        _SESSION = None
+    try:
+        report = session.report()
+        path = os.path.join(os.path.dirname(session.running_path), f"{session.id}.txt")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(report)
+        os.replace(path + ".tmp", path)
+        print(f"Profile {session.id} written to {path}", flush=True)
+    except Exception as e:
+        print(f"Profile {session.id} failed: {e}", flush=True)
+    finally:
+        try:
+            os.remove(session.running_path)
+        except OSError:
+            pass
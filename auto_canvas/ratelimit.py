@@ -0,0 +1,283 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterator, Mapping, Optional, Tuple
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every PhotoRoom worker.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; `acquire`
+    blocks until a token is available, so callers are paced without a fixed sleep.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self._lock = threading.Lock()
+        self._rate = max(float(rate), 1e-6)
+        self._capacity = max(float(capacity), 1.0)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        # Configured rate, which `set_rate` backs off from and returns to
+        self.base_rate = self._rate
+
+    @classmethod
+    def per_minute(cls, requests_per_min: int, burst: int, **kwargs) -> "TokenBucket":
+        return cls(rate=max(requests_per_min, 1) / 60.0, capacity=max(burst, 1), **kwargs)
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+            self._updated = now
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self._rate = max(float(rate), 1e-6)
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Take `tokens` if available and return 0.0, else return seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self._rate
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket kept in a SQLite file, so every process given the same
+    `path` (the watcher and the API's jobs) draws from one budget.
+
+    The current rate is stored with the tokens: a 429 seen by one process
+    slows the others down too.
+    """
+
+    def __init__(self, rate: float, capacity: float, path: str) -> None:
+        super().__init__(rate, capacity)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One connection for the process, used under `_lock`
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bucket ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), tokens REAL, updated REAL, rate REAL)"
+        )
+        # A lower configured rate applies at once; a higher one is reached by recovery
+        self._db.execute(
+            "INSERT INTO bucket VALUES (1, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET rate = MIN(rate, excluded.rate)",
+            (self._capacity, time.time(), self._rate),
+        )
+
+    def _update(self, change: Callable[[float, float], Tuple[float, float, float]]) -> float:
+        """Refill the stored bucket, then let `change(tokens, rate)` return the
+        new tokens and rate plus a result, all in one transaction."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated, rate = self._db.execute(
+                    "SELECT tokens, updated, rate FROM bucket WHERE id = 1"
+                ).fetchone()
+                now = time.time()
+                tokens = min(self._capacity, tokens + max(0.0, now - updated) * rate)
+                tokens, rate, result = change(tokens, rate)
+                self._db.execute(
+                    "UPDATE bucket SET tokens = ?, updated = ?, rate = ? WHERE id = 1",
+                    (tokens, max(now, updated), rate),
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    @property
+    def rate(self) -> float:
+        with self._lock:
+            return self._db.execute("SELECT rate FROM bucket WHERE id = 1").fetchone()[0]
+
+    def set_rate(self, rate: float) -> None:
+        self._update(lambda tokens, _: (tokens, max(float(rate), 1e-6), 0.0))
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        def take(available: float, rate: float) -> Tuple[float, float, float]:
+            if available >= tokens:
+                return available - tokens, rate, 0.0
+            return available, rate, (tokens - available) / rate
+
+        return self._update(take)
+
+
+class QuotaExhaustedError(RuntimeError):
+    """PhotoRoom answered 402, or the quota circuit breaker is still open."""
+
+
+class RateLimitedError(RuntimeError):
+    """PhotoRoom kept answering 429 after the allowed number of parked retries."""
+
+
+def _header_seconds(headers: Mapping[str, str], now: float) -> Optional[float]:
+    """Seconds to wait according to Retry-After or rate-limit reset headers."""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(retry_after)
+                return max(0.0, when.timestamp() - now)
+            except (TypeError, ValueError):
+                pass
+    for name in ("RateLimit-Reset", "X-RateLimit-Reset", "X-Ratelimit-Reset"):
+        value = headers.get(name)
+        if not value:
+            continue
+        try:
+            reset = float(value)
+        except ValueError:
+            continue
+        # Some APIs send an epoch timestamp, others a delay in seconds
+        return max(0.0, reset - now) if reset > 1e9 else max(0.0, reset)
+    return None
+
+
+class RateController:
+    """AIMD pacing for PhotoRoom on top of the shared TokenBucket.
+
+    Each 429 halves the allowed concurrency and request rate and parks every
+    worker until `Retry-After` (or `default_wait`) has elapsed; each success adds
+    one slot and a fraction of the base rate back, at most once per `cooldown`.
+    A 402 opens a circuit breaker for `quota_cooldown` seconds, after which a
+    single probe request decides whether to close it again.
+    """
+
+    def __init__(
+        self,
+        bucket: TokenBucket,
+        max_concurrency: int,
+        default_wait: float,
+        cooldown: float,
+        quota_cooldown: float,
+    ) -> None:
+        self.bucket = bucket
+        self.max_concurrency = max(1, max_concurrency)
+        self.base_rate = bucket.base_rate
+        self.default_wait = default_wait
+        self.cooldown = cooldown
+        self.quota_cooldown = quota_cooldown
+        self.concurrency = self.max_concurrency
+        self.breaker = "closed"
+        self._cond = threading.Condition()
+        self._active = 0
+        self._parked_until = 0.0
+        self._breaker_until = 0.0
+        self._last_increase = float("-inf")
+        self._last_decrease = float("-inf")
+
+    def _limit(self) -> int:
+        return 1 if self.breaker == "half_open" else self.concurrency
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one request slot; blocks while parked or at the concurrency limit."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.breaker == "open":
+                    if now < self._breaker_until:
+                        raise QuotaExhaustedError(
+                            f"PhotoRoom quota breaker open for {self._breaker_until - now:.0f}s"
+                        )
+                    self.breaker = "half_open"
+                if now < self._parked_until:
+                    self._cond.wait(self._parked_until - now)
+                    continue
+                if self._active >= self._limit():
+                    self._cond.wait()
+                    continue
+                self._active += 1
+                break
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def on_success(self, headers: Mapping[str, str]) -> None:
+        with self._cond:
+            now = time.monotonic()
+            self.breaker = "closed"
+            remaining = headers.get("X-RateLimit-Remaining") or headers.get("RateLimit-Remaining")
+            if remaining is not None and remaining.strip() == "0":
+                # Window used up: wait for the reset instead of collecting a 429
+                wait = _header_seconds(headers, time.time())
+                if wait:
+                    self._parked_until = max(self._parked_until, now + wait)
+            recovering = self.concurrency < self.max_concurrency or self.bucket.rate < self.base_rate
+            if recovering and now - max(self._last_increase, self._last_decrease) >= self.cooldown:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.bucket.set_rate(
+                    min(self.base_rate, self.bucket.rate + self.base_rate / self.max_concurrency)
+                )
+                self._last_increase = now
+            self._cond.notify_all()
+
+    def on_throttle(self, headers: Mapping[str, str]) -> float:
+        """Record a 429 and return how long workers are parked."""
+        with self._cond:
+            now = time.monotonic()
+            wait = _header_seconds(headers, time.time())
+            if wait is None:
+                wait = self.default_wait
+            self._parked_until = max(self._parked_until, now + wait)
+            # Only back off once per parked window, not once per in-flight request
+            if now - self._last_decrease >= self.cooldown:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.bucket.set_rate(max(self.base_rate / 8, self.bucket.rate / 2))
+                self._last_decrease = now
+            return wait
+
+    def on_quota_exhausted(self, headers: Mapping[str, str]) -> float:
+        with self._cond:
+            wait = _header_seconds(headers, time.time())
+            if wait is None:
+                wait = self.quota_cooldown
+            self.breaker = "open"
+            self._breaker_until = time.monotonic() + wait
+            self._cond.notify_all()
+            return wait
+
+    def snapshot(self) -> Dict[str, object]:
+        """Current allowed rate, concurrency and breaker state."""
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "requests_per_min": round(self.bucket.rate * 60, 2),
+                "base_requests_per_min": round(self.base_rate * 60, 2),
+                "concurrency": self._limit(),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self._active,
+                "parked_seconds": round(max(0.0, self._parked_until - now), 1),
+                "breaker": self.breaker,
+                "breaker_seconds": round(max(0.0, self._breaker_until - now), 1)
+                if self.breaker == "open"
+                else 0.0,
+            }
@@ -1,52 +1,333 @@
+import io
+import multiprocessing
 import os
-from typing import List, Tuple
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 from PIL import Image, ImageFilter
 
+from . import tracing
+from .artifact import Artifact
 from .config import load_settings
-from .utils import file_basename_without_ext
+from .metrics import STAGE_SECONDS
+from .utils import unique_output_paths
 
 
-def add_shadow_batch(
-    input_paths: List[str],
-    offset: Tuple[int, int] = (10, 10),
-    blur_radius: int = 10,
-) -> List[str]:
-    settings = load_settings()
-    os.makedirs(settings.work_shadow_dir, exist_ok=True)
+SHADOW_OFFSET = (10, 10)
+SHADOW_BLUR_RADIUS = 10
+# Downscale to reduce memory footprint if very large
+MAX_SIDE = 1600
+SHADOW_ENGINES = ("fast", "reference")
+# The fast engine blurs at 1/n resolution, with n chosen so the reduced blur
+# radius stays around this many pixels (keeps the upsampled result smooth)
+FAST_BLUR_MIN_RADIUS = 6.0
+
+
+def _fit(img: Image.Image, max_side: int) -> Image.Image:
+    if max(img.width, img.height) > max_side:
+        scale = max_side / float(max(img.width, img.height))
+        new_size = (int(img.width * scale), int(img.height * scale))
+        img = img.resize(new_size, Image.LANCZOS)
+    return img
+
+
+def render_shadow_reference(
+    img: Image.Image, offset: Tuple[int, int], blur_radius: int
+) -> Image.Image:
+    """Original full-RGBA shadow: black layer, LANCZOS grow, blur, pasted twice."""
+    alpha = img.split()[3]
+
+    # Create shadow from alpha
+    shadow = Image.new("RGBA", img.size, (0, 0, 0, 255))
+    shadow.putalpha(alpha)
+    shadow = shadow.resize((int(img.width * 1.01), int(img.height * 1.01)), Image.LANCZOS)
+    shadow = shadow.filter(ImageFilter.GaussianBlur(float(blur_radius * 3)))
+
+    # Compose
+    new_size = (img.width + offset[0] * 4, img.height + offset[1] * 4)
+    new_img = Image.new("RGBA", new_size, (0, 0, 0, 0))
+    for _ in range(2):
+        new_img.paste(shadow, (offset[0] * 2, offset[1] * 2), shadow)
+    new_img.paste(img, (offset[0] * 2, offset[1] * 2), img)
+    return new_img
+
+
+def _double_paste_table() -> List[int]:
+    """Alpha produced by pasting a black layer of alpha a twice onto transparency.
+
+    Measured on a 256-pixel ramp so it matches Pillow's paste arithmetic exactly.
+    """
+    ramp = Image.frombytes("L", (256, 1), bytes(range(256)))
+    layer = Image.new("RGBA", (256, 1), (0, 0, 0, 255))
+    layer.putalpha(ramp)
+    canvas = Image.new("RGBA", (256, 1), (0, 0, 0, 0))
+    for _ in range(2):
+        canvas.paste(layer, (0, 0), layer)
+    return list(canvas.getchannel("A").tobytes())
+
+
+_DOUBLE_PASTE = _double_paste_table()
+
+
+def render_shadow_fast(
+    img: Image.Image, offset: Tuple[int, int], blur_radius: int
+) -> Image.Image:
+    """Same look as `render_shadow_reference`, computed on the 8-bit alpha only.
+
+    The shadow colour is plain black, so only its alpha matters: it is grown and
+    blurred at reduced resolution, upsampled, and the double paste is folded
+    into one lookup table.
+    """
+    sigma = float(blur_radius * 3)
+    grown = (int(img.width * 1.01), int(img.height * 1.01))
+    factor = max(1, int(sigma / FAST_BLUR_MIN_RADIUS))
+    small_size = (max(1, grown[0] // factor), max(1, grown[1] // factor))
+
+    mask = img.getchannel("A").resize(small_size, Image.BOX)
+    mask = mask.filter(ImageFilter.GaussianBlur(sigma * small_size[0] / grown[0]))
+    mask = mask.resize(grown, Image.BILINEAR).point(_DOUBLE_PASTE)
+
+    pos = (offset[0] * 2, offset[1] * 2)
+    new_size = (img.width + offset[0] * 4, img.height + offset[1] * 4)
+    shadow_alpha = Image.new("L", new_size, 0)
+    shadow_alpha.paste(mask, pos)
+    new_img = Image.new("RGBA", new_size, (0, 0, 0, 0))
+    new_img.putalpha(shadow_alpha)
+    new_img.paste(img, pos, img)
+    return new_img
+
 
-    outputs: List[str] = []
-    for inp in input_paths:
-        name = file_basename_without_ext(inp)
-        out_path = os.path.join(settings.work_shadow_dir, f"{name}.png")
+_RENDERERS = {"fast": render_shadow_fast, "reference": render_shadow_reference}
 
-        with Image.open(inp) as base_img:
-            img = base_img.convert("RGBA")
 
-            # Downscale to reduce memory footprint if very large
-            max_side = 1600
-            if max(img.width, img.height) > max_side:
-                scale = max_side / float(max(img.width, img.height))
-                new_size = (int(img.width * scale), int(img.height * scale))
-                img = img.resize(new_size, Image.LANCZOS)
+ShadowSource = Union[str, bytes, Image.Image]
+# (start as epoch seconds, render seconds, PNG encoding seconds) of one image
+Timings = Tuple[float, float, float]
 
-            alpha = img.split()[3]
 
-            # Create shadow from alpha
-            shadow = Image.new("RGBA", img.size, (0, 0, 0, 255))
-            shadow.putalpha(alpha)
-            shadow = shadow.resize((int(img.width * 1.01), int(img.height * 1.01)), Image.LANCZOS)
-            shadow = shadow.filter(ImageFilter.GaussianBlur(float(blur_radius * 3)))
+def _shadow_one(
+    src: ShadowSource,
+    offset: Tuple[int, int],
+    blur_radius: int,
+    max_side: int,
+    engine: str,
+    compress_level: Optional[int],
+    keep_image: bool = True,
+) -> Tuple[Optional[Image.Image], Optional[bytes], Timings]:
+    """Render one image; runs in a pool worker, so it takes no settings.
 
-            # Compose
-            new_size = (img.width + offset[0] * 4, img.height + offset[1] * 4)
-            new_img = Image.new("RGBA", new_size, (0, 0, 0, 0))
-            for _ in range(2):
-                new_img.paste(shadow, (offset[0] * 2, offset[1] * 2), shadow)
-            new_img.paste(img, (offset[0] * 2, offset[1] * 2), img)
+    `src` is a path, encoded bytes or a decoded image. The PNG encoding is only
+    done (here, in parallel) when `compress_level` is given; pool callers then
+    pass `keep_image=False` so only the bytes travel back. Also returns when
+    it started and the seconds spent rendering and encoding, for the caller to
+    record (a pool worker's own metrics would not reach the parent without
+    METRICS_DIR).
+    """
+    started = time.time()
+    t0 = time.perf_counter()
+    if isinstance(src, Image.Image):
+        img = _fit(src.convert("RGBA"), max_side)
+    else:
+        with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as base_img:
+            img = _fit(base_img.convert("RGBA"), max_side)
+    new_img = _RENDERERS[engine](img, offset, blur_radius)
+    t1 = time.perf_counter()
+    data = None
+    if compress_level is not None:
+        buf = io.BytesIO()
+        new_img.save(buf, format="PNG", compress_level=compress_level)
+        data = buf.getvalue()
+    timings = (started, t1 - t0, time.perf_counter() - t1)
+    return (new_img if keep_image or data is None else None), data, timings
+
+
+def _record(name: str, engine: str, timings: Timings) -> None:
+    started, render_s, encode_s = timings
+    STAGE_SECONDS.observe(render_s + encode_s, stage="shadow")
+    tracing.record(
+        "shadow.image", started, render_s + encode_s, image=name, engine=engine,
+        render_ms=round(render_s * 1000, 3), encode_ms=round(encode_s * 1000, 3),
+    )
+
+
+def _source(art: Artifact, pooled: bool) -> ShadowSource:
+    """Cheapest form to hand over: in-process prefer the decoded image, across
+    processes prefer the compact encoded bytes."""
+    if not pooled and art.image is not None:
+        return art.image
+    if art.data is not None:
+        return art.data
+    if art.path is not None:
+        return art.path
+    return art.open()
+
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_WORKERS = 0
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Long-lived worker pool, so process start-up is paid once per run."""
+    global _POOL, _POOL_WORKERS
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_WORKERS != workers:
+            if _POOL is not None:
+                _POOL.shutdown(wait=False)
+            # spawn: safe with the PhotoRoom threads around, and the Windows default
+            _POOL = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            _POOL_WORKERS = workers
+        return _POOL
+
+
+def _reset_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False)
+        _POOL = None
+
+
+def add_shadow(
+    art: Artifact,
+    offset: Tuple[int, int] = SHADOW_OFFSET,
+    blur_radius: int = SHADOW_BLUR_RADIUS,
+    max_side: int = MAX_SIDE,
+    engine: Optional[str] = None,
+    encode: bool = False,
+    work_file: Optional[str] = None,
+) -> Artifact:
+    """Shadow a single image, in the shared pool when SHADOW_WORKERS > 1.
+
+    For streaming callers that hand images over one at a time; concurrency is
+    the number of threads calling it. Work files follow KEEP_WORK_FILES, named
+    `work_file` in WORK_SHADOW_DIR (default `<name>.png`; callers pass one from
+    `unique_output_paths` when basenames can repeat).
+    """
+    settings = load_settings()
+    engine = engine or settings.shadow_engine
+    if engine not in _RENDERERS:
+        raise ValueError(f"Unknown shadow engine {engine!r}; expected one of {SHADOW_ENGINES}")
+    compress_level = (
+        settings.png_compress_level if (encode or settings.keep_work_files) else None
+    )
+    args = (offset, blur_radius, max_side, engine, compress_level)
+    if settings.shadow_workers <= 1:
+        img, data, timings = _shadow_one(_source(art, pooled=False), *args)
+    else:
+        try:
+            fut = _get_pool(settings.shadow_workers).submit(
+                _shadow_one, _source(art, pooled=True), *args, compress_level is None
+            )
+            img, data, timings = fut.result()
+        except BrokenProcessPool:
+            _reset_pool()
+            raise
+    _record(art.name, engine, timings)
+    out = Artifact(name=art.name, image=img, data=data)
+    if settings.keep_work_files:
+        os.makedirs(settings.work_shadow_dir, exist_ok=True)
+        out.write(os.path.join(settings.work_shadow_dir, work_file or f"{art.name}.png"))
+    return out
+
+
+def add_shadow_batch(
+    inputs: Sequence[Union[str, Artifact]],
+    offset: Tuple[int, int] = SHADOW_OFFSET,
+    blur_radius: int = SHADOW_BLUR_RADIUS,
+    max_side: int = MAX_SIDE,
+    on_result: Optional[Callable[[int, Artifact], None]] = None,
+    engine: Optional[str] = None,
+    encode: bool = False,
+) -> List[Artifact]:
+    """Add a drop shadow to each image, fanned out over SHADOW_WORKERS processes.
+
+    Inputs are paths or artifacts; outputs are in-memory artifacts in input
+    order, PNG-encoded only when `encode` is set (e.g. for the cache) or written
+    to WORK_SHADOW_DIR when KEEP_WORK_FILES is set (pool workers then send
+    back only the PNG bytes). At most SHADOW_MAX_INFLIGHT images (default
+    2 x SHADOW_WORKERS) are submitted at once, each holding one image. A
+    failing image does not stop the others: they are all reported, then the
+    first error is raised.
+    """
+    settings = load_settings()
+    engine = engine or settings.shadow_engine
+    if engine not in _RENDERERS:
+        raise ValueError(f"Unknown shadow engine {engine!r}; expected one of {SHADOW_ENGINES}")
 
-            new_img.save(out_path, format="PNG")
-            outputs.append(out_path)
+    arts = [a if isinstance(a, Artifact) else Artifact.from_path(a) for a in inputs]
+    work_paths: Optional[List[str]] = None
+    if settings.keep_work_files:
+        os.makedirs(settings.work_shadow_dir, exist_ok=True)
+        work_paths = unique_output_paths([a.name for a in arts], settings.work_shadow_dir)
+    compress_level = settings.png_compress_level if (encode or work_paths) else None
+    outputs: List[Optional[Artifact]] = [None] * len(arts)
+    errors: List[Tuple[int, BaseException]] = []
 
-    return outputs
+    def _done(idx: int, result: Tuple[Optional[Image.Image], Optional[bytes], Timings]) -> None:
+        img, data, timings = result
+        _record(arts[idx].name, engine, timings)  # type: ignore[arg-type]
+        art = Artifact(name=arts[idx].name, image=img, data=data)
+        if work_paths is not None:
+            art.write(work_paths[idx], settings.png_compress_level)
+        outputs[idx] = art
+        if on_result is not None:
+            on_result(idx, art)
 
+    jobs = list(enumerate(arts))
+    workers = max(1, settings.shadow_workers)
+    if workers <= 1 or len(jobs) <= 1:
+        for idx, art in jobs:
+            try:
+                src = _source(art, pooled=False)
+                _done(idx, _shadow_one(src, offset, blur_radius, max_side, engine, compress_level))
+            except Exception as e:
+                errors.append((idx, e))
+    else:
+        pool = _get_pool(workers)
+        inflight = max(1, settings.shadow_max_inflight or 2 * workers)
+        pending: Dict[Future, int] = {}
+        queue = iter(jobs)
+        try:
+            while True:
+                for idx, art in queue:
+                    fut = pool.submit(
+                        _shadow_one,
+                        _source(art, pooled=True),
+                        offset,
+                        blur_radius,
+                        max_side,
+                        engine,
+                        compress_level,
+                        compress_level is None,
+                    )
+                    pending[fut] = idx
+                    if len(pending) >= inflight:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    idx = pending.pop(fut)
+                    try:
+                        _done(idx, fut.result())
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        errors.append((idx, e))
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM); start a fresh pool next batch
+            _reset_pool()
+            raise
 
+    if errors:
+        idx, err = min(errors, key=lambda item: item[0])
+        raise RuntimeError(
+            f"Shadow failed for {len(errors)}/{len(jobs)} image(s); "
+            f"first: {arts[idx].path or arts[idx].name}: {err}"
+        ) from err
+    return outputs  # type: ignore[return-value]
@@ -0,0 +1,400 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .config import Settings, load_settings
+from .utils import file_signature, load_state
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    status TEXT NOT NULL,          -- 'processing' or 'processed'
+    signature TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_status ON files(status);
+CREATE TABLE IF NOT EXISTS drive_files (
+    file_id TEXT PRIMARY KEY,
+    processed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS drive_listing (
+    folder_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    file TEXT NOT NULL,            -- JSON metadata from the Drive API
+    PRIMARY KEY (folder_id, file_id)
+);
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    paths TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phashes (
+    path TEXT PRIMARY KEY,
+    hash INTEGER NOT NULL,         -- 64-bit dHash, stored signed
+    bg_key TEXT,                   -- cache key of its cut-out, when known
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    folder_id TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    token TEXT NOT NULL,           -- marker in the Drive file's appProperties
+    attempts INTEGER NOT NULL DEFAULT 0,   -- uploads started, counted before each one
+    next_try REAL NOT NULL,
+    last_error TEXT,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# SQLite's default limit on bound parameters is 999 on older builds
+_CHUNK = 900
+_MASK64 = (1 << 64) - 1
+
+
+def _chunks(items: List[str]) -> Iterator[List[str]]:
+    for i in range(0, len(items), _CHUNK):
+        yield items[i : i + _CHUNK]
+
+
+class StateStore:
+    """Processed files, Drive ids and in-flight batches in SQLite (WAL mode).
+
+    Every update is one small transaction touching only the rows concerned,
+    instead of rewriting the whole `.state.json`. Each thread gets its own
+    connection; WAL lets the watcher read while a pipeline thread writes.
+
+    Polls are incremental too: processed rows already seen are remembered, so
+    a poll only queries files that are new or not yet processed, and pruning
+    compares the folder listing with the paths known to this process (rows
+    added by another process are pruned after a restart).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._memo_lock = threading.Lock()
+        # path -> signature of rows known to be 'processed'
+        self._processed: Dict[str, Optional[str]] = {}
+        # Every path in the table, loaded on the first prune
+        self._paths: Optional[Set[str]] = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self) -> Iterator[sqlite3.Connection]:
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    # Migration
+    def migrate_json(self, json_path: str) -> bool:
+        """Import a legacy `.state.json` once, then rename it `*.migrated`."""
+        if not os.path.exists(json_path):
+            return False
+        state = load_state(json_path)
+        now = time.time()
+        signatures: Dict[str, str] = state.get("processed_signatures", {})
+        rows = [(p, "processing", None, now) for p in state.get("processing", [])]
+        rows += [(p, "processed", signatures.get(p), now) for p in state.get("processed", [])]
+        with self._tx() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO files(path, status, signature, updated) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            db.executemany(
+                "INSERT OR IGNORE INTO drive_files(file_id, processed_at) VALUES (?, ?)",
+                [(fid, now) for fid in state.get("processed_drive_ids", [])],
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES ('migrated_from', ?)",
+                (json_path,),
+            )
+        os.replace(json_path, json_path + ".migrated")
+        print(f"State migrated from {json_path} to {self.path} ({len(rows)} file(s))", flush=True)
+        return True
+
+    # Local files
+    def lookup(self, paths: List[str]) -> Dict[str, Tuple[str, Optional[str]]]:
+        """(status, signature) of the given paths that are known."""
+        found: Dict[str, Tuple[str, Optional[str]]] = {}
+        missing: List[str] = []
+        with self._memo_lock:
+            for p in paths:
+                if p in self._processed:
+                    found[p] = ("processed", self._processed[p])
+                else:
+                    missing.append(p)
+        db = self._conn()
+        for part in _chunks(missing):
+            marks = ",".join("?" * len(part))
+            rows = db.execute(
+                f"SELECT path, status, signature FROM files WHERE path IN ({marks})", part
+            ).fetchall()
+            with self._memo_lock:
+                for path, status, sig in rows:
+                    found[path] = (status, sig)
+                    if status == "processed":
+                        self._processed[path] = sig
+        return found
+
+    def _remember(self, paths: Iterable[str], signatures: Optional[Dict[str, str]] = None) -> None:
+        with self._memo_lock:
+            if self._paths is not None:
+                self._paths.update(paths)
+            if signatures is not None:
+                self._processed.update(signatures)
+
+    def set_signatures(self, signatures: Dict[str, str]) -> None:
+        if not signatures:
+            return
+        now = time.time()
+        with self._tx() as db:
+            db.executemany(
+                "UPDATE files SET signature = ?, updated = ? WHERE path = ?",
+                [(sig, now, p) for p, sig in signatures.items()],
+            )
+        with self._memo_lock:
+            for p, sig in signatures.items():
+                if p in self._processed:
+                    self._processed[p] = sig
+
+    def mark_processing(self, paths: List[str]) -> int:
+        """Record an in-flight batch; returns its id for `mark_processed`."""
+        now = time.time()
+        with self._tx() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO files(path, status, signature, updated) "
+                "VALUES (?, 'processing', NULL, ?)",
+                [(p, now) for p in paths],
+            )
+            cur = db.execute(
+                "INSERT INTO batches(paths, started) VALUES (?, ?)", (json.dumps(paths), now)
+            )
+        self._remember(paths)
+        return int(cur.lastrowid)
+
+    def mark_processed(self, paths: List[str], batch_id: Optional[int] = None) -> None:
+        now = time.time()
+        rows = [(p, file_signature(p), now) for p in paths]
+        with self._tx() as db:
+            db.executemany(
+                "INSERT INTO files(path, status, signature, updated) VALUES (?, 'processed', ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET status = 'processed', "
+                "signature = excluded.signature, updated = excluded.updated",
+                rows,
+            )
+            if batch_id is not None:
+                db.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+        self._remember(paths, {p: sig for p, sig, _ in rows})
+
+    def prune_absent(self, existing: Iterable[str]) -> int:
+        """Forget files no longer on disk, so a later re-copy counts as new.
+
+        Their perceptual hashes go too (a running duplicate index drops them
+        when it is next opened), so `phashes` stays as large as `files`.
+        """
+        existing_set = set(existing)
+        if self._paths is None:
+            known = {p for (p,) in self._conn().execute("SELECT path FROM files")}
+            with self._memo_lock:
+                self._paths = known
+        with self._memo_lock:
+            gone = [p for p in self._paths if p not in existing_set]
+        if gone:
+            with self._tx() as db:
+                db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in gone])
+                db.executemany("DELETE FROM phashes WHERE path = ?", [(p,) for p in gone])
+            with self._memo_lock:
+                self._paths.difference_update(gone)
+                for p in gone:
+                    self._processed.pop(p, None)
+        return len(gone)
+
+    def clear_inflight(self) -> int:
+        """Drop batches left over by a previous run; their files are retried."""
+        with self._tx() as db:
+            return db.execute("DELETE FROM batches").rowcount
+
+    # Google Drive
+    def drive_processed(self, file_ids: List[str]) -> Set[str]:
+        done: Set[str] = set()
+        db = self._conn()
+        for part in _chunks(file_ids):
+            marks = ",".join("?" * len(part))
+            done.update(
+                fid for (fid,) in db.execute(
+                    f"SELECT file_id FROM drive_files WHERE file_id IN ({marks})", part
+                )
+            )
+        return done
+
+    def mark_drive_processed(self, file_ids: List[str]) -> None:
+        now = time.time()
+        with self._tx() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO drive_files(file_id, processed_at) VALUES (?, ?)",
+                [(fid, now) for fid in file_ids],
+            )
+
+    def drive_listing(self, folder_id: str) -> Tuple[Optional[str], Dict[str, Dict]]:
+        """Change token and images of a Drive folder as of that token (see gdrive.py)."""
+        db = self._conn()
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = ?", (f"drive_token:{folder_id}",)
+        ).fetchone()
+        files = {
+            fid: json.loads(meta)
+            for fid, meta in db.execute(
+                "SELECT file_id, file FROM drive_listing WHERE folder_id = ?", (folder_id,)
+            )
+        }
+        return (row[0] if row else None), files
+
+    def save_drive_listing(
+        self,
+        folder_id: str,
+        token: str,
+        upserts: Dict[str, Dict],
+        removed: Iterable[str] = (),
+        replace: bool = False,
+    ) -> None:
+        """Apply listing changes and the token they lead to in one transaction."""
+        with self._tx() as db:
+            if replace:
+                db.execute("DELETE FROM drive_listing WHERE folder_id = ?", (folder_id,))
+            db.executemany(
+                "DELETE FROM drive_listing WHERE folder_id = ? AND file_id = ?",
+                [(folder_id, fid) for fid in removed],
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO drive_listing(folder_id, file_id, file) VALUES (?, ?, ?)",
+                [(folder_id, fid, json.dumps(f)) for fid, f in upserts.items()],
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)",
+                (f"drive_token:{folder_id}", token),
+            )
+
+    # Drive uploads (see uploads.py)
+    def add_upload(self, path: str, folder_id: str, mime_type: str) -> int:
+        now = time.time()
+        with self._tx() as db:
+            cur = db.execute(
+                "INSERT INTO uploads(path, folder_id, mime_type, token, next_try, added) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, folder_id, mime_type, uuid.uuid4().hex, now, now),
+            )
+        return int(cur.lastrowid)
+
+    def due_uploads(self, now: float) -> List[Tuple[int, str, str, str, str, int]]:
+        """(upload_id, path, folder_id, mime_type, token, attempts), oldest first."""
+        return self._conn().execute(
+            "SELECT upload_id, path, folder_id, mime_type, token, attempts FROM uploads "
+            "WHERE next_try <= ? ORDER BY upload_id",
+            (now,),
+        ).fetchall()
+
+    def pending_uploads(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def next_upload_at(self) -> Optional[float]:
+        return self._conn().execute("SELECT MIN(next_try) FROM uploads").fetchone()[0]
+
+    def start_upload(self, upload_id: int) -> None:
+        """Count an attempt before it starts, so a crash during or right after
+        the upload leaves a trace."""
+        with self._tx() as db:
+            db.execute(
+                "UPDATE uploads SET attempts = attempts + 1 WHERE upload_id = ?", (upload_id,)
+            )
+
+    def retry_upload(self, upload_id: int, error: str, next_try: float) -> None:
+        with self._tx() as db:
+            db.execute(
+                "UPDATE uploads SET last_error = ?, next_try = ? WHERE upload_id = ?",
+                (error, next_try, upload_id),
+            )
+
+    def finish_upload(self, upload_id: int) -> None:
+        with self._tx() as db:
+            db.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+
+    # Perceptual hashes (see dedup.py)
+    def phashes(self) -> List[Tuple[str, int, Optional[str]]]:
+        return [
+            (path, h & _MASK64, key)
+            for path, h, key in self._conn().execute("SELECT path, hash, bg_key FROM phashes")
+        ]
+
+    def add_phash(self, path: str, h: int, bg_key: Optional[str]) -> None:
+        signed = h - (1 << 64) if h >= 1 << 63 else h
+        with self._tx() as db:
+            db.execute(
+                "INSERT INTO phashes(path, hash, bg_key, added) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET hash = excluded.hash, "
+                "bg_key = COALESCE(excluded.bg_key, phashes.bg_key), added = excluded.added",
+                (path, signed, bg_key, time.time()),
+            )
+
+    def bump_counter(self, name: str, n: int = 1) -> int:
+        """Add `n` to a persistent counter in `meta`; returns the new value."""
+        with self._tx() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = ?", (name,)).fetchone()
+            value = int(row[0]) + n if row else n
+            db.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (name, str(value))
+            )
+        return value
+
+    def counts(self) -> Dict[str, int]:
+        db = self._conn()
+        out = {
+            status: n
+            for status, n in db.execute("SELECT status, COUNT(*) FROM files GROUP BY status")
+        }
+        out["drive_files"] = db.execute("SELECT COUNT(*) FROM drive_files").fetchone()[0]
+        out["inflight_batches"] = db.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+        out["pending_uploads"] = self.pending_uploads()
+        return out
+
+
+_STORES: Dict[str, StateStore] = {}
+_STORE_LOCK = threading.Lock()
+
+
+def get_state_store(settings: Optional[Settings] = None) -> StateStore:
+    """Process-wide store at STATE_DB (one per database, e.g. per watched
+    folder), migrating STATE_FILE on first open."""
+    s = settings or load_settings()
+    with _STORE_LOCK:
+        store = _STORES.get(s.state_db)
+        if store is None:
+            store = StateStore(s.state_db)
+            store.migrate_json(s.state_file)
+            _STORES[s.state_db] = store
+        return store
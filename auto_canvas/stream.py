@@ -0,0 +1,260 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+from . import profiling, tracing
+from .artifact import Artifact
+from .bg import get_backend
+from .cache import get_cache
+from .config import Settings, load_settings
+from .metrics import BATCHES_PROCESSED, IMAGES_PROCESSED, STAGE_SECONDS
+from .pdfgen import images_to_pdf_3x3
+from .pipeline import bg_cache_key, mark_processed, mark_processing, shadow_cache_key
+from .shadow import add_shadow
+from .utils import unique_output_paths
+
+
+class _Batch:
+    def __init__(self, batch_id: int, paths: List[str]) -> None:
+        self.batch_id = batch_id
+        self.paths = paths
+        self.outputs: List[Optional[Artifact]] = [None] * len(paths)
+        # Work file names (KEEP_WORK_FILES), suffixed where basenames repeat
+        self.work_files = unique_output_paths(paths, "")
+        self.remaining = len(paths)
+        self.bg_remaining = len(paths)
+        self.error: Optional[BaseException] = None
+        self.fell_back = False
+        self.state_id: Optional[int] = None
+        self.future: "Future[str]" = Future()
+        self.lock = threading.Lock()
+        self.submitted = time.monotonic()
+        self.bg_done = self.stages_done = self.submitted
+        # Parent of the batch's image and PDF spans, ended with the PDF
+        self.span = tracing.start("batch", images=len(paths), pipeline="stream")
+
+
+class _Job:
+    def __init__(self, batch: _Batch, index: int) -> None:
+        self.batch = batch
+        self.index = index
+        self.path = batch.paths[index]
+        self.bg_key: Optional[str] = None
+        self.shadow_key: Optional[str] = None
+        self.no_bg: Optional[Artifact] = None
+
+
+class StreamingPipeline:
+    """Background removal, shadow and PDF as stages joined by bounded queues.
+
+    Each image moves to the shadow stage as soon as its cut-out exists, and a
+    batch's PDF is rendered while the next batch is in the API. `submit` blocks
+    once PIPELINE_MAX_BATCHES batches are in flight, and background workers
+    block when PIPELINE_QUEUE_SIZE cut-outs wait for a shadow worker, so a slow
+    stage holds back the ones before it instead of piling up images in memory.
+    """
+
+    def __init__(self, backend: Optional[str] = None, settings: Optional[Settings] = None) -> None:
+        self.settings = settings or load_settings()
+        s = self.settings
+        self.backend_name = backend or s.bg_backend
+        self.backend = get_backend(self.backend_name, s)
+        self.fallback = s.bg_fallback if s.bg_fallback != self.backend_name else ""
+        self.cache = get_cache(s)
+
+        bg_workers = s.pipeline_bg_workers or self.backend.concurrency
+        self._bg_pool = ThreadPoolExecutor(max_workers=max(1, bg_workers), thread_name_prefix="stream-bg")
+        self._shadow_q: "queue.Queue[Optional[_Job]]" = queue.Queue(maxsize=max(1, s.pipeline_queue_size))
+        # Bounded by the batch slots below
+        self._pdf_q: "queue.Queue[Optional[_Batch]]" = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max(1, s.pipeline_max_batches))
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+
+        self._shadow_threads = [
+            threading.Thread(target=self._shadow_loop, name=f"stream-shadow-{i}", daemon=True)
+            for i in range(max(1, s.shadow_workers))
+        ]
+        self._pdf_thread = threading.Thread(target=self._pdf_loop, name="stream-pdf", daemon=True)
+        for t in self._shadow_threads + [self._pdf_thread]:
+            t.start()
+
+    def __enter__(self) -> "StreamingPipeline":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def submit(self, paths: List[str]) -> "Future[str]":
+        """Queue a batch; the future resolves to its PDF path. Raises
+        ValueError for an empty batch, which would never reach the PDF stage."""
+        if not paths:
+            raise ValueError("Empty batch")
+        self._slots.acquire()
+        with self._id_lock:
+            self._next_id += 1
+            batch = _Batch(self._next_id, list(paths))
+        try:
+            batch.state_id = mark_processing(self.settings, batch.paths)
+            batch.span.set(batch_id=batch.state_id, state_db=os.path.basename(self.settings.state_db))
+            for i in range(len(batch.paths)):
+                self._bg_pool.submit(self._bg_task, _Job(batch, i))
+        except BaseException as e:
+            batch.span.end(error=e)
+            self._slots.release()
+            raise
+        return batch.future
+
+    def close(self) -> None:
+        """Finish every submitted batch, then stop the stage threads."""
+        self._bg_pool.shutdown(wait=True)
+        for _ in self._shadow_threads:
+            self._shadow_q.put(None)
+        for t in self._shadow_threads:
+            t.join()
+        self._pdf_q.put(None)
+        self._pdf_thread.join()
+
+    # Stage 1: background removal (thread pool sized like the backend)
+    def _bg_task(self, job: _Job) -> None:
+        batch = job.batch
+        if batch.error is not None:
+            self._image_done(job, None)
+            return
+        try:
+            with profiling.section(), tracing.span(
+                "bg.image", batch.span, image=os.path.basename(job.path), backend=self.backend_name
+            ) as span:
+                if self.cache is not None:
+                    job.bg_key = bg_cache_key(self.cache, self.settings, job.path, self.backend_name)
+                    job.shadow_key = shadow_cache_key(self.cache, self.settings, job.bg_key)
+                    cached = self.cache.get("shadow", job.shadow_key)
+                    if cached is not None:
+                        span.set(cached="shadow")
+                        self._bg_finished(batch)
+                        self._image_done(job, cached)
+                        return
+                    job.no_bg = self.cache.get("no_bg", job.bg_key)
+                    if job.no_bg is not None:
+                        span.set(cached="no_bg")
+                if job.no_bg is None:
+                    job.no_bg = self._remove(job)
+            self._bg_finished(batch)
+        except BaseException as e:
+            self._bg_finished(batch)
+            self._image_done(job, None, e)
+            return
+        # Blocks while the shadow stage is behind (backpressure)
+        self._shadow_q.put(job)
+
+    def _remove(self, job: _Job) -> Artifact:
+        s = self.settings
+        try:
+            with STAGE_SECONDS.time(stage="bg"):
+                art = self.backend.remove_background(job.path)
+            if self.cache is not None and job.bg_key:
+                self.cache.put("no_bg", job.bg_key, art)
+        except Exception as e:
+            if not self.fallback:
+                raise
+            batch = job.batch
+            if not batch.fell_back:
+                batch.fell_back = True
+                print(
+                    f"Background backend {self.backend_name} failed ({e}); "
+                    f"using {self.fallback} for batch {batch.batch_id}",
+                    flush=True,
+                )
+            with STAGE_SECONDS.time(stage="bg"):
+                art = get_backend(self.fallback, s).remove_background(job.path)
+            # Fallback cut-outs (and their shadows) must not be cached
+            job.shadow_key = None
+        if s.keep_work_files:
+            os.makedirs(s.work_no_bg_dir, exist_ok=True)
+            work_file = job.batch.work_files[job.index]
+            art.write(os.path.join(s.work_no_bg_dir, work_file), s.png_compress_level)
+        return art
+
+    def _bg_finished(self, batch: _Batch) -> None:
+        with batch.lock:
+            batch.bg_remaining -= 1
+            if batch.bg_remaining == 0:
+                batch.bg_done = time.monotonic()
+
+    # Stage 2: shadow (one thread per SHADOW_WORKERS slot, work in the shared pool)
+    def _shadow_loop(self) -> None:
+        while True:
+            job = self._shadow_q.get()
+            if job is None:
+                return
+            if job.batch.error is not None:
+                self._image_done(job, None)
+                continue
+            try:
+                with profiling.section(), tracing.use(job.batch.span):
+                    art = add_shadow(
+                        job.no_bg,  # type: ignore[arg-type]
+                        encode=self.cache is not None,
+                        work_file=job.batch.work_files[job.index],
+                    )
+                job.no_bg = None
+                if self.cache is not None and job.shadow_key:
+                    self.cache.put("shadow", job.shadow_key, art)
+                self._image_done(job, art)
+            except BaseException as e:
+                self._image_done(job, None, e)
+
+    def _image_done(
+        self, job: _Job, art: Optional[Artifact], error: Optional[BaseException] = None
+    ) -> None:
+        batch = job.batch
+        with batch.lock:
+            batch.outputs[job.index] = art
+            if error is not None and batch.error is None:
+                batch.error = error
+            batch.remaining -= 1
+            last = batch.remaining == 0
+        if last:
+            batch.stages_done = time.monotonic()
+            self._pdf_q.put(batch)
+
+    # Stage 3: PDF
+    def _pdf_loop(self) -> None:
+        while True:
+            batch = self._pdf_q.get()
+            if batch is None:
+                return
+            try:
+                if batch.error is not None:
+                    raise batch.error
+                started = time.monotonic()
+                with profiling.section(), tracing.use(batch.span):
+                    pdf = images_to_pdf_3x3(
+                        batch.outputs,  # type: ignore[arg-type]
+                        self.settings.output_pdf_dir,
+                        settings=self.settings,
+                    )
+                mark_processed(self.settings, batch.paths, batch.state_id)
+                BATCHES_PROCESSED.inc()
+                IMAGES_PROCESSED.inc(len(batch.paths))
+                done = time.monotonic()
+                print(
+                    f"Batch {batch.batch_id} ({len(batch.paths)} images): {pdf} in "
+                    f"{done - batch.submitted:.1f}s (bg {batch.bg_done - batch.submitted:.1f}s, "
+                    f"shadow +{max(0.0, batch.stages_done - batch.bg_done):.1f}s, "
+                    f"pdf wait {started - batch.stages_done:.1f}s, pdf {done - started:.1f}s)",
+                    flush=True,
+                )
+                batch.span.set(pdf=os.path.basename(pdf))
+                batch.span.end()
+                batch.future.set_result(pdf)
+            except BaseException as e:
+                batch.span.end(error=e)
+                batch.future.set_exception(e)
+            finally:
+                batch.outputs = []
+                profiling.batch_done()
+                self._slots.release()
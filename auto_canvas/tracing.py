@@ -0,0 +1,205 @@
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from .config import load_settings
+
+
+# Spans of batches, images and watcher polls, appended as JSON lines to
+# TRACE_FILE. A span without a parent starts a new trace; its id ties the
+# spans of one batch together, also across threads (pass the batch span as
+# `parent`). Each line: trace, span, parent, name, start (epoch seconds),
+# ms, pid, thread, error and the span's attributes.
+
+_IDS = itertools.count(1)
+_LOCAL = threading.local()
+_WRITE_LOCK = threading.Lock()
+_FILE = None
+_FILE_PATH = ""
+_FILE_CHECKED = 0.0
+# How often a writer checks that another process has not rotated its file
+_ROTATE_CHECK_SECONDS = 1.0
+
+
+def _new_id() -> str:
+    return f"{os.getpid():x}-{next(_IDS):x}"
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"] = None, **attrs: object) -> None:
+        self.name = name
+        self.span_id = _new_id()
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs: Dict[str, object] = attrs
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+
+    def set(self, **attrs: object) -> None:
+        self.attrs.update(attrs)
+
+    def end(self, error: Optional[BaseException] = None, duration: Optional[float] = None) -> None:
+        seconds = time.perf_counter() - self._t0 if duration is None else duration
+        record: Dict[str, object] = {
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "ms": round(seconds * 1000, 3),
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+        }
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        record.update(self.attrs)
+        _write(record)
+
+
+class _NoSpan(Span):
+    """Stand-in while tracing is off: nothing is measured or written."""
+
+    def __init__(self) -> None:
+        self.name = ""
+        self.span_id = self.trace_id = ""
+        self.parent_id = None
+        self.attrs = {}
+
+    def set(self, **attrs: object) -> None:
+        pass
+
+    def end(self, error: Optional[BaseException] = None, duration: Optional[float] = None) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enabled() -> bool:
+    return bool(load_settings().trace_file)
+
+
+def current() -> Optional[Span]:
+    """Innermost open span of this thread."""
+    stack: List[Span] = getattr(_LOCAL, "stack", [])
+    return stack[-1] if stack else None
+
+
+def start(name: str, parent: Optional[Span] = None, **attrs: object) -> Span:
+    """Open a span that the caller ends, e.g. from another thread; the parent
+    defaults to the current span."""
+    if not enabled():
+        return _NO_SPAN
+    return Span(name, parent if parent is not None else current(), **attrs)
+
+
+@contextmanager
+def use(span: Optional[Span]) -> Iterator[None]:
+    """Make `span` the current span of this thread for the block."""
+    if span is None:
+        yield
+        return
+    stack: List[Span] = getattr(_LOCAL, "stack", None) or []
+    _LOCAL.stack = stack
+    stack.append(span)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+@contextmanager
+def span(name: str, parent: Optional[Span] = None, **attrs: object) -> Iterator[Span]:
+    """Time the block as a span, child of `parent` or of the current span."""
+    s = start(name, parent, **attrs)
+    if s is _NO_SPAN:
+        yield s
+        return
+    with use(s):
+        try:
+            yield s
+        except BaseException as e:
+            s.end(error=e)
+            raise
+    s.end()
+
+
+def record(
+    name: str, started: float, seconds: float, parent: Optional[Span] = None, **attrs: object
+) -> None:
+    """Write a span measured elsewhere (e.g. in a pool worker) that began at
+    epoch `started` and lasted `seconds`."""
+    s = start(name, parent, **attrs)
+    if s is not _NO_SPAN:
+        s.start = started
+        s.end(duration=seconds)
+
+
+def _rotated_away() -> bool:
+    global _FILE_CHECKED
+    now = time.monotonic()
+    if now - _FILE_CHECKED < _ROTATE_CHECK_SECONDS:
+        return False
+    _FILE_CHECKED = now
+    try:
+        return os.stat(_FILE_PATH).st_ino != os.fstat(_FILE.fileno()).st_ino  # type: ignore[union-attr]
+    except OSError:
+        return True
+
+
+def _write(record: Dict[str, object]) -> None:
+    global _FILE, _FILE_PATH
+    s = load_settings()
+    if not s.trace_file:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _WRITE_LOCK:
+        try:
+            if _FILE is None or _FILE_PATH != s.trace_file or _rotated_away():
+                if _FILE is not None:
+                    _FILE.close()
+                os.makedirs(os.path.dirname(s.trace_file) or ".", exist_ok=True)
+                _FILE = open(s.trace_file, "a", encoding="utf-8")
+                _FILE_PATH = s.trace_file
+            _FILE.write(line)
+            _FILE.flush()
+            if s.trace_max_mb > 0 and _FILE.tell() > s.trace_max_mb << 20:
+                # Keep one previous file; other writers notice and reopen
+                _FILE.close()
+                _FILE = None
+                os.replace(s.trace_file, s.trace_file + ".1")
+        except OSError as e:
+            _FILE = None
+            print(f"Trace write failed: {e}", flush=True)
+
+
+def read_spans(
+    trace_id: str = "", limit: int = 500, path: Optional[str] = None
+) -> List[Dict[str, object]]:
+    """Latest spans of TRACE_FILE, or every span of one trace (read from the
+    end, so recent batches are found fast)."""
+    path = path or load_settings().trace_file
+    if not path:
+        return []
+    out: List[Dict[str, object]] = []
+    for candidate in (path, path + ".1"):
+        try:
+            with open(candidate, "rb") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for raw in reversed(lines):
+            try:
+                item = json.loads(raw)
+            except ValueError:
+                continue
+            if trace_id and item.get("trace") != trace_id:
+                continue
+            out.append(item)
+            if len(out) >= limit:
+                return out[::-1]
+    return out[::-1]
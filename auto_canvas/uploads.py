@@ -0,0 +1,161 @@
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from . import tracing
+from .config import Settings, load_settings
+from .gdrive import _service, find_by_app_property, upload_file
+from .metrics import QUEUE_DEPTH, STAGE_SECONDS
+from .state import StateStore, get_state_store
+
+
+# Retry delays of a failed upload: doubling from the base, capped, with jitter
+RETRY_BASE_SECONDS = 5.0
+RETRY_MAX_SECONDS = 900.0
+# Longest sleep of the worker; also bounds how late a row added by another
+# process is noticed
+IDLE_WAKE_SECONDS = 60.0
+# appProperties key marking files uploaded from the queue
+UPLOAD_PROPERTY = "auto_canvas_upload"
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+
+class UploadQueue:
+    """Persistent queue of files to upload to Drive, drained by a background thread.
+
+    `enqueue` records the upload in the state store and returns at once, so a
+    batch counts as done without waiting for Drive; pending uploads survive
+    restarts and are retried with exponential backoff until they succeed.
+    Every upload is tagged with a token in its appProperties, and counted in
+    the row before it starts: after a crash between the end of an upload and
+    its removal from the queue, the token finds the file on Drive instead of
+    uploading it twice.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        chunk_mb: int = 8,
+        service: Optional[Callable[[], object]] = None,
+        name: str = "",
+    ) -> None:
+        self.store = store
+        # Folder label of the queue-depth metric, like the watchers'
+        self.name = name or "default"
+        self.chunk_mb = chunk_mb
+        self._service = service or _service
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gdrive-upload", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, path: str, folder_id: str, mime_type: str = "application/pdf") -> int:
+        upload_id = self.store.add_upload(path, folder_id, mime_type)
+        with self._lock:
+            self._idle.clear()
+            self._wake.set()
+        self.start()
+        return upload_id
+
+    def pending(self) -> int:
+        return self.store.pending_uploads()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Wait until nothing is due (pending uploads may still be backing off)."""
+        return self._idle.wait(timeout)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                QUEUE_DEPTH.set(self.pending(), queue="uploads", folder=self.name)
+                rows = self.store.due_uploads(time.time())
+                for row in rows:
+                    self._upload(*row)
+                if rows:
+                    continue
+                with self._lock:
+                    # Not idle if an upload was enqueued since the query
+                    if not self._wake.is_set():
+                        self._idle.set()
+                next_try = self.store.next_upload_at()
+                wait_s = IDLE_WAKE_SECONDS
+                if next_try is not None:
+                    wait_s = min(wait_s, max(0.0, next_try - time.time()))
+            except Exception as e:
+                print(f"Upload queue error: {e}", flush=True)
+                wait_s = RETRY_BASE_SECONDS
+            self._wake.wait(wait_s)
+
+    def _upload(
+        self, upload_id: int, path: str, folder_id: str, mime_type: str, token: str, attempts: int
+    ) -> None:
+        if not os.path.exists(path):
+            print(f"Upload of {path} dropped: file no longer exists", flush=True)
+            self.store.finish_upload(upload_id)
+            return
+        t0 = time.perf_counter()
+        try:
+            with tracing.span(
+                "drive.upload", file=os.path.basename(path), attempt=attempts + 1
+            ) as span:
+                svc = self._service()
+                file_id = None
+                if attempts:
+                    # An earlier attempt (maybe of a process that crashed) may
+                    # have reached Drive before it could remove the row
+                    file_id = find_by_app_property(UPLOAD_PROPERTY, token, folder_id, svc)
+                    span.set(found=file_id is not None)
+                if file_id is None:
+                    self.store.start_upload(upload_id)
+                    file_id = upload_file(
+                        path, folder_id, mime_type, self.chunk_mb,
+                        app_properties={UPLOAD_PROPERTY: token}, service=svc,
+                    )
+        except Exception as e:
+            delay = retry_delay(attempts)
+            self.store.retry_upload(upload_id, str(e), time.time() + delay)
+            print(
+                f"Upload of {os.path.basename(path)} failed (attempt {attempts + 1}): {e}; "
+                f"retrying in {delay:.0f}s",
+                flush=True,
+            )
+            return
+        self.store.finish_upload(upload_id)
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage="upload")
+        print(
+            f"Uploaded {os.path.basename(path)} to Drive folder {folder_id} "
+            f"({file_id}, {time.perf_counter() - t0:.1f}s)",
+            flush=True,
+        )
+
+
+_QUEUES: Dict[str, UploadQueue] = {}
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_upload_queue(settings: Optional[Settings] = None, name: str = "") -> UploadQueue:
+    """Process-wide queue of the state store, started (resuming uploads left
+    by an earlier run) on first use. `name` is the watched folder's."""
+    s = settings or load_settings()
+    store = get_state_store(s)
+    with _QUEUE_LOCK:
+        queue = _QUEUES.get(store.path)
+        if queue is None:
+            queue = _QUEUES[store.path] = UploadQueue(store, s.gdrive_upload_chunk_mb, name=name)
+            left = queue.pending()
+            if left:
+                print(f"{left} Drive upload(s) left by the last run will be resumed", flush=True)
+            queue.start()
+        return queue
@@ -1,7 +1,7 @@
 import json
 import os
 import time
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
@@ -26,11 +26,14 @@ def sort_by_ctime(paths: List[str]) -> List[str]:
     return sorted(paths, key=lambda p: os.path.getctime(p))
 
 
+def stat_signature(st: os.stat_result) -> str:
+    return f"{st.st_size}:{int(st.st_mtime)}:{int(getattr(st, 'st_ctime', st.st_mtime))}"
+
+
 def file_signature(path: str) -> str:
     """Signature d'un fichier: taille + mtime + ctime pour distinguer réapparitions et duplications."""
     try:
-        st = os.stat(path)
-        return f"{st.st_size}:{int(st.st_mtime)}:{int(getattr(st, 'st_ctime', st.st_mtime))}"
+        return stat_signature(os.stat(path))
     except FileNotFoundError:
         return ""
 
@@ -60,35 +63,52 @@ def save_state(state_file: str, state: Dict) -> None:
     os.replace(tmp, state_file)
 
 
-def wait_until_stable(
-    paths: List[str], stability_seconds: int = 3, check_interval: float = 1.0
-) -> List[str]:
-    """Return subset of paths that are stable (size unchanged for stability_seconds)."""
-    now = time.time()
-    initial_sizes: Dict[str, Tuple[int, float]] = {}
-    for p in paths:
-        try:
-            initial_sizes[p] = (os.path.getsize(p), now)
-        except FileNotFoundError:
-            continue
-
-    time.sleep(check_interval)
-
-    stable: List[str] = []
-    for p in paths:
-        try:
-            size1, t0 = initial_sizes.get(p, (None, None))
-            size2 = os.path.getsize(p)
-            if size1 is not None and size1 == size2:
-                # Passed first check; wait remaining time
-                remaining = max(0.0, stability_seconds - check_interval)
-                time.sleep(remaining)
-                size3 = os.path.getsize(p)
-                if size3 == size2:
-                    stable.append(p)
-        except FileNotFoundError:
-            continue
-    return stable
+class StabilityTracker:
+    """Remembers each candidate's size/mtime across polls (or file events).
+
+    A file is ready once its signature has not changed for `stability_seconds`.
+    `observe` only stats (or reads signatures) and never sleeps, so all
+    candidates are evaluated together and a file that finished copying long
+    ago is ready on the first poll after its window, whatever its position in
+    the batch.
+    """
+
+    def __init__(self, stability_seconds: float) -> None:
+        self.stability_seconds = stability_seconds
+        # path -> (signature, monotonic time it was first seen with it)
+        self._seen: Dict[str, Tuple[str, float]] = {}
+
+    def observe(
+        self, paths: List[str], signature: Callable[[str], str] = file_signature
+    ) -> List[str]:
+        """Record the current signatures; return the stable paths, in order.
+
+        Files no longer among `paths` are forgotten.
+        """
+        now = time.monotonic()
+        seen: Dict[str, Tuple[str, float]] = {}
+        stable: List[str] = []
+        for p in paths:
+            sig = signature(p)
+            if not sig:
+                continue
+            prev = self._seen.get(p)
+            since = prev[1] if prev is not None and prev[0] == sig else now
+            seen[p] = (sig, since)
+            if now - since >= self.stability_seconds:
+                stable.append(p)
+        self._seen = seen
+        return stable
+
+    def next_ready_in(self, paths: List[str]) -> float:
+        """Seconds until every one of `paths` may be stable (0 if already)."""
+        now = time.monotonic()
+        waits = [
+            self.stability_seconds - (now - self._seen[p][1]) if p in self._seen
+            else self.stability_seconds
+            for p in paths
+        ]
+        return max([0.0] + waits)
 
 
 def chunk(items: List[str], n: int) -> List[List[str]]:
@@ -99,35 +119,15 @@ def file_basename_without_ext(path: str) -> str:
     return os.path.splitext(os.path.basename(path))[0]
 
 
-def prune_state_absent_files(state_file: str, existing_files: List[str]) -> None:
-    """Remove entries from state for files that no longer exist in INPUT_DIR.
-
-    This allows a later re-copy of the same filename to be considered NEW again.
-    """
-    existing_set = set(existing_files)
-    state = load_state(state_file)
-    changed = False
-
-    processed = state.get("processed", [])
-    new_processed = [p for p in processed if p in existing_set]
-    if new_processed != processed:
-        state["processed"] = new_processed
-        changed = True
-
-    processing = state.get("processing", [])
-    new_processing = [p for p in processing if p in existing_set]
-    if new_processing != processing:
-        state["processing"] = new_processing
-        changed = True
-
-    processed_signatures = state.get("processed_signatures", {})
-    new_signatures = {
-        p: sig for p, sig in processed_signatures.items() if p in existing_set
-    }
-    if new_signatures != processed_signatures:
-        state["processed_signatures"] = new_signatures
-        changed = True
-
-    if changed:
-        save_state(state_file, state)
-
+def unique_output_paths(input_paths: List[str], out_dir: str, ext: str = ".png") -> List[str]:
+    """Map inputs to `out_dir/<basename><ext>`, suffixing repeated basenames so they don't collide."""
+    seen: Dict[str, int] = {}
+    outputs: List[str] = []
+    for p in input_paths:
+        name = file_basename_without_ext(p)
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count:
+            name = f"{name}_{count}"
+        outputs.append(os.path.join(out_dir, f"{name}{ext}"))
+    return outputs
@@ -1,86 +1,290 @@
 import os
+import threading
 import time
-from typing import List
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
-from .config import load_settings
-from .utils import list_image_files, wait_until_stable, load_state, save_state, sort_by_ctime, file_signature, prune_state_absent_files
-from .pipeline import process_batch
+from . import tracing
+from .config import Settings, install_reload_signal, load_settings, reload_if_env_changed
+from .utils import StabilityTracker, list_image_files, sort_by_ctime, file_signature
+from .dedup import drop_duplicates
+from .fsindex import DirectoryIndex, start_directory_index
+from .metrics import QUEUE_DEPTH, QUEUE_SECONDS, QUEUE_TIME
+from .pipeline import mark_processed, process_batch
+from .state import get_state_store
+from .stream import StreamingPipeline
 
 
-def collect_new_images() -> List[str]:
-    settings = load_settings()
-    state = load_state(settings.state_file)
-    processed = set(state.get("processed", []))
-    processed_signatures = state.get("processed_signatures", {})
-    candidates = sort_by_ctime(list_image_files(settings.input_dir))
+# Longest sleep between two scans when nothing is pending and file events
+# are on: events wake the watcher earlier, this only bounds `.env` reloads
+IDLE_WAKE_SECONDS = 30
+
+
+def collect_new_images(
+    index: Optional[DirectoryIndex] = None, settings: Optional[Settings] = None
+) -> List[str]:
+    """Unprocessed (or changed since processed) images, oldest first.
+
+    With a `DirectoryIndex` the listing and signatures come from memory.
+    """
+    settings = settings or load_settings()
+    store = get_state_store(settings)
+    if index is not None:
+        candidates = index.paths()
+        signature = index.signature
+    else:
+        candidates = sort_by_ctime(list_image_files(settings.input_dir))
+        signature = file_signature
+    known = store.lookup(candidates)
     new_files: List[str] = []
-    changed = False
+    baselines: Dict[str, str] = {}
     for p in candidates:
-        sig = file_signature(p)
-        prev_sig = processed_signatures.get(p)
-        if p not in processed:
+        status, prev_sig = known.get(p, ("", None))
+        if status != "processed":
             new_files.append(p)
             continue
+        sig = signature(p)
         # p is in processed: ensure we have a baseline signature
         if not prev_sig and sig:
-            processed_signatures[p] = sig
-            changed = True
+            baselines[p] = sig
         # If signature changed since baseline, treat as new
         if prev_sig and sig and sig != prev_sig:
             new_files.append(p)
-    if changed:
-        state["processed_signatures"] = processed_signatures
-        save_state(settings.state_file, state)
+    store.set_signatures(baselines)
     return new_files
 
 
+class FolderWatcher:
+    """Pending-file bookkeeping of one local input folder.
+
+    Lists the folder (from file events when WATCH_EVENTS is on), tracks each
+    file's stability and the partial-batch deadline, and hands out ready
+    batches oldest first. Files of a handed-out batch are ignored until
+    `release`; if the batch failed they are then new again and retried.
+    """
+
+    def __init__(self, settings: Settings, name: str = "") -> None:
+        self.settings = settings
+        self.name = name
+        self.index: Optional[DirectoryIndex] = None
+        if settings.watch_events:
+            self.index = start_directory_index(
+                settings.input_dir, settings.watch_reconcile_seconds
+            )
+        self.tracker = StabilityTracker(settings.stability_seconds)
+        self._inflight: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def log(self, msg: str) -> None:
+        print(f"[{self.name}] {msg}" if self.name else msg, flush=True)
+
+    def update_settings(self, settings: Settings) -> None:
+        self.settings = settings
+        self.tracker.stability_seconds = settings.stability_seconds
+
+    def _signature(self, path: str) -> str:
+        return self.index.signature(path) if self.index is not None else file_signature(path)
+
+    def _arrived(self, path: str) -> float:
+        ctime = self.index.ctime(path) if self.index is not None else None
+        if ctime is None:
+            try:
+                ctime = os.path.getctime(path)
+            except OSError:
+                ctime = time.time()
+        return ctime
+
+    def _flush_in(self, pending: List[str]) -> Optional[float]:
+        """Seconds before the oldest pending file forces a partial batch."""
+        if not pending or self.settings.batch_max_wait_seconds <= 0:
+            return None
+        return self.settings.batch_max_wait_seconds - (time.time() - self._arrived(pending[0]))
+
+    def _batch_due(self, pending: List[str]) -> bool:
+        if len(pending) >= self.settings.batch_size:
+            return True
+        flush_in = self._flush_in(pending)
+        return flush_in is not None and flush_in <= 0
+
+    def _record_queue_time(self, batch: List[str]) -> None:
+        now = time.time()
+        for p in batch:
+            waited = max(0.0, now - self._arrived(p))
+            QUEUE_TIME.observe(waited)
+            QUEUE_SECONDS.observe(waited)
+        self.log(QUEUE_TIME.describe())
+
+    def poll(self, max_batches: Optional[int] = None) -> Tuple[List[List[str]], float]:
+        """Ready batches (now in flight) and how long to wait before the next poll.
+
+        A batch is the `batch_size` oldest pending files, or fewer once the
+        oldest waited BATCH_MAX_WAIT_SECONDS; all of them must be stable.
+        """
+        with tracing.span("watch.poll", folder=self.name or "default") as span:
+            batches, wait_s = self._poll(max_batches)
+            span.set(batches=len(batches))
+        return batches, wait_s
+
+    def _poll(self, max_batches: Optional[int]) -> Tuple[List[List[str]], float]:
+        s = self.settings
+        # First, prune state for files no longer present, so re-copied files are treated as new
+        if self.index is not None:
+            self.index.maybe_reconcile()
+            current_files = self.index.paths()
+        else:
+            current_files = sort_by_ctime(list_image_files(s.input_dir))
+        get_state_store(s).prune_absent(current_files)
+
+        new_files = collect_new_images(self.index, s)
+        with self._lock:
+            pending = [p for p in new_files if p not in self._inflight]
+        # Every pending file gets a stability history, even before a batch fills
+        ready = set(self.tracker.observe(pending, self._signature))
+        self.log(f"New files detected: {len(pending)}")
+
+        batches: List[List[str]] = []
+        wait_s: Optional[float] = None
+        while self._batch_due(pending) and (max_batches is None or len(batches) < max_batches):
+            batch = pending[: s.batch_size]
+            stable = [p for p in batch if p in ready]
+            self.log(f"Stable images: {len(stable)}/{len(batch)}")
+            if len(stable) < len(batch):
+                # Oldest batch not stable yet; come back when its window ends
+                wait_s = min(
+                    float(s.poll_interval_seconds), max(0.1, self.tracker.next_ready_in(batch))
+                )
+                break
+            kept, skipped = drop_duplicates(s, batch)
+            if skipped:
+                # Never billed; refill the batch from the next files
+                mark_processed(s, skipped)
+                dropped = set(skipped)
+                pending = [p for p in pending if p not in dropped]
+                continue
+            if len(kept) < s.batch_size:
+                self.log(
+                    f"Flushing partial batch of {len(kept)} image(s): oldest "
+                    f"waited over {s.batch_max_wait_seconds}s"
+                )
+            self._record_queue_time(kept)
+            with self._lock:
+                self._inflight.update(kept)
+            batches.append(kept)
+            pending = pending[len(batch):]
+        QUEUE_DEPTH.set(len(pending), queue="images", folder=self.name or "default")
+
+        if wait_s is None:
+            flush_in = self._flush_in(pending)
+            with self._lock:
+                busy = bool(batches or self._inflight)
+            if busy or self.index is None:
+                wait_s = float(s.poll_interval_seconds)
+            else:
+                wait_s = float(IDLE_WAKE_SECONDS)
+            if flush_in is not None:
+                wait_s = min(wait_s, max(0.1, flush_in))
+                if not batches:
+                    self.log(
+                        f"Waiting for files... partial batch of {len(pending)} "
+                        f"in {max(0.0, flush_in):.0f}s"
+                    )
+            elif not batches:
+                self.log("Waiting for files...")
+        return batches, wait_s
+
+    def run_batch(self, batch: List[str]) -> str:
+        return process_batch(batch, settings=self.settings)
+
+    def release(self, batch: List[str]) -> None:
+        with self._lock:
+            self._inflight.difference_update(batch)
+
+    def wait(self, seconds: float) -> None:
+        """Sleep up to `seconds`; file events end the wait early."""
+        if self.index is not None:
+            self.index.wait(seconds)
+        else:
+            time.sleep(min(seconds, self.settings.poll_interval_seconds))
+
+    def close(self) -> None:
+        if self.index is not None:
+            self.index.stop()
+
+
+def _submit_streaming(
+    pipeline: StreamingPipeline, batch: List[str], release: Callable[[List[str]], None]
+) -> None:
+    """Hand the batch to the streaming pipeline and return without waiting.
+
+    Its files are ignored by the scan until the batch finishes; if it fails
+    they become new again and are retried on a later poll.
+    """
+    future = pipeline.submit(batch)
+
+    def _done(fut: Future) -> None:
+        release(batch)
+        err = fut.exception()
+        if err is not None:
+            print(f"Pipeline error: {err}", flush=True)
+        else:
+            print(f"Done: {fut.result()}", flush=True)
+
+    future.add_done_callback(_done)
+
+
 def run_watcher() -> None:
     settings = load_settings()
     print(f"Watching: {settings.input_dir} (batch={settings.batch_size})", flush=True)
+    pipeline: Optional[StreamingPipeline] = None
+    watcher = FolderWatcher(settings)
+
+    install_reload_signal()
+    interrupted = get_state_store(settings).clear_inflight()
+    if interrupted:
+        print(f"{interrupted} batch(es) interrupted by the last stop will be redone", flush=True)
     while True:
         try:
-            # First, prune state for files no longer present, so re-copied files are treated as new
-            current_files = sort_by_ctime(list_image_files(settings.input_dir))
-            prune_state_absent_files(settings.state_file, current_files)
-
-            new_files = collect_new_images()
-            print(f"New files detected: {len(new_files)}", flush=True)
-            if len(new_files) >= settings.batch_size:
-                # Process as many full batches as available, always oldest first
-                while True:
-                    new_files = collect_new_images()
-                    if len(new_files) < settings.batch_size:
-                        break
-                    print("Evaluating oldest batch of 9 for stability...", flush=True)
-                    batch = new_files[: settings.batch_size]
-                    stable = wait_until_stable(
-                        batch,
-                        stability_seconds=settings.stability_seconds,
-                        check_interval=1.0,
-                    )
-                    print(f"Stable images: {len(stable)}/{settings.batch_size}", flush=True)
-                    if len(stable) == settings.batch_size:
-                        print("Batch ready. Processing...", flush=True)
-                        try:
-                            pdf = process_batch(stable)
-                            print(f"Done: {pdf}", flush=True)
-                        except Exception as e:
-                            print(f"Pipeline error: {e}", flush=True)
-                            # Stop inner loop to avoid busy retry; will retry next poll
-                            break
-                        # Loop again in case more than one batch is ready
-                        continue
-                    else:
-                        # Oldest batch not stable yet; wait before retry
-                        break
-                print(f"Sleeping {settings.poll_interval_seconds}s...", flush=True)
-                time.sleep(settings.poll_interval_seconds)
-            else:
-                # Not enough files yet
-                print(f"Waiting for files... Sleeping {settings.poll_interval_seconds}s", flush=True)
-                time.sleep(settings.poll_interval_seconds)
+            if reload_if_env_changed():
+                settings = load_settings()
+                watcher.update_settings(settings)
+                if pipeline is not None:
+                    # Workers, queues, backend and cache are set at creation:
+                    # finish the batches in flight, then rebuild on the next one
+                    pipeline.close()
+                    pipeline = None
+            batches, wait_s = watcher.poll()
+            for i, batch in enumerate(batches):
+                print("Batch ready. Processing...", flush=True)
+                if settings.pipeline_streaming:
+                    # Blocks only while PIPELINE_MAX_BATCHES are in flight
+                    if pipeline is None:
+                        pipeline = StreamingPipeline(settings=settings)
+                    try:
+                        _submit_streaming(pipeline, batch, watcher.release)
+                    except BaseException:
+                        for rest in batches[i:]:
+                            watcher.release(rest)
+                        raise
+                    continue
+                try:
+                    pdf = process_batch(batch, settings=settings)
+                    print(f"Done: {pdf}", flush=True)
+                except Exception as e:
+                    print(f"Pipeline error: {e}", flush=True)
+                    # Stop here to avoid busy retry; will retry next poll
+                    for rest in batches[i + 1:]:
+                        watcher.release(rest)
+                    break
+                finally:
+                    watcher.release(batch)
+            if batches:
+                print(f"Sleeping {wait_s:.1f}s...", flush=True)
+            watcher.wait(wait_s)
         except KeyboardInterrupt:
             print("Stopped by user.", flush=True)
+            if pipeline is not None:
+                pipeline.close()
+            watcher.close()
             break
         except Exception as e:
             print(f"Error in watcher: {e}", flush=True)
@@ -89,5 +293,3 @@ def run_watcher() -> None:
 
 if __name__ == "__main__":
     run_watcher()
-
-
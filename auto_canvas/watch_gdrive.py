@@ -1,11 +1,160 @@
 import os
+import threading
 import time
-from typing import List
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
 
-from .config import load_settings
-from .gdrive import list_images_in_folder, download_file, upload_file
-from .utils import load_state, save_state, file_signature
+from . import tracing
+from .config import Settings, install_reload_signal, load_settings, reload_if_env_changed
+from .gdrive import DriveFolderFeed, Downloader
+from .state import get_state_store
+from .dedup import drop_duplicates
+from .metrics import QUEUE_DEPTH, QUEUE_SECONDS, QUEUE_TIME
 from .pipeline import process_batch
+from .uploads import get_upload_queue
+
+
+def _created_at(f: Dict) -> float:
+    try:
+        return datetime.fromisoformat(f["createdTime"]).timestamp()
+    except (KeyError, ValueError):
+        return time.time()
+
+
+class DriveFolderWatcher:
+    """Pending-file bookkeeping of one Drive input folder and its output folder.
+
+    Same interface as `watch.FolderWatcher`: `poll` hands out batches of
+    Drive file ids, `run_batch` downloads, processes and uploads one.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        input_folder_id: str,
+        output_folder_id: str,
+        name: str = "",
+        staging_dir: Optional[str] = None,
+    ) -> None:
+        self.settings = settings
+        self.input_folder_id = input_folder_id
+        self.output_folder_id = output_folder_id
+        self.name = name
+        self.staging_dir = staging_dir or settings.input_dir
+        # Resumes uploads left by an earlier run right away
+        self.uploads = get_upload_queue(settings, name)
+        self.downloader = Downloader(
+            self.staging_dir, settings.gdrive_download_workers, settings.gdrive_chunk_mb
+        )
+        self.feed = DriveFolderFeed(
+            input_folder_id, get_state_store(settings), settings.gdrive_resync_seconds
+        )
+        # Drive file id -> arrival time (upload time, else first seen)
+        self._arrived: Dict[str, float] = {}
+        self._inflight: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def log(self, msg: str) -> None:
+        print(f"[{self.name}] {msg}" if self.name else msg, flush=True)
+
+    def update_settings(self, settings: Settings) -> None:
+        self.settings = settings
+        self.feed.resync_seconds = settings.gdrive_resync_seconds
+        self.uploads.chunk_mb = settings.gdrive_upload_chunk_mb
+
+    def poll(self, max_batches: Optional[int] = None) -> Tuple[List[List[str]], float]:
+        with tracing.span("watch.poll", folder=self.name or "default", drive=True) as span:
+            batches, wait_s = self._poll(max_batches)
+            span.set(batches=len(batches))
+        return batches, wait_s
+
+    def _poll(self, max_batches: Optional[int]) -> Tuple[List[List[str]], float]:
+        s = self.settings
+        images = self.feed.images()
+        now = time.time()
+        # Processed Drive file ids, looked up for this listing only
+        processed_ids = get_state_store(s).drive_processed([f["id"] for f in images])
+        todo_ids: List[str] = []
+        with self._lock:
+            for f in images:
+                fid = f["id"]
+                if fid in processed_ids or fid in self._inflight:
+                    continue
+                todo_ids.append(fid)
+                self._arrived.setdefault(fid, _created_at(f))
+            # Forget files removed from the folder before being processed
+            gone = self._arrived.keys() - set(todo_ids)
+            self._arrived = {fid: self._arrived[fid] for fid in todo_ids}
+        self.downloader.discard(gone)
+
+        batches: List[List[str]] = []
+        while todo_ids and (max_batches is None or len(batches) < max_batches):
+            oldest_wait = max(now - self._arrived[fid] for fid in todo_ids)
+            overdue = 0 < s.batch_max_wait_seconds <= oldest_wait
+            if len(todo_ids) < s.batch_size and not overdue:
+                break
+            batch_ids = todo_ids[: s.batch_size]
+            todo_ids = todo_ids[s.batch_size:]
+            if len(batch_ids) < s.batch_size:
+                self.log(
+                    f"Flushing partial batch of {len(batch_ids)} image(s): oldest "
+                    f"waited {oldest_wait:.0f}s"
+                )
+            with self._lock:
+                for fid in batch_ids:
+                    waited = max(0.0, now - self._arrived.pop(fid))
+                    QUEUE_TIME.observe(waited)
+                    QUEUE_SECONDS.observe(waited)
+                self._inflight.update(batch_ids)
+            self.log(QUEUE_TIME.describe())
+            batches.append(batch_ids)
+        QUEUE_DEPTH.set(len(todo_ids), queue="images", folder=self.name or "default")
+        # Download what was handed out, then the next batch, while batches run
+        for batch_ids in batches:
+            self.downloader.prefetch(batch_ids)
+        self.downloader.prefetch(todo_ids[: s.batch_size])
+        if not batches:
+            self.log(f"Waiting for files... Sleeping {s.poll_interval_seconds}s")
+        return batches, float(s.poll_interval_seconds)
+
+    def run_batch(self, batch_ids: List[str]) -> str:
+        """Download and process one batch and queue its PDF for upload; returns
+        the PDF path ("" if every image was a skipped duplicate)."""
+        s = self.settings
+        with tracing.span("drive.batch", folder=self.name or "default", files=len(batch_ids)):
+            t0 = time.perf_counter()
+            # Only the wait shows here: prefetched files were downloaded earlier
+            with tracing.span("drive.fetch"):
+                local_paths = self.downloader.fetch(batch_ids)
+            self.log(
+                f"Downloaded {len(local_paths)} file(s) to {self.staging_dir} "
+                f"({time.perf_counter() - t0:.1f}s waited)"
+            )
+
+            with tracing.span("dedup"):
+                local_paths, skipped = drop_duplicates(s, local_paths)
+            pdf = ""
+            if local_paths:
+                pdf = process_batch(local_paths, settings=s)
+                self.log(f"Done: {pdf}")
+
+                # Uploaded in the background; recorded before the batch counts as done
+                self.uploads.enqueue(pdf, self.output_folder_id, mime_type="application/pdf")
+                self.log(f"PDF queued for upload to Drive folder: {self.output_folder_id}")
+
+            # Mark processed ids
+            get_state_store(s).mark_drive_processed(batch_ids)
+        return pdf
+
+    def release(self, batch_ids: List[str]) -> None:
+        with self._lock:
+            self._inflight.difference_update(batch_ids)
+
+    def wait(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+    def close(self) -> None:
+        self.downloader.close()
 
 
 def run_gdrive_watcher() -> None:
@@ -16,45 +165,26 @@ def run_gdrive_watcher() -> None:
         raise RuntimeError("GDRIVE_INPUT_FOLDER_ID and GDRIVE_OUTPUT_FOLDER_ID must be set")
 
     print(f"Watching Google Drive folder: {input_folder_id} (batch={s.batch_size})", flush=True)
+    watcher = DriveFolderWatcher(s, input_folder_id, output_folder_id)
+    install_reload_signal()
     while True:
         try:
-            images = list_images_in_folder(input_folder_id)
-            # Map to local staging paths by id
-            todo_ids: List[str] = []
-
-            # Load state (keep processed Drive file ids)
-            st = load_state(s.state_file)
-            processed_ids = set(st.get("processed_drive_ids", []))
-
-            for f in images:
-                fid = f["id"]
-                if fid in processed_ids:
-                    continue
-                todo_ids.append(fid)
-
-            if len(todo_ids) >= s.batch_size:
-                batch_ids = todo_ids[: s.batch_size]
-                local_paths: List[str] = []
-                for fid in batch_ids:
-                    dest = os.path.join(s.input_dir, f"gdrive_{fid}.bin")
-                    print(f"Downloading {fid} -> {dest}", flush=True)
-                    download_file(fid, dest)
-                    local_paths.append(dest)
-
-                pdf = process_batch(local_paths)
-                print(f"Done: {pdf}", flush=True)
-
-                # Upload result PDF
-                print(f"Uploading PDF to Drive folder: {output_folder_id}", flush=True)
-                upload_file(pdf, output_folder_id, mime_type="application/pdf")
-
-                # Mark processed ids
-                processed_ids.update(batch_ids)
-                st["processed_drive_ids"] = sorted(processed_ids)
-                save_state(s.state_file, st)
-            else:
-                print(f"Waiting for files... Sleeping {s.poll_interval_seconds}s", flush=True)
-                time.sleep(s.poll_interval_seconds)
+            if reload_if_env_changed():
+                s = load_settings()
+                watcher.update_settings(s)
+            batches, wait_s = watcher.poll()
+            for i, batch_ids in enumerate(batches):
+                try:
+                    watcher.run_batch(batch_ids)
+                except BaseException:
+                    # Retried on a later poll, like the rest of this listing
+                    for rest in batches[i + 1:]:
+                        watcher.release(rest)
+                    raise
+                finally:
+                    watcher.release(batch_ids)
+            if not batches:
+                watcher.wait(wait_s)
         except KeyboardInterrupt:
             print("Stopped by user.", flush=True)
             break
@@ -65,5 +195,3 @@ def run_gdrive_watcher() -> None:
 
 if __name__ == "__main__":
     run_gdrive_watcher()
-
-
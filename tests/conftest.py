@@ -0,0 +1,68 @@
+import os
+import random
+
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+from auto_canvas import config
+from auto_canvas.config import load_settings, reload_settings
+
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+    """Settings with every folder, store and output under `tmp_path`, so no
+    test writes into the checkout. A developer's `.env` is not read."""
+    monkeypatch.setattr(config, "_apply_dotenv", lambda: None)
+    env = {
+        "PHOTOROOM_API_KEY": "test",
+        "INPUT_DIR": tmp_path / "in",
+        "OUTPUT_PDF_DIR": tmp_path / "out",
+        "WORK_NO_BG_DIR": tmp_path / "no_bg",
+        "WORK_SHADOW_DIR": tmp_path / "shadow",
+        "STATE_FILE": tmp_path / "state.json",
+        "STATE_DB": tmp_path / "state.db",
+        "CACHE_DIR": tmp_path / "cache",
+        "PHOTOROOM_BUCKET_DB": tmp_path / "photoroom_bucket.db",
+        "JOBS_DIR": tmp_path / "jobs",
+        "PROFILE_DIR": tmp_path / "profile",
+        "METRICS_DIR": "",
+        "TRACE_FILE": "",
+        "WKHTMLTOPDF_PATH": tmp_path / "no-wkhtmltopdf",
+        "SHADOW_WORKERS": "1",
+    }
+    for name, value in env.items():
+        monkeypatch.setenv(name, str(value))
+    reload_settings()
+    yield load_settings()
+    monkeypatch.undo()
+    reload_settings()
+
+
+@pytest.fixture
+def cutout(tmp_path) -> str:
+    """RGBA cut-out with a hole, like a background-removal result."""
+    path = str(tmp_path / "cutout.png")
+    img = Image.new("RGBA", (1200, 1600), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.rounded_rectangle((250, 200, 950, 1400), radius=120, fill=(190, 60, 40, 255))
+    draw.ellipse((450, 500, 750, 800), fill=(0, 0, 0, 0))
+    img.save(path, format="PNG")
+    return path
+
+
+@pytest.fixture
+def photos(tmp_path):
+    """Distinct synthetic photos: shapes on a light backdrop."""
+    out = []
+    for seed in range(6):
+        rnd = random.Random(seed)
+        img = Image.new("RGB", (2000, 1500), (235, 235, 230))
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x, y = rnd.randrange(1800), rnd.randrange(1300)
+            w, h = rnd.randrange(100, 600), rnd.randrange(100, 600)
+            draw.ellipse((x, y, x + w, y + h), fill=tuple(rnd.randrange(256) for _ in range(3)))
+        path = os.path.join(tmp_path, f"photo{seed}.jpg")
+        img.filter(ImageFilter.GaussianBlur(3)).save(path, quality=92)
+        out.append(path)
+    return out
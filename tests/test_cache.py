@@ -0,0 +1,28 @@
+import dataclasses
+
+from PIL import Image
+
+from auto_canvas.artifact import Artifact
+from auto_canvas.cache import ArtifactCache, get_cache
+
+
+def _image(shade: int) -> Artifact:
+    return Artifact(name=f"img{shade}", image=Image.new("RGBA", (64, 64), (shade, 0, 0, 255)))
+
+
+def test_artifacts_outlive_their_evicted_entries(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"), max_bytes=1)
+    stored = cache.put("no_bg", "a" * 64, _image(10))
+    hit = cache.get("no_bg", "a" * 64)
+    cache.put("no_bg", "b" * 64, _image(20))  # evicts the first entry
+    assert not cache.contains("no_bg", "a" * 64)
+    assert stored.path is None
+    for art in (stored, hit):
+        assert art.open().getpixel((0, 0)) == (10, 0, 0, 255)
+
+
+def test_cache_size_change_rebuilds_the_cache(settings):
+    cache = get_cache(settings)
+    assert get_cache(settings) is cache
+    resized = get_cache(dataclasses.replace(settings, cache_max_mb=settings.cache_max_mb + 1))
+    assert resized.max_bytes == (settings.cache_max_mb + 1) * 1024 * 1024
@@ -0,0 +1,45 @@
+import random
+
+from PIL import Image
+
+from auto_canvas.dedup import MultiIndex, dhash, get_duplicate_index, hamming
+
+
+def test_copies_are_close_and_distinct_photos_far(settings, photos, tmp_path):
+    radius = settings.dedup_max_distance
+    hashes = [dhash(p) for p in photos]
+    copy = str(tmp_path / "copy.jpg")
+    for path, h in zip(photos, hashes):
+        with Image.open(path) as im:
+            img = im.convert("RGB")
+        side = 1600 / max(img.size)
+        for variant, quality in (
+            (img.resize((img.width // 2, img.height // 2), Image.LANCZOS), 90),
+            (img, 50),
+            (img.resize((int(img.width * side), int(img.height * side))), 50),
+        ):
+            variant.save(copy, quality=quality)
+            assert hamming(h, dhash(copy)) <= radius
+    closest = min(hamming(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:])
+    assert closest > radius
+
+
+def test_multi_index_matches_linear_scan():
+    radius = 5
+    rnd = random.Random(0)
+    stored = [rnd.getrandbits(64) for _ in range(5000)]
+    index = MultiIndex(radius)
+    for i, h in enumerate(stored):
+        index.add(h, str(i))
+    probes = [
+        stored[rnd.randrange(len(stored))] ^ (1 << rnd.randrange(64)) if i % 2 else rnd.getrandbits(64)
+        for i in range(200)
+    ]
+    for h in probes:
+        expected = sorted(str(i) for i, s in enumerate(stored) if hamming(h, s) <= radius)
+        assert sorted(value for _, _, value in index.search(h)) == expected
+
+
+def test_near_duplicates_are_not_reused_by_default(settings):
+    assert settings.dedup_mode == "off"
+    assert get_duplicate_index(settings) is None
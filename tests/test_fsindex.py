@@ -0,0 +1,37 @@
+import os
+import time
+
+from auto_canvas.fsindex import DirectoryIndex
+
+
+def _eventually(index: DirectoryIndex, check, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        index.wait(0.1)
+    return True
+
+
+def test_index_follows_file_events(tmp_path):
+    for i in range(50):
+        (tmp_path / f"img{i:03d}.jpg").write_bytes(b"x")
+    (tmp_path / "notes.txt").write_bytes(b"x")
+    index = DirectoryIndex(str(tmp_path))
+    assert index.start()
+    try:
+        assert len(index.paths()) == 50
+        index.wait(0)
+        new = str(tmp_path / "new.jpg")
+        with open(new, "wb") as f:
+            f.write(b"x")
+        assert index.wait(5.0)
+        assert _eventually(index, lambda: new in index.paths())
+        assert index.signature(new)
+
+        gone = str(tmp_path / "img000.jpg")
+        os.remove(gone)
+        assert _eventually(index, lambda: gone not in index.paths())
+        assert index.reconcile() == 0
+    finally:
+        index.stop()
@@ -0,0 +1,178 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from auto_canvas import gdrive
+from auto_canvas.drive_stand_in import DriveStandIn
+from auto_canvas.gdrive import Downloader, DriveFolderFeed, list_images_in_folder, upload_file
+from auto_canvas.state import StateStore
+from auto_canvas.uploads import UploadQueue
+
+
+FOLDER = "inbox"
+
+
+@pytest.fixture
+def drive():
+    stand_in = DriveStandIn()
+    for i in range(2500):
+        stand_in.put(f"img{i:06d}", FOLDER)
+    stand_in.put("notes", FOLDER, mime="text/plain")
+    stand_in.put("elsewhere", "other")
+    yield stand_in
+    stand_in.close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StateStore(str(tmp_path / "drive.db"))
+
+
+def _ids(feed: DriveFolderFeed):
+    return sorted(f["id"] for f in feed.images())
+
+
+def test_full_listing_is_paginated(drive):
+    drive.calls = 0
+    listed = list_images_in_folder(FOLDER, drive.service())
+    assert sorted(f["id"] for f in listed) == drive.expected(FOLDER)
+    assert drive.calls == 3
+
+
+def test_change_feed_follows_changes(drive, store):
+    svc = drive.service()
+    feed = DriveFolderFeed(FOLDER, store, resync_seconds=0, service=lambda: svc)
+    assert _ids(feed) == drive.expected(FOLDER)
+
+    drive.calls = 0
+    feed.images()
+    assert drive.calls == 1  # idle poll: one empty page of changes
+
+    for i in range(5):
+        drive.put(f"new{i}", FOLDER)
+    drive.put("img000000", FOLDER, trashed=True)
+    drive.put("img000001", "other")
+    drive.delete("img000002")
+    drive.put("new0", FOLDER)
+    assert _ids(feed) == drive.expected(FOLDER)
+
+    drive.put("late", FOLDER)
+    restarted = DriveFolderFeed(FOLDER, store, resync_seconds=0, service=lambda: svc)
+    assert _ids(restarted) == drive.expected(FOLDER)
+
+
+def test_change_feed_resyncs_after_token_expiry(drive, store):
+    svc = drive.service()
+    feed = DriveFolderFeed(FOLDER, store, resync_seconds=0, service=lambda: svc)
+    feed.images()
+    drive.first_token = len(drive.log) + 1
+    drive.put("after_expiry", FOLDER)
+    assert _ids(feed) == drive.expected(FOLDER)
+
+
+def test_downloader_fetches_and_prefetches(drive, tmp_path):
+    ids = [f"img{i:06d}" for i in range(10, 28)]
+    for i, fid in enumerate(ids):
+        drive.content[fid] = os.urandom(1 << 18) + bytes([i])
+    downloader = Downloader(str(tmp_path / "dl"), service=drive.thread_service())
+    try:
+        paths = downloader.fetch(ids[:9])
+        downloader.prefetch(ids[9:])
+        paths += downloader.fetch(ids[9:])
+    finally:
+        downloader.close()
+    for path, fid in zip(paths, ids):
+        with open(path, "rb") as f:
+            assert f.read() == drive.content[fid]
+
+
+def _pdfs(tmp_path, n):
+    paths = []
+    for i in range(n):
+        path = str(tmp_path / f"canvas_{i}.pdf")
+        with open(path, "wb") as f:
+            f.write(os.urandom(3 << 19))  # 1.5 MB: two 1 MB chunks
+        paths.append(path)
+    return paths
+
+
+def _uploaded(drive, folder):
+    return sorted(drive.content[f["id"]] for f in drive.files.values() if folder in f["parents"])
+
+
+def _contents(paths):
+    out = []
+    for path in paths:
+        with open(path, "rb") as f:
+            out.append(f.read())
+    return sorted(out)
+
+
+def test_upload_file_in_chunks(drive, tmp_path):
+    (pdf,) = _pdfs(tmp_path, 1)
+    upload_file(pdf, "out", chunk_mb=1, service=drive.service())
+    assert _uploaded(drive, "out") == _contents([pdf])
+
+
+def test_upload_queue_drains_through_transient_errors(drive, store, tmp_path):
+    pdfs = _pdfs(tmp_path, 3)
+    queue = UploadQueue(store, chunk_mb=1, service=drive.thread_service())
+    drive.upload_faults = 2
+    for path in pdfs:
+        queue.enqueue(path, "out")
+    assert queue.wait_idle(120)
+    assert queue.pending() == 0
+    assert _uploaded(drive, "out") == _contents(pdfs)
+
+
+CRASH_AFTER_UPLOAD = """
+import os, sys
+from auto_canvas.state import StateStore
+from auto_canvas.uploads import UploadQueue
+from auto_canvas.drive_stand_in import drive_client
+
+db, endpoint, pdf = sys.argv[1:]
+store = StateStore(db)
+# Killed once Drive has the file, before the row leaves the queue
+store.finish_upload = lambda upload_id: os._exit(3)
+queue = UploadQueue(store, chunk_mb=1, service=lambda: drive_client(endpoint))
+queue.enqueue(pdf, "out")
+queue.wait_idle(60)
+"""
+
+
+def test_upload_is_not_repeated_after_a_crash(drive, store, tmp_path):
+    (pdf,) = _pdfs(tmp_path, 1)
+    env = dict(
+        os.environ, METRICS_DIR="", TRACE_FILE="",
+        PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    child = subprocess.run(
+        [sys.executable, "-c", CRASH_AFTER_UPLOAD, store.path, drive.endpoint, pdf],
+        env=env, capture_output=True, text=True, timeout=120,
+    )
+    assert child.returncode == 3, child.stderr
+    assert _uploaded(drive, "out") == _contents([pdf])
+    assert store.pending_uploads() == 1
+
+    queue = UploadQueue(StateStore(store.path), chunk_mb=1, service=drive.thread_service())
+    queue.start()
+    assert queue.wait_idle(60)
+    assert queue.pending() == 0
+    assert _uploaded(drive, "out") == _contents([pdf])
+
+
+def test_credential_source_is_resolved_once(monkeypatch):
+    resolved = []
+    resolve = gdrive._resolve_source
+    monkeypatch.setattr(gdrive, "_SOURCES", {})
+    monkeypatch.setattr(gdrive, "_resolve_source", lambda *env: resolved.append(env) or resolve(*env))
+    monkeypatch.delenv("GDRIVE_SERVICE_ACCOUNT_JSON", raising=False)
+    monkeypatch.setenv("GDRIVE_SERVICE_ACCOUNT_JSON_CONTENT", '{"type": "service_account"}')
+    for _ in range(3):
+        assert gdrive._credential_source() == ("info", '{"type": "service_account"}')
+    monkeypatch.setenv("GDRIVE_SERVICE_ACCOUNT_JSON_CONTENT", '{"type": "other"}')
+    assert gdrive._credential_source() == ("info", '{"type": "other"}')
+    assert len(resolved) == 2
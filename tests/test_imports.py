@@ -0,0 +1,20 @@
+import subprocess
+import sys
+
+import pytest
+
+from auto_canvas.bench import STARTUP_MODULES
+
+
+# Libraries the entry points must not load before a batch needs them
+LAZY_DEPENDENCIES = ("reportlab", "pdfkit", "googleapiclient", "numpy", "requests", "fastapi")
+
+
+@pytest.mark.parametrize("module", STARTUP_MODULES)
+def test_entry_points_import_heavy_libraries_lazily(module):
+    code = (
+        f"import sys, {module}; "
+        f"print(' '.join(m for m in {LAZY_DEPENDENCIES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert proc.stdout.split() == []
@@ -0,0 +1,65 @@
+import dataclasses
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from auto_canvas import jobs
+from auto_canvas.jobs import JobQueue, JobQueueFullError
+
+
+def _jpeg() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 32), (200, 100, 50)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def test_concurrent_submits_stay_within_the_queue_size(settings, monkeypatch):
+    save = jobs._save_upload
+
+    def slow_save(*args):
+        time.sleep(0.1)  # every submit is saving files at the same time
+        return save(*args)
+
+    monkeypatch.setattr(jobs, "_save_upload", slow_save)
+    queue = JobQueue(dataclasses.replace(settings, jobs_queue_size=2))
+    monkeypatch.setattr(queue, "start", lambda: None)  # no worker takes the jobs
+    data = _jpeg()
+    accepted, refused = [], []
+
+    def post():
+        try:
+            accepted.append(queue.submit([("photo.jpg", io.BytesIO(data))]))
+        except JobQueueFullError:
+            refused.append(True)
+
+    threads = [threading.Thread(target=post) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(accepted) == 2 and len(refused) == 4
+    assert len(queue._queue) == 2
+
+
+def test_failed_submit_frees_its_slot(settings, monkeypatch):
+    queue = JobQueue(dataclasses.replace(settings, jobs_queue_size=1))
+    monkeypatch.setattr(queue, "start", lambda: None)
+    with pytest.raises(ValueError):
+        queue.submit([("notes.txt", io.BytesIO(b"not an image"))])
+    assert queue.submit([("photo.jpg", io.BytesIO(_jpeg()))]).status == "queued"
+
+
+def test_full_queue_refuses_before_reading_uploads(settings, monkeypatch):
+    queue = JobQueue(dataclasses.replace(settings, jobs_queue_size=1))
+    monkeypatch.setattr(queue, "start", lambda: None)
+    queue.submit([("photo.jpg", io.BytesIO(_jpeg()))])
+
+    class Unread(io.BytesIO):
+        def read(self, *args):
+            raise AssertionError("upload read while the queue is full")
+
+    with pytest.raises(JobQueueFullError):
+        queue.submit([("photo.jpg", Unread(_jpeg()))])
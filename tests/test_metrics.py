@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+from auto_canvas import metrics
+from auto_canvas.metrics import BATCHES_PROCESSED, QUEUE_DEPTH, STAGE_SECONDS, collect
+
+CHILD = """
+import sys
+from auto_canvas import metrics
+metrics._VALUES = metrics._MmapValues(sys.argv[1])
+metrics.BATCHES_PROCESSED.inc(3)
+metrics.STAGE_SECONDS.observe(0.2, stage="bg")
+metrics.QUEUE_DEPTH.set(7, queue="images", folder="in")
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_child(directory: str) -> None:
+    subprocess.run([sys.executable, "-c", CHILD, directory], check=True, cwd=ROOT)
+
+
+def test_exited_processes_are_archived(tmp_path):
+    directory = str(tmp_path / "metrics")
+    _run_child(directory)
+    _run_child(directory)
+    totals = collect(directory)
+    assert totals[BATCHES_PROCESSED.name + "_total"] == 6
+    assert totals[STAGE_SECONDS.name + '_count{stage="bg"}'] == 2
+    assert not any(key.startswith(QUEUE_DEPTH.name) for key in totals)
+    assert os.listdir(directory) == ["archive.metrics"]
+    assert collect(directory) == totals
+
+
+def test_reused_pid_keeps_the_counters(tmp_path, monkeypatch):
+    directory = str(tmp_path / "metrics")
+    earlier = metrics._MmapValues(directory)
+    earlier.add(BATCHES_PROCESSED.name + "_total", 2)
+    monkeypatch.setattr(metrics, "_VALUES", metrics._MmapValues(directory))
+    BATCHES_PROCESSED.inc()
+    assert collect(directory)[BATCHES_PROCESSED.name + "_total"] == 3
@@ -0,0 +1,53 @@
+import os
+
+from auto_canvas.artifact import Artifact
+from auto_canvas.pdfgen import images_to_pdf_3x3
+
+
+def test_reportlab_lays_out_nine_images_per_page(cutout, tmp_path):
+    out_dir = str(tmp_path / "pdf")
+    out = images_to_pdf_3x3([Artifact.from_path(cutout) for _ in range(10)], out_dir)
+    assert os.path.dirname(out) == out_dir
+    with open(out, "rb") as f:
+        data = f.read()
+    assert data.startswith(b"%PDF")
+    assert b"/Count 2" in data
+
+
+def test_missing_wkhtmltopdf_falls_back_to_reportlab(cutout, tmp_path):
+    out = images_to_pdf_3x3([cutout], str(tmp_path / "pdf"), renderer="wkhtmltopdf")
+    with open(out, "rb") as f:
+        assert f.read().startswith(b"%PDF")
+
+
+def test_wkhtmltopdf_inputs_are_temporary(cutout, settings, tmp_path, monkeypatch):
+    import pdfkit
+
+    from auto_canvas import pdfgen
+
+    seen = []
+
+    def from_string(html, out_path, configuration, options):
+        seen.extend(p for p in html.split("'") if p.startswith("file:///"))
+        assert all(os.path.exists(p[len("file://"):]) for p in seen)
+        with open(out_path, "wb") as f:
+            f.write(b"%PDF-1.4\n")
+
+    monkeypatch.setattr(pdfgen, "_wk_config", lambda binary: object())
+    monkeypatch.setattr(pdfkit, "from_string", from_string)
+    images = [Artifact.from_path(cutout), Artifact(name="mem", image=Artifact.from_path(cutout).open())]
+    pdfgen.render_pdf_wkhtmltopdf(images, str(tmp_path / "out.pdf"), settings)
+    assert len(seen) == 2
+    assert os.path.exists(cutout)
+    assert not os.path.exists(seen[1][len("file://"):])
+    assert images[1].path is None
+    assert os.listdir(settings.work_shadow_dir) == []
+
+
+def test_savings_are_logged_only_against_known_sizes(cutout, tmp_path, capsys):
+    out_dir = str(tmp_path / "pdf")
+    images_to_pdf_3x3([Artifact.from_path(cutout)], out_dir)
+    assert "saved" in capsys.readouterr().out
+    decoded = Artifact(name="mem", image=Artifact.from_path(cutout).open())
+    images_to_pdf_3x3([decoded], out_dir)
+    assert "saved" not in capsys.readouterr().out
@@ -0,0 +1,26 @@
+import os
+import time
+
+from PIL import Image
+
+from auto_canvas import pipeline
+from auto_canvas.config import reload_settings
+
+
+def test_once_takes_images_oldest_first(settings, monkeypatch):
+    monkeypatch.setenv("STABILITY_SECONDS", "0")
+    settings = reload_settings()
+    os.makedirs(settings.input_dir, exist_ok=True)
+    names = ["c.jpg", "notes.txt", "a.png", "b.jpg"]
+    for name in names:
+        path = os.path.join(settings.input_dir, name)
+        if name.endswith(".txt"):
+            with open(path, "w") as f:
+                f.write("not an image")
+        else:
+            Image.new("RGB", (8, 8)).save(path)
+        time.sleep(0.01)
+    batches = []
+    monkeypatch.setattr(pipeline, "process_batch", lambda files, backend=None: batches.append(files))
+    pipeline.main_once()
+    assert [[os.path.basename(p) for p in files] for files in batches] == [["c.jpg", "a.png", "b.jpg"]]
@@ -0,0 +1,23 @@
+from auto_canvas.ratelimit import SharedTokenBucket
+
+
+def test_processes_share_one_budget(tmp_path):
+    path = str(tmp_path / "bucket.db")
+    # One bucket per process, e.g. the watcher and the API
+    watcher = SharedTokenBucket.per_minute(6, 2, path=path)
+    api = SharedTokenBucket.per_minute(6, 2, path=path)
+    assert watcher.try_acquire() == 0.0
+    assert api.try_acquire() == 0.0
+    assert 9.0 < watcher.try_acquire() <= 10.0
+    assert api.try_acquire() > 9.0
+
+
+def test_rate_changes_reach_every_process(tmp_path):
+    path = str(tmp_path / "bucket.db")
+    watcher = SharedTokenBucket.per_minute(60, 1, path=path)
+    api = SharedTokenBucket.per_minute(60, 1, path=path)
+    watcher.set_rate(0.5)
+    assert api.rate == 0.5
+    assert api.base_rate == 1.0
+    # A restart with a lower PHOTOROOM_RPM applies straight away
+    assert SharedTokenBucket.per_minute(12, 1, path=path).rate == 0.2
@@ -0,0 +1,35 @@
+import numpy as np
+from PIL import Image
+
+from auto_canvas.config import reload_settings
+from auto_canvas.shadow import MAX_SIDE, SHADOW_BLUR_RADIUS, SHADOW_OFFSET, _fit
+from auto_canvas.shadow import add_shadow_batch, render_shadow_fast, render_shadow_reference
+
+
+def test_fast_engine_matches_reference(cutout):
+    with Image.open(cutout) as im:
+        img = _fit(im.convert("RGBA"), MAX_SIDE)
+    ref = render_shadow_reference(img, SHADOW_OFFSET, SHADOW_BLUR_RADIUS)
+    fast = render_shadow_fast(img, SHADOW_OFFSET, SHADOW_BLUR_RADIUS)
+    assert ref.size == fast.size
+    diff = np.abs(np.asarray(ref, dtype=np.int16) - np.asarray(fast, dtype=np.int16))
+    assert diff.max() <= 24
+    assert diff.mean() <= 0.5
+
+
+def test_batch_keeps_input_order(cutout):
+    outputs = add_shadow_batch([cutout, cutout], encode=True)
+    assert [o.name for o in outputs] == ["cutout", "cutout"]
+    for out in outputs:
+        assert out.data is not None
+        assert out.open().size == (1200 + 4 * SHADOW_OFFSET[0], 1600 + 4 * SHADOW_OFFSET[1])
+
+
+def test_pool_sends_back_only_encoded_images(cutout, monkeypatch):
+    monkeypatch.setenv("SHADOW_WORKERS", "2")
+    monkeypatch.setenv("SHADOW_MAX_INFLIGHT", "1")
+    reload_settings()
+    outputs = add_shadow_batch([cutout] * 3, encode=True)
+    assert [o.image for o in outputs] == [None] * 3
+    assert all(o.open().mode == "RGBA" for o in outputs)
+    assert add_shadow_batch([cutout] * 2)[0].image is not None
@@ -0,0 +1,60 @@
+import os
+
+from auto_canvas.state import StateStore
+from auto_canvas.utils import file_signature, save_state
+
+
+def _touch(path: str) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x")
+    return path
+
+
+def test_migrates_legacy_json_once(tmp_path):
+    json_path = str(tmp_path / "state.json")
+    save_state(json_path, {
+        "processed": ["/in/a.jpg", "/in/b.jpg"],
+        "processing": ["/in/c.jpg"],
+        "processed_signatures": {"/in/a.jpg": "1:2:3"},
+        "processed_drive_ids": ["drive1"],
+    })
+    store = StateStore(str(tmp_path / "state.db"))
+    assert store.migrate_json(json_path)
+    assert not store.migrate_json(json_path)
+    assert store.lookup(["/in/a.jpg", "/in/c.jpg", "/in/d.jpg"]) == {
+        "/in/a.jpg": ("processed", "1:2:3"),
+        "/in/c.jpg": ("processing", None),
+    }
+    assert store.drive_processed(["drive1", "drive2"]) == {"drive1"}
+
+
+def test_batch_lifecycle_and_pruning(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    batch = [_touch(str(tmp_path / "in" / f"img{i}.jpg")) for i in range(3)]
+    batch_id = store.mark_processing(batch)
+    assert store.counts()["inflight_batches"] == 1
+    store.mark_processed(batch, batch_id)
+    assert store.counts()["inflight_batches"] == 0
+    assert store.lookup(batch)[batch[0]] == ("processed", file_signature(batch[0]))
+
+    assert store.prune_absent(batch[1:]) == 1
+    assert batch[0] not in store.lookup(batch)
+    # Another process sees the pruned table too
+    assert batch[0] not in StateStore(store.path).lookup(batch)
+
+
+def test_inflight_batches_are_cleared_on_restart(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.mark_processing(["/in/a.jpg"])
+    assert StateStore(store.path).clear_inflight() == 1
+
+
+def test_pruning_drops_perceptual_hashes(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    kept, gone = (_touch(str(tmp_path / "in" / name)) for name in ("kept.jpg", "gone.jpg"))
+    store.mark_processed([kept, gone], store.mark_processing([kept, gone]))
+    store.add_phash(kept, 1 << 63, "key")
+    store.add_phash(gone, 42, None)
+    assert store.prune_absent([kept]) == 1
+    assert store.phashes() == [(kept, 1 << 63, "key")]
@@ -0,0 +1,45 @@
+import dataclasses
+import os
+
+import pytest
+from PIL import Image
+
+from auto_canvas.config import reload_settings
+from auto_canvas.stream import StreamingPipeline
+
+
+def test_pdf_goes_to_the_pipeline_output_folder(settings, tmp_path):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f"photo{i}.jpg")
+        Image.new("RGB", (400, 300), (240, 240, 240)).save(path)
+        paths.append(path)
+    folder = dataclasses.replace(
+        settings, output_pdf_dir=str(tmp_path / "folder_out"), state_db=str(tmp_path / "folder.db")
+    )
+    with StreamingPipeline(backend="local", settings=folder) as pipeline:
+        pdf = pipeline.submit(paths).result(timeout=120)
+    assert os.path.dirname(pdf) == folder.output_pdf_dir
+    assert not os.listdir(settings.output_pdf_dir)
+
+
+def test_repeated_basenames_keep_separate_work_files(settings, tmp_path, monkeypatch):
+    paths = []
+    for i, folder in enumerate(("a", "b")):
+        os.makedirs(tmp_path / folder)
+        path = str(tmp_path / folder / "photo.jpg")
+        Image.new("RGB", (400, 300), (240, 240 - 100 * i, 240)).save(path)
+        paths.append(path)
+    monkeypatch.setenv("KEEP_WORK_FILES", "1")
+    settings = reload_settings()
+    with StreamingPipeline(backend="local", settings=settings) as pipeline:
+        pipeline.submit(paths).result(timeout=120)
+    for folder in (settings.work_no_bg_dir, settings.work_shadow_dir):
+        assert sorted(os.listdir(folder)) == ["photo.png", "photo_1.png"]
+
+
+def test_empty_batch_is_rejected(settings):
+    with StreamingPipeline(backend="local", settings=settings) as pipeline:
+        for _ in range(settings.pipeline_max_batches + 1):
+            with pytest.raises(ValueError):
+                pipeline.submit([])